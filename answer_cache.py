@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from dotenv import load_dotenv
+
+from manifest import MANIFEST_FILE
+
+load_dotenv()
+
+persist_directory = os.environ.get('PERSIST_DIRECTORY')
+
+# Maximum number of cached answers across all collections, 0 disables the cache
+answer_cache_max_entries = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 1000))
+answer_cache_ttl_seconds = float(os.environ.get('ANSWER_CACHE_TTL_SECONDS', 3600))
+# A query within this cosine distance of a cached one reuses its answer
+answer_cache_max_distance = float(os.environ.get('ANSWER_CACHE_MAX_DISTANCE', 0.05))
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+def collection_version(collection):
+    # Ingestion rewrites the collection's manifest, so its mtime changes whenever the collection does,
+    # whether the ingest ran in this process or from the command line.
+    # A federated query is cached under its comma-separated collection names and versioned by all of them.
+    if "," in collection:
+        return tuple(collection_version(name) for name in collection.split(","))
+    try:
+        return os.stat(os.path.join(persist_directory, collection, MANIFEST_FILE)).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+
+class CachedAnswer:
+    def __init__(self, collection, query, vector, answer, sources, version):
+        self.collection = collection
+        self.query = query
+        self.vector = vector
+        self.answer = answer
+        self.sources = sources
+        self.version = version
+        self.created_at = time.time()
+
+
+class AnswerCache:
+    # Answers keyed by collection and normalised query text, with a cosine-distance
+    # lookup over the cached query embeddings for near-duplicate questions
+
+    def __init__(self, max_entries=answer_cache_max_entries, ttl_seconds=answer_cache_ttl_seconds,
+                 max_distance=answer_cache_max_distance):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self._entries = OrderedDict()  # (collection, normalized query) -> CachedAnswer
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get_exact(self, collection, query):
+        # Checked before the query is embedded
+        if not self.enabled:
+            return None
+        key = (collection, normalize_query(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_valid(entry, collection_version(collection)):
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry
+            if entry is not None:
+                del self._entries[key]
+        return None
+
+    def get_similar(self, collection, vector):
+        if not self.enabled:
+            return None
+        query_vector = _unit(vector)
+        best_key, best_distance = None, self.max_distance
+        version = collection_version(collection)
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.collection != collection:
+                    continue
+                if not self._is_valid(entry, version):
+                    del self._entries[key]
+                    continue
+                distance = 1.0 - float(np.dot(query_vector, entry.vector))
+                if distance <= best_distance:
+                    best_key, best_distance = key, distance
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.semantic_hits += 1
+            return self._entries[best_key]
+
+    def put(self, collection, query, vector, answer, sources):
+        if not self.enabled:
+            return
+        key = (collection, normalize_query(query))
+        entry = CachedAnswer(collection, query, _unit(vector), answer, sources, collection_version(collection))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, collection):
+        with self._lock:
+            for key in [key for key in self._entries if collection in key[0].split(",")]:
+                del self._entries[key]
+
+    def _is_valid(self, entry, version):
+        if self.ttl_seconds > 0 and time.time() - entry.created_at > self.ttl_seconds:
+            return False
+        return entry.version == version
+
+    def stats(self):
+        hits = self.exact_hits + self.semantic_hits
+        lookups = hits + self.misses
+        with self._lock:
+            size = len(self._entries)
+        return {
+            "entries": size,
+            "max_entries": self.max_entries,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+answer_cache = AnswerCache()
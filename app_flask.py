@@ -1,15 +1,14 @@
+import time
+import_started = time.perf_counter()
 import traceback
 import urllib.parse
 import os
 import urllib.parse
-from flask import Flask, request, jsonify
-from langchain.chains import RetrievalQA
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.vectorstores import Chroma
-from langchain.llms import GPT4All, LlamaCpp
+import importlib
+import json
+from flask import Flask, Response, g, request, jsonify, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
 from dotenv import load_dotenv
-from langchain.chains import RetrievalQA
 
 app = Flask(__name__)
 
@@ -24,22 +23,26 @@ model_n_ctx = os.environ.get('MODEL_N_CTX')
 source_directory = os.environ.get('SOURCE_DIRECTORY', 'source_documents')
 ai_story_directory = os.environ.get('SOURCE_DIRECTORY', 'source_documents/ai_story')
 
-from constants import CHROMA_SETTINGS
+# langchain, Chroma and the models are imported and loaded by the warm-up (see startup.py);
+# route handlers import what they need when they run
+from metrics import metrics, request_seconds, Timings
+from startup import warmup, startup_mode, warmup_llm, WARMUP_IMPORTS
+from uploads import max_bytes, upload_max_request_mb
+
+# Request bodies over the upload limit are refused before they are read; the slack covers multipart framing
+if max_bytes(upload_max_request_mb) is not None:
+    app.config["MAX_CONTENT_LENGTH"] = max_bytes(upload_max_request_mb) + (1 << 20)
 
 def test_embedding():
-    src_folder_path = "source_documents"
-    # Create the folder if it doesn't exist
-    os.makedirs(src_folder_path, exist_ok=True)
-    # Create a sample.txt file in the source_documents directory
-    file_path = os.path.join(src_folder_path, "test.txt")
-    with open(file_path, "w") as file:
-        file.write("This is a test.")
-    # Run the ingest.py command
-    os.system('python ingest.py --collection test --project test')
-    # Delete the sample.txt file
-    os.remove(file_path)
+    # Loads the embeddings model and embeds a sample text in-process
+    from resources import registry
+    registry.embeddings().embed_query("This is a test.")
     print("embeddings working")
 
+def load_llm():
+    from resources import registry
+    registry.llm()
+
 def model_download():
     url = None
     if model_type == "LlamaCpp":
@@ -49,6 +52,8 @@ def model_download():
     elif model_type == "OpenAI":
         url = "https://gpt4all.io/models/ggml-gpt4all-j-v1.3-groovy.bin"
 
+    if url is None:
+        return
     folder = "models"
     parsed_url = urllib.parse.urlparse(url)
     filename = os.path.join(folder, os.path.basename(parsed_url.path))
@@ -63,10 +68,88 @@ def model_download():
         os.environ['MODEL_PATH'] = filename
         print("model downloaded")
 
-# Starting the app with embedding and llm download
-def before_first_request():
-    test_embedding()
-    model_download()
+# Startup steps, each timed and reported by /readyz
+for module_name in WARMUP_IMPORTS:
+    warmup.add(f"import_{module_name}", lambda module_name=module_name: importlib.import_module(module_name))
+warmup.add("model_download", model_download)
+warmup.add("load_embeddings", test_embedding)
+if warmup_llm:
+    warmup.add("load_llm", load_llm)
+
+# Warm-up steps each kind of endpoint waits for: searching needs the imports and the embeddings
+# model, generating also needs the LLM, so a failed LLM load leaves search endpoints available
+RETRIEVAL_STEPS = [f"import_{module_name}" for module_name in WARMUP_IMPORTS] + ["load_embeddings"]
+GENERATION_STEPS = RETRIEVAL_STEPS + ["model_download", "load_llm"]
+
+def not_ready_response(steps=RETRIEVAL_STEPS):
+    # Endpoints answer 503 until the warm-up steps they need have finished
+    if warmup.ready_for(steps):
+        return None
+    status = warmup.status()
+    failed = warmup.failed(steps)
+    response = jsonify({"message": "Warm-up failed" if failed else "The service is warming up",
+                        "errors": failed, "startup": status})
+    response.headers["Retry-After"] = "5"
+    return response, 503
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    if hasattr(g, "request_start"):
+        metrics.observe(request_seconds, time.perf_counter() - g.request_start,
+                        endpoint=request.endpoint or "unknown", status=response.status_code)
+    return response
+
+def wants_timings(params=None):
+    # Stage timings are added to JSON responses when requested with timings=1
+    value = request.args.get("timings") or (params if params is not None else request.form).get("timings")
+    return str(value).lower() in ("1", "true", "yes")
+
+def service_gauges():
+    if not warmup.ready_for(RETRIEVAL_STEPS):
+        return [("privategpt_ready", "Whether warm-up has finished", 0)]
+    from resources import registry
+    from answer_cache import answer_cache
+    from scheduler import scheduler
+    scheduler_stats = scheduler.stats()
+    cache_stats = answer_cache.stats()
+    return [
+        ("privategpt_llm_queue_depth", "Generation requests waiting for a model", scheduler_stats["queue_depth"]),
+        ("privategpt_llm_busy_instances", "Model instances currently generating", scheduler_stats["busy"]),
+        ("privategpt_llm_rejected_total", "Generation requests rejected with 429", scheduler_stats["rejected"]),
+        ("privategpt_llm_expired_total", "Generation requests that timed out in the queue", scheduler_stats["expired"]),
+        ("privategpt_answer_cache_hit_rate", "Answer cache hit rate", cache_stats["hit_rate"]),
+        ("privategpt_open_collections", "Collection stores open in the pool", len(registry.stats()["open_collections"])),
+        ("privategpt_ready", "Whether warm-up has finished", int(warmup.ready)),
+        ("privategpt_retrieval_ready", "Whether the search endpoints are ready", 1),
+        ("privategpt_generation_ready", "Whether the generation endpoints are ready",
+         int(warmup.ready_for(GENERATION_STEPS))),
+    ]
+
+metrics.add_gauges(service_gauges)
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    # Liveness: the web server is up, whether or not the models are loaded
+    return jsonify({"status": "ok", "uptime_seconds": warmup.status()["uptime_seconds"]}), 200
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    # Readiness: 200 once the search endpoints can answer, with the readiness of each kind of endpoint,
+    # the state of each startup step and the time each took. ready is only true when every step finished.
+    status = warmup.status()
+    status["endpoints"] = {"retrieval": warmup.ready_for(RETRIEVAL_STEPS),
+                           "generation": warmup.ready_for(GENERATION_STEPS)}
+    if status["state"] == "failed" and status["endpoints"]["retrieval"]:
+        status["state"] = "partial"
+    return jsonify(status), 200 if status["endpoints"]["retrieval"] else 503
 
 # Example route
 @app.route("/")
@@ -90,71 +173,317 @@ def insert_file(file):
 
 @app.route("/embed2", methods=["POST"])
 def embed2():
+    # Jobs wait for the embeddings model themselves, so uploads are accepted during warm-up
+    from jobs import job_queue
+    from uploads import StagedUpload, UploadTooLarge, upload_max_file_mb
+    upload = None
     try:
         files = request.files.getlist("files")
         collection_name = request.form.get("collection_name")
         project_name = request.form.get("project_name")
-        save_path = f"source_documents/{project_name}"
-        os.makedirs(save_path, exist_ok=True)
-        saved_files = []
+        if collection_name is None and files:
+            collection_name = files[0].filename
+        upload = StagedUpload(collection_name, project_name)
+        timings = Timings("embed2")
+        upload_start = time.perf_counter()
 
         for file in files:
-            try:
-                file_path = os.path.join(save_path, file.filename)
-                saved_files.append(file_path)
-                with open(file_path, "wb") as f:
-                    f.write(file.read())
-            except:
-                print("Error saving file")
-
-            if collection_name is None:
-                collection_name = file.filename
+            upload.save(file, max_file_bytes=max_bytes(upload_max_file_mb),
+                        max_request_bytes=max_bytes(upload_max_request_mb))
 
-        os.system(f'python ingest.py --collection {collection_name} --project {project_name}')
+        timings.record("upload", time.perf_counter() - upload_start)
 
-        # Delete the contents of the folder
-        [os.remove(os.path.join(save_path, file.filename)) or os.path.join(save_path, file.filename) for file in files]
-
-        return jsonify({"message": "Files embedded successfully", "saved_files": saved_files}), 200
+        result = {"saved_files": upload.saved_files, "skipped_files": upload.skipped}
+        if upload.saved_files:
+            job = job_queue.submit(collection_name, project_name, upload.files, cleanup=upload.cleanup)
+            upload = None  # the job removes the staged files when it finishes
+            result.update(message="Files queued for embedding", job_id=job.id)
+            status = 202
+        else:
+            # Nothing new to embed
+            upload.cleanup()
+            result.update(message="All files are already embedded", job_id=None)
+            status = 200
+        if wants_timings():
+            result["timings"] = timings.to_dict()
+        return jsonify(result), status
+    except (UploadTooLarge, RequestEntityTooLarge) as e:
+        if upload is not None:
+            upload.cleanup()
+        return jsonify({"error": str(e)}), 413
     except Exception as e:
         print("exception", e)
+        if upload is not None:
+            upload.cleanup()
         return "Something went wrong", 500
 
+@app.route("/jobs", methods=["GET"])
+def list_jobs():
+    from jobs import job_queue
+    return jsonify({"jobs": [job.to_dict() for job in job_queue.list()]}), 200
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    from jobs import job_queue
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+    return jsonify(job.to_dict()), 200
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    from jobs import job_queue
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+    return jsonify(job.to_dict()), 200
+
+@app.route("/collections", methods=["GET"])
+def list_collections():
+    # Read from each collection's cached summary; no store is opened
+    from collection_admin import list_collections
+    return jsonify({"collections": list_collections()}), 200
+
+@app.route("/collections/<name>", methods=["GET"])
+def collection_stats(name):
+    from collection_admin import collection_summary, CollectionNotFound
+    try:
+        return jsonify(collection_summary(name)), 200
+    except CollectionNotFound as e:
+        return jsonify({"message": str(e)}), 404
+
+def collection_changed(name):
+    # Pooled stores, indexes and cached answers of the collection no longer match what is on disk
+    from resources import registry
+    from answer_cache import answer_cache
+    registry.release(name)
+    answer_cache.invalidate(name)
+
+@app.route("/collections/<name>/delete-source", methods=["POST"])
+def delete_collection_source(name):
+    # source may be repeated or a wildcard such as "source_documents/my_project/*.pdf"
+    from collection_admin import delete_source, CollectionNotFound
+    from jobs import job_queue
+    params = request.get_json(silent=True) or request.form
+    sources = params.getlist("source") if hasattr(params, "getlist") else params.get("source")
+    sources = [sources] if isinstance(sources, str) else sources
+    if not sources:
+        return jsonify({"message": "source is required"}), 400
+    remove_files = str(params.get("remove_files", "")).lower() in ("1", "true", "yes")
+    try:
+        with job_queue.collection_lock(name):
+            result = delete_source(name, sources, remove_files=remove_files)
+    except CollectionNotFound as e:
+        return jsonify({"message": str(e)}), 404
+    collection_changed(name)
+    return jsonify(result), 200
+
+@app.route("/collections/<name>/compact", methods=["POST"])
+def compact_collection(name):
+    from collection_admin import compact, CollectionNotFound
+    from jobs import job_queue
+    try:
+        with job_queue.collection_lock(name):
+            result = compact(name)
+    except CollectionNotFound as e:
+        return jsonify({"message": str(e)}), 404
+    collection_changed(name)
+    return jsonify(result), 200
+
+def request_timeout():
+    # Optional per-request limit on the time spent queued for a model, capped by LLM_QUEUE_TIMEOUT_SECONDS
+    timeout = request.form.get("timeout")
+    return float(timeout) if timeout else None
+
+def requested_collections(params=None):
+    # collection_name may be repeated, comma-separated or a wildcard such as "team-*"
+    params = request.form if params is None else params
+    spec = params.getlist("collection_name") if hasattr(params, "getlist") else params.get("collection_name")
+    if isinstance(spec, list) and len(spec) == 1:
+        spec = spec[0]
+    from qa import collections_for
+    return collections_for(spec)
+
+def rejected_response(e):
+    response = jsonify({"message": str(e), "retry_after": e.retry_after})
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, e.status
+
 @app.route("/retrieve", methods=["POST"])
 def query():
+    not_ready = not_ready_response(GENERATION_STEPS)
+    if not_ready:
+        return not_ready
+    from resources import ModelNotSupported
+    from scheduler import SchedulerRejected
+    from qa import answer_query
     try:
         query_text = request.form.get("query")
-        collection_name = request.form.get("collection_name")
+        collection_names = requested_collections()
 
-        print(query_text,collection_name)
-        embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
-        db = Chroma(persist_directory=persist_directory+"/"+collection_name, embedding_function=embeddings, client_settings=CHROMA_SETTINGS)
-        retriever = db.as_retriever()
+        print(query_text,collection_names)
+        timings = Timings("retrieve")
+        with timings.stage("total"):
+            result = answer_query(collection_names, query_text, timeout=request_timeout(), timings=timings)
+        if "collections" in timings.values:
+            # Per-collection search latency and hit counts of a federated query
+            result["collections"] = timings.values["collections"]
+        if wants_timings():
+            result["timings"] = timings.to_dict()
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    except ModelNotSupported as e:
+        print(e)
+        return "Model not supported", 400
+    except SchedulerRejected as e:
+        return rejected_response(e)
+    except Exception as e:
+        traceback.print_exc()
+        print("exception", e)
+        return "Something went wrong", 500
 
-        callbacks = [StreamingStdOutCallbackHandler()]
+@app.route("/retrieve/docs", methods=["POST"])
+def query_docs():
+    # Retrieval only: returns the top-k chunks with their similarity (and fused score in hybrid mode)
+    # without running the LLM
+    not_ready = not_ready_response()
+    if not_ready:
+        return not_ready
+    from resources import registry
+    from retrieval import document_to_dict, search_collections
+    try:
+        params = request.get_json(silent=True) or request.form
+        query_text = params.get("query")
+        collection_names = requested_collections(params)
+        search_filter = params.get("filter")
+        if isinstance(search_filter, str):
+            search_filter = json.loads(search_filter) if search_filter else None
+        score_threshold = params.get("score_threshold")
 
-        if model_type == "LlamaCpp":
-            llm = LlamaCpp(model_path=model_path, n_ctx=model_n_ctx, callbacks=callbacks, verbose=False)
-        elif model_type == "GPT4All":
-            llm = GPT4All(model=model_path, n_ctx=model_n_ctx, backend='gptj', callbacks=callbacks, verbose=False)
-        else:
-            print(f"Model {model_type} not supported!")
-            return "Model not supported", 400
+        timings = Timings("retrieve_docs")
+        with timings.stage("embed_query"):
+            vector = registry.embeddings().embed_query(query_text)
+        with timings.stage("vector_search"):
+            hits, per_collection = search_collections(
+                collection_names, registry.db, vector,
+                k=int(params.get("k", 4)),
+                query_text=query_text,
+                open_index=registry.lexical_index,
+                mode=params.get("mode") or None,
+                score_threshold=float(score_threshold) if score_threshold not in (None, "") else None,
+                mmr=str(params.get("mmr", "false")).lower() in ("1", "true", "yes"),
+                fetch_k=int(params.get("fetch_k", 20)),
+                lambda_mult=float(params.get("lambda_mult", 0.5)),
+                filter=search_filter,
+                similarities=True,
+            )
+        timings.count("chunks", len(hits))
+        # score is the similarity to the query; hybrid hits are ranked by their rrf_score
+        result = {"docs": [document_to_dict(doc, score, rrf_score) for doc, score, rrf_score in hits]}
+        if len(collection_names) > 1:
+            result["collections"] = per_collection
+        if wants_timings(params):
+            result["timings"] = timings.to_dict()
+        return jsonify(result), 200
+    except (ValueError, TypeError) as e:
+        print("exception", e)
+        return jsonify({"message": f"Invalid parameters: {e}"}), 400
+    except Exception as e:
+        traceback.print_exc()
+        print("exception", e)
+        return "Something went wrong", 500
+
+@app.route("/retrieve/stream", methods=["POST"])
+def query_stream():
+    # Server-sent events: "sources" first, then one "token" per generated token, then "done" with timings
+    not_ready = not_ready_response(GENERATION_STEPS)
+    if not_ready:
+        return not_ready
+    from answer_cache import answer_cache
+    from qa import cached_answer, cache_key, retrieve, pack, generate_answer
+    from retrieval import document_to_dict
+    from scheduler import scheduler, SchedulerRejected
+    from streaming import sse_event, stream_generation
+    try:
+        query_text = request.form.get("query")
+        collection_names = requested_collections()
 
-        qa = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever, return_source_documents=True)
+        print(query_text,collection_names)
+        start = time.perf_counter()
+        stage_timings = Timings("retrieve_stream")
+        cached, vector = cached_answer(collection_names, query_text, stage_timings)
+        if cached is not None:
+            timings = {"retrieval_seconds": time.perf_counter() - start}
+            return Response(stream_with_context(cached_events(cached, timings)), mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-        res = qa(query_text)
-        answer, docs = res['result'], res['source_documents']
+        context = pack(retrieve(collection_names, query_text, vector, stage_timings), stage_timings)
+        docs = context.docs
+        timings = {"retrieval_seconds": time.perf_counter() - start}
+        timeout = request_timeout()
 
-        return jsonify({"results": answer, "docs": docs}), 200
+        scheduler.check_capacity()
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    except SchedulerRejected as e:
+        return rejected_response(e)
     except Exception as e:
         traceback.print_exc()
         print("exception", e)
         return "Something went wrong", 500
 
-#to run before all else as replacement to app.before_first_request
-with app.app_context():
-    before_first_request()
+    sources = [document_to_dict(doc) for doc in docs]
+
+    def generate(callbacks):
+        answer = generate_answer(collection_names, query_text, docs, callbacks=callbacks, timeout=timeout,
+                                 timings=stage_timings)
+        answer_cache.put(cache_key(collection_names), query_text, vector, answer, sources)
+
+    def events():
+        yield sse_event("sources", {"docs": sources, "context": context.to_dict()})
+        try:
+            for token in stream_generation(generate, timings):
+                yield sse_event("token", {"token": token})
+        except Exception as e:
+            traceback.print_exc()
+            yield sse_event("error", {"message": str(e)})
+            return
+        timings["total_seconds"] = time.perf_counter() - start
+        timings["stages"] = stage_timings.to_dict()
+        yield sse_event("done", {"timings": timings, "cached": False})
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def cached_events(cached, timings):
+    # A cached answer is sent as a single token so clients handle it like a generated one
+    from streaming import sse_event
+    yield sse_event("sources", {"docs": cached.sources})
+    yield sse_event("token", {"token": cached.answer})
+    timings.update({"tokens": 1, "total_seconds": timings["retrieval_seconds"]})
+    yield sse_event("done", {"timings": timings, "cached": True})
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    not_ready = not_ready_response()
+    if not_ready:
+        return not_ready
+    from resources import registry
+    from answer_cache import answer_cache
+    from scheduler import scheduler
+    from model_client import model_server_socket, model_client
+    result = {"resources": registry.stats(), "answer_cache": answer_cache.stats(), "scheduler": scheduler.stats()}
+    if model_server_socket:
+        result["model_server"] = model_client().stats()
+    return jsonify(result), 200
+
+warmup.record("import_app", time.perf_counter() - import_started)
+# Replaces the blocking downloads and test ingest that used to run here at import
+if startup_mode == "eager":
+    warmup.run()
+elif startup_mode == "background":
+    warmup.start()
 
 if __name__ == "__main__":
     app.run(debug=True,port=5601)
@@ -0,0 +1,104 @@
+import csv
+import os
+import random
+
+# File types the generator can write, all of which have a loader in ingest.LOADER_MAPPING
+WRITERS = {}
+
+_SYLLABLES = ["ka", "lo", "mi", "ren", "ta", "vo", "su", "ne", "dor", "pha", "qui", "zel", "bra", "ion", "tek"]
+
+
+def _writer(ext):
+    def register(fn):
+        WRITERS[ext] = fn
+        return fn
+    return register
+
+
+def parse_mix(mix):
+    # "txt=0.6,csv=0.2,md=0.2" -> {".txt": 0.6, ".csv": 0.2, ".md": 0.2}
+    weights = {}
+    for part in mix.split(","):
+        ext, _, weight = part.partition("=")
+        ext = "." + ext.strip().lstrip(".")
+        if ext not in WRITERS:
+            raise ValueError(f"Cannot generate '{ext}' files, choose from {', '.join(sorted(WRITERS))}")
+        weights[ext] = float(weight or 1)
+    return weights
+
+
+class TextSource:
+    # Deterministic pseudo-words and sentences; every document also carries unique identifiers
+    def __init__(self, seed, vocabulary_size=5000):
+        self.random = random.Random(seed)
+        self.vocabulary = sorted({
+            "".join(self.random.choice(_SYLLABLES) for _ in range(self.random.randint(1, 4)))
+            for _ in range(vocabulary_size)
+        })
+
+    def sentence(self, words=12):
+        return " ".join(self.random.choice(self.vocabulary) for _ in range(words)).capitalize() + "."
+
+    def paragraph(self, sentences=6):
+        return " ".join(self.sentence(self.random.randint(6, 18)) for _ in range(sentences))
+
+
+@_writer(".txt")
+def write_txt(path, source, size):
+    with open(path, "w", encoding="utf8") as f:
+        written = 0
+        while written < size:
+            paragraph = source.paragraph() + "\n\n"
+            f.write(paragraph)
+            written += len(paragraph)
+
+
+@_writer(".md")
+def write_md(path, source, size):
+    with open(path, "w", encoding="utf8") as f:
+        written = 0
+        while written < size:
+            section = f"## {source.sentence(4)}\n\n{source.paragraph()}\n\n"
+            f.write(section)
+            written += len(section)
+
+
+@_writer(".html")
+def write_html(path, source, size):
+    with open(path, "w", encoding="utf8") as f:
+        f.write("<html><body>\n")
+        written = 0
+        while written < size:
+            section = f"<h2>{source.sentence(4)}</h2>\n<p>{source.paragraph()}</p>\n"
+            f.write(section)
+            written += len(section)
+        f.write("</body></html>\n")
+
+
+@_writer(".csv")
+def write_csv(path, source, size):
+    with open(path, "w", encoding="utf8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "title", "body"])
+        written, row = 0, 0
+        while written < size:
+            body = source.paragraph(2)
+            writer.writerow([row, source.sentence(4), body])
+            written += len(body)
+            row += 1
+
+
+def generate_corpus(directory, files, mix, mean_size, seed=0):
+    # Writes files into directory and returns one query per file, drawn from the corpus vocabulary
+    os.makedirs(directory, exist_ok=True)
+    weights = parse_mix(mix)
+    source = TextSource(seed)
+    chooser = random.Random(seed + 1)
+    extensions, ext_weights = zip(*weights.items())
+    queries = []
+    for index in range(files):
+        ext = chooser.choices(extensions, ext_weights)[0]
+        size = max(200, int(chooser.expovariate(1 / mean_size)))
+        WRITERS[ext](os.path.join(directory, f"doc_{index:06d}{ext}"), source, size)
+        queries.append(source.sentence(10))
+    return queries
@@ -0,0 +1,57 @@
+import hashlib
+import time
+from typing import List, Optional
+
+import numpy as np
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+
+
+class FakeEmbeddings(Embeddings):
+    # Deterministic unit vectors derived from the text hash, so runs need no model download.
+    # seconds_per_text simulates the cost of a real embedding model.
+
+    def __init__(self, dim=384, seconds_per_text=0.0):
+        self.dim = dim
+        self.seconds_per_text = seconds_per_text
+
+    def _embed(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.seconds_per_text:
+            time.sleep(self.seconds_per_text * len(texts))
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class FakeLLM(LLM):
+    # Answers with words picked deterministically from the prompt, streaming them as tokens.
+    # tokens_per_second of 0 generates without delay.
+
+    answer_tokens: int = 32
+    tokens_per_second: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None) -> str:
+        words = prompt.split() or ["empty"]
+        seed = int.from_bytes(hashlib.sha256(prompt.encode("utf8")).digest()[:8], "little")
+        picks = np.random.default_rng(seed).integers(0, len(words), self.answer_tokens)
+        tokens = []
+        for index in picks:
+            if self.tokens_per_second:
+                time.sleep(1.0 / self.tokens_per_second)
+            token = words[index] + " "
+            tokens.append(token)
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+        return "".join(tokens).strip()
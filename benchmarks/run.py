@@ -0,0 +1,212 @@
+"""Offline ingest and query benchmark with fake embedding and LLM backends.
+
+  python -m benchmarks.run --files 500 --mix txt=0.6,csv=0.2,md=0.2 --queries 200 --output bench.json
+  python -m benchmarks.run --files 500 --compare bench.json
+
+Runs in a temporary working directory, so no model download, network or existing data is needed.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COLLECTION = "benchmark"
+PROJECT = "benchmark"
+
+# Metrics checked for regressions by --compare
+HIGHER_IS_BETTER = ("docs_per_second", "chunks_per_second", "mb_per_second", "queries_per_second")
+LOWER_IS_BETTER = ("seconds", "peak_rss_mb", "cold_seconds", "p50_seconds", "p95_seconds", "p99_seconds")
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def configure_environment(args, workdir):
+    # Project modules read their settings at import, so this runs before any of them is imported
+    os.environ["PERSIST_DIRECTORY"] = os.path.join(workdir, "db")
+    os.environ["EMBEDDINGS_MODEL_NAME"] = "benchmark-fake"
+    os.environ["EMBEDDING_CACHE_DIR"] = os.path.join(workdir, "embedding_cache")
+    os.environ["EMBEDDING_CACHE_MAX_ENTRIES"] = str(args.embedding_cache_entries)
+    os.environ["EXTRACTION_CACHE_DIR"] = os.path.join(workdir, "extraction_cache")
+    os.environ["EXTRACTION_CACHE_MAX_MB"] = str(args.extraction_cache_mb)
+    os.environ["ANSWER_CACHE_MAX_ENTRIES"] = str(args.answer_cache_entries)
+    os.environ["LLM_INSTANCES"] = str(args.llm_instances)
+    os.environ["LLM_QUEUE_SIZE"] = str(max(args.concurrency, 1) * 4)
+    os.environ["STARTUP_MODE"] = "eager"
+    sys.path.insert(0, REPO_ROOT)
+    os.chdir(workdir)
+
+
+def run_ingest_benchmark(args, embeddings):
+    from benchmarks.corpus import generate_corpus
+    import ingest
+
+    source_directory = os.path.join("source_documents", PROJECT)
+    queries = generate_corpus(source_directory, args.files, args.mix, args.mean_size, seed=args.seed)
+    corpus_bytes = sum(os.path.getsize(os.path.join(source_directory, name)) for name in os.listdir(source_directory))
+
+    start = time.perf_counter()
+    progress = ingest.run_ingest(COLLECTION, PROJECT, embeddings=embeddings, workers=args.workers,
+                                 batch_size=args.batch_size, full_rebuild=True, chunk_size=args.chunk_size,
+                                 chunk_overlap=args.chunk_overlap)
+    elapsed = time.perf_counter() - start
+    return queries, {
+        "files": args.files,
+        "corpus_mb": corpus_bytes / 1e6,
+        "docs_loaded": progress.files_loaded,
+        "chunks": progress.chunks_persisted,
+        "seconds": elapsed,
+        "docs_per_second": progress.files_loaded / elapsed,
+        "chunks_per_second": progress.chunks_persisted / elapsed,
+        "mb_per_second": corpus_bytes / 1e6 / elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_query_benchmark(args, queries):
+    # Queries go through the Flask /retrieve route, including the readiness gate, scheduler
+    # admission and JSON serialisation; --direct calls qa.answer_query to measure the library path only
+    queries = (queries * (args.queries // max(len(queries), 1) + 1))[:args.queries]
+    errors = []
+
+    if args.direct:
+        from qa import answer_query
+
+        def run_query(query):
+            answer_query([COLLECTION], query)
+    else:
+        import threading
+        # Imported after the fakes are installed; STARTUP_MODE=eager warms up before returning
+        from app_flask import app
+        clients = threading.local()
+
+        def run_query(query):
+            if not hasattr(clients, "client"):
+                clients.client = app.test_client()
+            response = clients.client.post("/retrieve", data={"query": query, "collection_name": COLLECTION})
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    def timed_query(query):
+        start = time.perf_counter()
+        run_query(query)
+        return time.perf_counter() - start
+
+    # The first query opens the collection and is reported separately
+    cold = timed_query(queries[0])
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = list(executor.map(timed_query, queries[1:]))
+    elapsed = time.perf_counter() - start
+    if errors:
+        print(f"{len(errors)} queries failed with status {sorted(set(errors))}")
+    return {
+        "path": "library" if args.direct else "http",
+        "queries": len(latencies),
+        "errors": len(errors),
+        "concurrency": args.concurrency,
+        "cold_seconds": cold,
+        "queries_per_second": len(latencies) / elapsed if elapsed > 0 else None,
+        "p50_seconds": percentile(latencies, 0.50),
+        "p95_seconds": percentile(latencies, 0.95),
+        "p99_seconds": percentile(latencies, 0.99),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(results, baseline_path, tolerance):
+    # Prints each metric against the baseline and returns the names of those that regressed
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for section in ("ingest", "query"):
+        for name, value in results[section].items():
+            old = baseline.get(section, {}).get(name)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            change = (value - old) / old
+            worse = -change if name in HIGHER_IS_BETTER else change
+            marker = ""
+            if name in HIGHER_IS_BETTER + LOWER_IS_BETTER and worse > tolerance:
+                marker = "  REGRESSION"
+                regressions.append(f"{section}.{name}")
+            print(f"{section}.{name:<20} {old:12.4f} -> {value:12.4f} ({change:+.1%}){marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=200, help="Number of files in the synthetic corpus")
+    parser.add_argument("--mix", default="txt=0.7,csv=0.3", help="File type mix, e.g. txt=0.6,csv=0.2,md=0.2")
+    parser.add_argument("--mean-size", type=int, default=8000, help="Mean file size in bytes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="Ingest parsing processes")
+    parser.add_argument("--batch-size", type=int, default=128, help="Ingest embedding batch size")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--chunk-overlap", type=int, default=50)
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="Simulated seconds per embedded text")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=0.0, help="Simulated generation speed, 0 for none")
+    parser.add_argument("--llm-instances", type=int, default=1)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=1, help="Queries in flight at once")
+    parser.add_argument("--direct", action="store_true", help="Call qa.answer_query instead of POST /retrieve, measuring the library path only")
+    parser.add_argument("--embedding-cache-entries", type=int, default=0, help="Enable the embedding cache with this capacity")
+    parser.add_argument("--extraction-cache-mb", type=float, default=0, help="Enable the extracted text cache with this size")
+    parser.add_argument("--answer-cache-entries", type=int, default=0, help="Enable the answer cache with this capacity")
+    parser.add_argument("--workdir", help="Directory for the corpus and collection (default: a new temporary directory)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Compare against a previous JSON result and exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="privategpt-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    configure_environment(args, workdir)
+
+    from benchmarks.fakes import FakeEmbeddings, FakeLLM
+    from embedding_cache import with_cache
+    from resources import registry
+
+    embeddings = with_cache(FakeEmbeddings(seconds_per_text=args.embed_latency), os.environ["EMBEDDINGS_MODEL_NAME"])
+    # The query path takes its models from the registry, so the fakes are installed there
+    registry._embeddings = embeddings
+    registry._llm = FakeLLM(tokens_per_second=args.llm_tokens_per_second)
+    registry.load_llm = lambda: FakeLLM(tokens_per_second=args.llm_tokens_per_second)
+
+    queries, ingest_results = run_ingest_benchmark(args, embeddings)
+    query_results = run_query_benchmark(args, queries)
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "workdir")},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "timestamp": time.time(),
+        "ingest": ingest_results,
+        "query": query_results,
+    }
+    print(json.dumps({"ingest": ingest_results, "query": query_results}, indent=2))
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline and compare(results, baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
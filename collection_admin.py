@@ -0,0 +1,227 @@
+import argparse
+import fnmatch
+import json
+import os
+import time
+from contextlib import nullcontext
+
+from dotenv import load_dotenv
+
+from manifest import Manifest, MANIFEST_FILE
+from lexical_index import BM25Index
+from retrieval import collection_names, resolve_collections, store_lock
+from vector_store import (backend_for, stored_dtype, stored_collection, chroma_client, chroma_has_collection,
+                          chroma_write, MmapCollection, STORE_DIR, INDEX_FILE, CHROMA_FILES)
+
+load_dotenv()
+
+persist_directory = os.environ.get('PERSIST_DIRECTORY')
+
+# Per-collection figures written whenever the collection changes, so listing never opens a store
+SUMMARY_FILE = "summary.json"
+
+
+class CollectionNotFound(Exception):
+    pass
+
+
+def _directory(name):
+    if name not in collection_names(persist_directory):
+        raise CollectionNotFound(f"Collection {name!r} not found")
+    return os.path.join(persist_directory, name)
+
+
+def directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file_name))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _chroma_index_bytes(name):
+    # Bytes of a Chroma collection's HNSW index files in PERSIST_DIRECTORY/index
+    index_directory = os.path.join(persist_directory, "index")
+    try:
+        collection_uuid = str(chroma_client()._db.get_collection_uuid_from_name(name))
+        index_files = [file_name for file_name in os.listdir(index_directory) if collection_uuid in file_name]
+    except (FileNotFoundError, IndexError, ValueError):
+        return 0
+    return sum(os.path.getsize(os.path.join(index_directory, file_name)) for file_name in index_files)
+
+
+def collection_bytes(name, directory):
+    if backend_for(name, directory) == "chroma" and chroma_has_collection(name):
+        return directory_bytes(directory) + _chroma_index_bytes(name)
+    return directory_bytes(directory)
+
+
+def chroma_shared_bytes():
+    # The parquet files holding the chunks of every Chroma collection together
+    paths = [os.path.join(persist_directory, file_name) for file_name in CHROMA_FILES]
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def write_summary(name, directory=None):
+    # Recomputes a collection's summary from its store, manifest, BM25 index metadata and store files.
+    # chunks is counted in the store, so collections ingested before manifests are counted too.
+    # A Chroma collection's bytes include its HNSW index files; the parquet files all Chroma
+    # collections share are reported apart as shared_bytes.
+    directory = directory or os.path.join(persist_directory, name)
+    manifest = Manifest(directory)
+    backend = backend_for(name, directory)
+    summary = {
+        "name": name,
+        "backend": backend,
+        "dtype": stored_dtype(name, directory),
+        "files": len(manifest.files),
+        "chunks": sum(len(entry["chunk_ids"]) for entry in manifest.files.values()),
+        "bm25_deleted_chunks": BM25Index(directory).deleted_docs(),
+        "bytes": collection_bytes(name, directory),
+        "updated_at": time.time(),
+    }
+    if os.path.exists(os.path.join(directory, STORE_DIR, INDEX_FILE)):
+        # Rows of deleted chunks stay in the files until the collection is compacted
+        collection = MmapCollection(os.path.join(directory, STORE_DIR))
+        try:
+            summary["chunks"] = collection.count()
+            summary["deleted_rows"] = collection.memory()["rows"] - collection.count()
+        finally:
+            collection.close()
+    elif backend == "chroma" and chroma_has_collection(name):
+        collection = stored_collection(name, directory)
+        with store_lock(collection):
+            summary["chunks"] = collection.count()
+        summary["shared_bytes"] = chroma_shared_bytes()
+    tmp_path = os.path.join(directory, SUMMARY_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(summary, f)
+    os.replace(tmp_path, os.path.join(directory, SUMMARY_FILE))
+    return summary
+
+
+def read_summary(name, directory=None):
+    # The cached summary, recomputed when missing or older than the manifest
+    directory = directory or os.path.join(persist_directory, name)
+    path = os.path.join(directory, SUMMARY_FILE)
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    try:
+        if not os.path.exists(manifest_path) or os.path.getmtime(path) >= os.path.getmtime(manifest_path):
+            with open(path) as f:
+                return json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+    return write_summary(name, directory)
+
+
+def list_collections():
+    return [read_summary(name) for name in collection_names(persist_directory)]
+
+
+def collection_summary(name):
+    return read_summary(name, _directory(name))
+
+
+def delete_source(name, sources, remove_files=False):
+    # Deletes the chunks of the given source paths, which may be shell-style wildcards such as
+    # "source_documents/team/*.pdf", from the store, the BM25 index and the manifest.
+    # Source files are left on disk unless remove_files is set; an ingest of their project
+    # directory would otherwise add them again.
+    directory = _directory(name)
+    manifest = Manifest(directory)
+    patterns = [sources] if isinstance(sources, str) else list(sources)
+    matched = sorted(path for path in manifest.files if any(fnmatch.fnmatch(path, pattern) for pattern in patterns))
+    # Sources without a manifest entry, e.g. from before manifests, are matched on chunk metadata
+    exact = [pattern for pattern in patterns if not any(char in pattern for char in "*?[") and pattern not in matched]
+    chunk_ids = [chunk_id for path in matched for chunk_id in manifest.forget(path)]
+    # Chroma collections are persisted when chroma_write ends
+    with chroma_write() if backend_for(name, directory) == "chroma" else nullcontext():
+        collection = stored_collection(name, directory)
+        with store_lock(collection):
+            for source in exact:
+                found = collection.get(where={"source": source}, include=[])["ids"]
+                if found:
+                    chunk_ids.extend(found)
+                    matched.append(source)
+            if chunk_ids:
+                collection.delete(ids=chunk_ids)
+            if isinstance(collection, MmapCollection):
+                collection.persist()
+                collection.close()
+    index = BM25Index(directory)
+    index.delete(chunk_ids)
+    index.save()
+    manifest.save()
+    if remove_files:
+        for path in matched:
+            if os.path.isfile(path):
+                os.remove(path)
+    summary = write_summary(name, directory)
+    return {"sources": matched, "deleted_chunks": len(chunk_ids), "collection": summary}
+
+
+def compact(name):
+    # Reclaims the space of deleted chunks: the mmap store is rewritten without their rows and a
+    # Chroma collection's HNSW index is rebuilt; the BM25 index is merged into one segment
+    directory = _directory(name)
+    bytes_before = collection_bytes(name, directory)
+    start = time.perf_counter()
+    with chroma_write() if backend_for(name, directory) == "chroma" else nullcontext():
+        collection = stored_collection(name, directory)
+        with store_lock(collection):
+            if isinstance(collection, MmapCollection):
+                store = collection.compact()
+                collection.close()
+            else:
+                # Chroma only marks deleted chunks in its HNSW index; the index is dropped and built
+                # again from the stored embeddings (chromadb 0.3 has no public call for this)
+                chroma_db = chroma_client()._db
+                chroma_db._delete_index(chroma_db.get_collection_uuid_from_name(name))
+                collection.create_index()
+                store = {"rows": collection.count()}
+    index = BM25Index(directory)
+    if index.exists:
+        index.save(compact=True)
+    summary = write_summary(name, directory)
+    return {"store": store, "bytes_before": bytes_before, "bytes": summary["bytes"],
+            "seconds": time.perf_counter() - start, "collection": summary}
+
+
+def _format_bytes(size):
+    return f"{size / 1e6:.1f} MB"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List, inspect, prune and compact collections")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="Collections with their chunk counts and size on disk")
+    stats_parser = subparsers.add_parser("stats", help="Recompute and print the summary of collections")
+    stats_parser.add_argument("collections", help="Collection name, comma-separated list or wildcard")
+    delete_parser = subparsers.add_parser("delete-source", help="Delete the chunks of source files from a collection")
+    delete_parser.add_argument("collection")
+    delete_parser.add_argument("sources", nargs="+", help="Source paths as stored in chunk metadata, or wildcards")
+    delete_parser.add_argument("--remove-files", action="store_true", help="Also delete the source files from disk")
+    compact_parser = subparsers.add_parser("compact", help="Reclaim the space of deleted chunks")
+    compact_parser.add_argument("collections", help="Collection name, comma-separated list or wildcard")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for summary in list_collections():
+            shared = (f" + {_format_bytes(summary['shared_bytes'])} shared by Chroma collections"
+                      if "shared_bytes" in summary else "")
+            print(f"{summary['name']}: {summary['chunks']} chunks from {summary['files']} files, "
+                  f"{_format_bytes(summary['bytes'])}{shared} ({summary['backend']}, {summary['dtype']})")
+    elif args.command == "stats":
+        for name in resolve_collections(args.collections, persist_directory):
+            print(json.dumps(write_summary(name, _directory(name))))
+    elif args.command == "delete-source":
+        result = delete_source(args.collection, args.sources, remove_files=args.remove_files)
+        print(f"Deleted {result['deleted_chunks']} chunks of {len(result['sources'])} sources from {args.collection}")
+    else:
+        for name in resolve_collections(args.collections, persist_directory):
+            result = compact(name)
+            print(f"{name}: {_format_bytes(result['bytes_before'])} -> {_format_bytes(result['bytes'])} "
+                  f"in {result['seconds']:.1f}s")
@@ -0,0 +1,179 @@
+import math
+import os
+import re
+from typing import List
+
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+
+from metrics import metrics, context_tokens, context_tokens_saved
+
+load_dotenv()
+
+model_n_ctx = os.environ.get('MODEL_N_CTX')
+
+# Pack retrieved chunks before generation; 0 passes them to the LLM unchanged
+context_packing = os.environ.get('CONTEXT_PACKING', '1').lower() in ('1', 'true', 'yes')
+# Tokens of MODEL_N_CTX left for the prompt template, the question and the answer
+context_reserve_tokens = int(os.environ.get('CONTEXT_RESERVE_TOKENS', 512))
+# Tokens of retrieved text allowed in the prompt; by default what MODEL_N_CTX leaves after the reserve
+context_token_budget = int(os.environ.get('CONTEXT_TOKEN_BUDGET') or
+                           (max(int(model_n_ctx) - context_reserve_tokens, 128) if model_n_ctx else 1500))
+# Token counts are estimated from the text length, which avoids loading a tokenizer per request
+context_chars_per_token = float(os.environ.get('CONTEXT_CHARS_PER_TOKEN', 4))
+# Chunks sharing at least this fraction of their word 5-grams with a more relevant chunk are dropped
+context_duplicate_threshold = float(os.environ.get('CONTEXT_DUPLICATE_THRESHOLD', 0.8))
+
+# Shortest suffix/prefix overlap taken as evidence that two chunks of a source were adjacent
+MIN_OVERLAP_CHARS = 16
+# Longest overlap searched for; the splitter's chunk_overlap is 50 characters by default
+MAX_OVERLAP_CHARS = 400
+# A chunk that doesn't fit is cut to the remaining budget only if at least this many tokens remain
+MIN_PARTIAL_TOKENS = 64
+SHINGLE_WORDS = 5
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / context_chars_per_token)
+
+
+class PackedContext:
+    def __init__(self, docs, tokens_before, tokens, merged=0, duplicates=0, dropped=0, truncated=0):
+        self.docs = docs
+        self.tokens_before = tokens_before
+        self.tokens = tokens
+        self.merged = merged
+        self.duplicates = duplicates
+        self.dropped = dropped
+        self.truncated = truncated
+
+    @property
+    def tokens_saved(self):
+        return self.tokens_before - self.tokens
+
+    def to_dict(self):
+        return {
+            "chunks_retrieved": len(self.docs) + self.merged + self.duplicates + self.dropped,
+            "chunks": len(self.docs),
+            "merged": self.merged,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped,
+            "truncated": self.truncated,
+            "tokens_before": self.tokens_before,
+            "tokens": self.tokens,
+            "tokens_saved": self.tokens_saved,
+        }
+
+    def report(self, timings):
+        # Adds the packing outcome to a request's timings and to the /metrics token counters
+        for name in ("tokens_before", "tokens", "tokens_saved"):
+            timings.count(f"context_{name}", getattr(self, name))
+        metrics.observe(context_tokens, self.tokens, operation=timings.operation)
+        metrics.inc(context_tokens_saved, self.tokens_saved, operation=timings.operation)
+
+
+def _position_key(metadata):
+    # Chunks can only be neighbours within one record of one source in one collection
+    return tuple(metadata.get(key) for key in ("collection", "source", "page", "row", "note"))
+
+
+def _overlap(first, second):
+    # Length of the longest suffix of first that is a prefix of second, or 0
+    if len(second) < MIN_OVERLAP_CHARS:
+        return 0
+    probe = second[:MIN_OVERLAP_CHARS]
+    position = first.find(probe, max(len(first) - MAX_OVERLAP_CHARS, 0))
+    while position != -1:
+        if second.startswith(first[position:]):
+            return len(first) - position
+        position = first.find(probe, position + 1)
+    return 0
+
+
+def _merge_adjacent(docs):
+    # Joins chunks of the same record whose ends overlap, as consecutive splitter chunks do.
+    # The merged chunk keeps the rank of its most relevant part.
+    merged = 0
+    docs = list(docs)
+    changed = True
+    while changed:
+        changed = False
+        for i, first in enumerate(docs):
+            for j, second in enumerate(docs):
+                if i == j or _position_key(first.metadata) != _position_key(second.metadata):
+                    continue
+                overlap = _overlap(first.page_content, second.page_content)
+                if not overlap:
+                    continue
+                combined = Document(page_content=first.page_content + second.page_content[overlap:],
+                                    metadata=docs[min(i, j)].metadata)
+                docs[min(i, j)] = combined
+                del docs[max(i, j)]
+                merged += 1
+                changed = True
+                break
+            if changed:
+                break
+    return docs, merged
+
+
+def _shingles(text):
+    words = _WHITESPACE.sub(" ", text).strip().lower().split(" ")
+    if len(words) < SHINGLE_WORDS:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def _drop_duplicates(docs):
+    # Drops chunks contained in, or mostly made of the same word 5-grams as, a more relevant chunk
+    kept, kept_shingles, duplicates = [], [], 0
+    for doc in docs:
+        normalized = _WHITESPACE.sub(" ", doc.page_content).strip()
+        shingles = _shingles(normalized)
+        duplicate = False
+        for other, other_shingles in zip(kept, kept_shingles):
+            if normalized in _WHITESPACE.sub(" ", other.page_content):
+                duplicate = True
+            elif shingles and len(shingles & other_shingles) / len(shingles) >= context_duplicate_threshold:
+                duplicate = True
+            if duplicate:
+                break
+        if duplicate:
+            duplicates += 1
+            continue
+        kept.append(doc)
+        kept_shingles.append(shingles)
+    return kept, duplicates
+
+
+def _truncate(text, tokens):
+    # Cuts text to about tokens tokens at a word boundary
+    cut = text[:int(tokens * context_chars_per_token)]
+    space = cut.rfind(" ")
+    return cut[:space] if space > len(cut) // 2 else cut
+
+
+def pack_context(docs: List[Document], budget=None, count_tokens=estimate_tokens) -> PackedContext:
+    # docs are ordered by relevance, most relevant first, and so is the packed context
+    tokens_before = sum(count_tokens(doc.page_content) for doc in docs)
+    if not context_packing:
+        return PackedContext(list(docs), tokens_before, tokens_before)
+    budget = context_token_budget if budget is None else budget
+    candidates, merged = _merge_adjacent(docs)
+    candidates, duplicates = _drop_duplicates(candidates)
+    packed, used, dropped, truncated = [], 0, 0, 0
+    for doc in candidates:
+        tokens = count_tokens(doc.page_content)
+        if used + tokens <= budget:
+            packed.append(doc)
+            used += tokens
+        elif budget - used >= MIN_PARTIAL_TOKENS:
+            text = _truncate(doc.page_content, budget - used)
+            packed.append(Document(page_content=text, metadata=doc.metadata))
+            used += count_tokens(text)
+            truncated += 1
+        else:
+            dropped += 1
+    return PackedContext(packed, tokens_before, used, merged, duplicates, dropped, truncated)
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import List
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.embeddings.base import Embeddings
+
+load_dotenv()
+
+embedding_cache_dir = os.environ.get('EMBEDDING_CACHE_DIR', 'embedding_cache')
+# Maximum number of cached vectors per embeddings model, 0 disables the cache
+embedding_cache_max_entries = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 200000))
+
+INDEX_FILE = "index.sqlite"
+VECTORS_FILE = "vectors.f32"
+OWNERS_FILE = "owners.i64"
+
+
+def text_key(text):
+    digest = hashlib.sha256(text.encode("utf8")).digest()
+    # Non-zero 63-bit id doubles as the slot owner tag; 0 marks a slot being written
+    return digest.hex(), (int.from_bytes(digest[:8], "little") >> 1) or 1
+
+
+class EmbeddingCache:
+    # Disk-backed cache of embedding vectors for one model, keyed by chunk text hash.
+    # Vectors live in a fixed-capacity memory-mapped float32 matrix; a sqlite index maps
+    # text hashes to matrix rows and tracks last use for LRU eviction. A parallel owner
+    # array tags each row with the key stored in it, so a reader racing an eviction in
+    # another process sees a mismatch and treats the lookup as a miss.
+
+    def __init__(self, model_name, cache_dir=embedding_cache_dir, max_entries=embedding_cache_max_entries):
+        model_dir = hashlib.sha256(model_name.encode("utf8")).hexdigest()[:16]
+        self.directory = os.path.join(cache_dir, model_dir)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._vectors = None
+        self._owners = None
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "model.txt"), "w") as f:
+            f.write(model_name)
+        self._db = sqlite3.connect(os.path.join(self.directory, INDEX_FILE), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER UNIQUE, last_used REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self._db.commit()
+        self._open_if_created()
+
+    def _open_if_created(self):
+        # The files may have been created by another process since this one started
+        dim = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        if dim is not None:
+            self._open(dim[0])
+
+    def _open(self, dim):
+        # Capacity is fixed by the files on disk once created
+        capacity = self._db.execute("SELECT value FROM meta WHERE name = 'capacity'").fetchone()[0]
+        self._vectors = np.memmap(os.path.join(self.directory, VECTORS_FILE), dtype=np.float32, mode="r+", shape=(capacity, dim))
+        self._owners = np.memmap(os.path.join(self.directory, OWNERS_FILE), dtype=np.int64, mode="r+", shape=(capacity,))
+
+    def _create(self, dim):
+        capacity = self.max_entries
+        with self._db:
+            self._db.execute("INSERT OR IGNORE INTO meta VALUES ('dim', ?)", (dim,))
+            self._db.execute("INSERT OR IGNORE INTO meta VALUES ('capacity', ?)", (capacity,))
+        vectors_path = os.path.join(self.directory, VECTORS_FILE)
+        owners_path = os.path.join(self.directory, OWNERS_FILE)
+        if not os.path.exists(vectors_path):
+            np.memmap(vectors_path, dtype=np.float32, mode="w+", shape=(capacity, dim)).flush()
+            np.memmap(owners_path, dtype=np.int64, mode="w+", shape=(capacity,)).flush()
+        dim = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()[0]
+        self._open(dim)
+
+    def get_many(self, texts: List[str]):
+        # Returns a list aligned with texts, holding a vector or None for each
+        results = [None] * len(texts)
+        if self._vectors is None:
+            self._open_if_created()
+        if self._vectors is None:
+            self.misses += len(texts)
+            return results
+        keys = [text_key(text) for text in texts]
+        found = []
+        with self._lock:
+            for i, (key, owner) in enumerate(keys):
+                row = self._db.execute("SELECT slot FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    continue
+                vector = np.array(self._vectors[row[0]])
+                if self._owners[row[0]] != owner:
+                    continue
+                results[i] = vector.tolist()
+                found.append(key)
+            if found:
+                now = time.time()
+                with self._db:
+                    self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+        self.hits += len(found)
+        self.misses += len(texts) - len(found)
+        return results
+
+    def put_many(self, texts: List[str], vectors):
+        if not texts:
+            return
+        if self._vectors is None:
+            self._create(len(vectors[0]))
+        capacity = self._vectors.shape[0]
+        now = time.time()
+        with self._lock, self._db:
+            # BEGIN IMMEDIATE serialises writers across processes while readers carry on
+            self._db.execute("BEGIN IMMEDIATE")
+            # Rows are only freed by eviction, which reuses them at once, so used rows stay dense and
+            # the next free row is the number of rows used. It is kept in meta; caches from before
+            # that count their entries once.
+            used = self._db.execute("SELECT value FROM meta WHERE name = 'rows'").fetchone()
+            used = used[0] if used is not None else self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            for text, vector in zip(texts, vectors):
+                key, owner = text_key(text)
+                if self._db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone():
+                    continue
+                if used < capacity:
+                    slot = used
+                    used += 1
+                else:
+                    slot, old_key = self._db.execute(
+                        "SELECT slot, key FROM entries ORDER BY last_used LIMIT 1").fetchone()
+                    self._db.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                    self.evictions += 1
+                self._owners[slot] = 0
+                self._vectors[slot] = vector
+                self._owners[slot] = owner
+                self._db.execute("INSERT INTO entries VALUES (?, ?, ?)", (key, slot, now))
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('rows', ?)", (used,))
+            self._vectors.flush()
+            self._owners.flush()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            size = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {
+            "entries": size,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    # Wraps an embeddings model so chunks already embedded once, in any collection, are not recomputed
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.cache.get_many(texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Identical chunks within one batch are embedded once
+            unique_texts = list(dict.fromkeys(texts[i] for i in missing))
+            computed = dict(zip(unique_texts, self.embeddings.embed_documents(unique_texts)))
+            self.cache.put_many(unique_texts, [computed[text] for text in unique_texts])
+            for i in missing:
+                vectors[i] = computed[texts[i]]
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        # Queries are rarely repeated word for word and would only push chunks out of the cache
+        return self.embeddings.embed_query(text)
+
+
+def uncached(embeddings: Embeddings) -> Embeddings:
+    # The model behind a cache, for texts that shouldn't be stored such as queries
+    return embeddings.embeddings if isinstance(embeddings, CachedEmbeddings) else embeddings
+
+
+def with_cache(embeddings: Embeddings, model_name: str) -> Embeddings:
+    if embedding_cache_max_entries <= 0:
+        return embeddings
+    return CachedEmbeddings(embeddings, EmbeddingCache(model_name))
@@ -0,0 +1,170 @@
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import Iterator
+
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+
+from manifest import file_hash
+
+load_dotenv()
+
+extraction_cache_dir = os.environ.get('EXTRACTION_CACHE_DIR', 'extraction_cache')
+# Size limit of the cache, enforced after each ingest by removing least recently used entries; 0 disables the cache
+extraction_cache_max_mb = float(os.environ.get('EXTRACTION_CACHE_MAX_MB', 2048))
+
+# Bump when the entry format or the text a loader produces changes, so old entries stop matching
+CACHE_FORMAT = 1
+ENTRY_SUFFIX = ".jsonl.gz"
+
+
+def loader_key(loader_class, loader_args):
+    return json.dumps([CACHE_FORMAT, f"{loader_class.__module__}.{loader_class.__name__}", loader_args], sort_keys=True)
+
+
+def entry_key(content_hash, loader_class, loader_args):
+    return hashlib.sha256(f"{content_hash}:{loader_key(loader_class, loader_args)}".encode("utf8")).hexdigest()
+
+
+class ExtractionCache:
+    # Text and metadata extracted from source files, keyed by file content hash and loader, so
+    # re-chunking or re-embedding a corpus doesn't parse PDFs and Office files again.
+    # Each entry is a gzip-compressed JSON-lines file of documents under <cache_dir>/<key[:2]>/;
+    # its mtime is refreshed on every hit and drives least-recently-used pruning.
+    # A document's source is stored only when it isn't the file itself, so an identical file
+    # under another path reuses the entry.
+
+    def __init__(self, cache_dir=extraction_cache_dir, max_mb=extraction_cache_max_mb):
+        self.directory = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ENTRY_SUFFIX)
+
+    def load(self, file_path, loader_class, loader_args, extract, content_hash=None) -> Iterator[Document]:
+        # Yields the file's documents from the cache, or from extract() while writing a new entry.
+        # content_hash is the hash the manifest already computed for the file, if any.
+        key = entry_key(content_hash or file_hash(file_path), loader_class, loader_args)
+        path = self._path(key)
+        try:
+            f = gzip.open(path, "rt", encoding="utf8")
+        except FileNotFoundError:
+            f = None
+        if f is None:
+            yield from self._write(path, file_path, extract())
+            return
+        os.utime(path)
+        with f:
+            for line in f:
+                record = json.loads(line)
+                metadata = record["metadata"]
+                metadata.setdefault("source", file_path)
+                yield Document(page_content=record["page_content"], metadata=metadata)
+
+    @staticmethod
+    def _write(path, file_path, documents):
+        # The entry is only published once the loader has finished, so a failed or abandoned
+        # extraction never leaves a partial entry behind
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        complete = False
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf8", compresslevel=6) as f:
+                for document in documents:
+                    metadata = {k: v for k, v in document.metadata.items() if not (k == "source" and v == file_path)}
+                    f.write(json.dumps({"page_content": document.page_content, "metadata": metadata}) + "\n")
+                    yield document
+            os.replace(tmp_path, path)
+            complete = True
+        finally:
+            if not complete and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def entries(self):
+        # (path, size, last used) of every entry, least recently used first
+        result = []
+        for path in glob.glob(os.path.join(self.directory, "*", "*" + ENTRY_SUFFIX)):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            result.append((path, stat.st_size, stat.st_mtime))
+        return sorted(result, key=lambda entry: entry[2])
+
+    def prune(self, max_bytes=None, max_age_seconds=None, keep_keys=None):
+        # Removes entries older than max_age_seconds, entries not in keep_keys (when given), then
+        # the least recently used ones until the cache fits in max_bytes. Returns (entries, bytes) removed.
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        now = time.time()
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed, removed_bytes = 0, 0
+        for path, size, last_used in entries:
+            key = os.path.basename(path)[:-len(ENTRY_SUFFIX)]
+            stale = ((max_age_seconds is not None and now - last_used > max_age_seconds)
+                     or (keep_keys is not None and key not in keep_keys)
+                     or total > max_bytes)
+            if not stale:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            removed += 1
+            removed_bytes += size
+        return removed, removed_bytes
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            "entries": len(entries),
+            "size_mb": sum(size for _, size, _ in entries) / 1e6,
+            "max_mb": self.max_bytes / 1024 / 1024,
+        }
+
+
+extraction_cache = ExtractionCache()
+
+
+def current_keys(source_dir):
+    # Keys of the entries the files under source_dir would use today
+    from ingest import EXTRACTION_CACHED, LOADER_MAPPING, find_documents
+
+    keys = set()
+    for file_path in find_documents(source_dir):
+        ext = os.path.splitext(file_path)[1]
+        if ext in EXTRACTION_CACHED:
+            loader_class, loader_args = LOADER_MAPPING[ext]
+            keys.add(entry_key(file_hash(file_path), loader_class, loader_args))
+    return keys
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or prune the extracted text cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Print the number of entries and the cache size")
+    prune_parser = subparsers.add_parser("prune", help="Remove stale entries")
+    prune_parser.add_argument("--max-age-days", type=float, help="Remove entries not used for this many days")
+    prune_parser.add_argument("--max-size-mb", type=float, help="Shrink the cache to this size (default EXTRACTION_CACHE_MAX_MB)")
+    prune_parser.add_argument("--source-dir", help="Remove entries that no file under this directory uses any more")
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print(json.dumps(extraction_cache.stats(), indent=2))
+    else:
+        max_bytes = None if args.max_size_mb is None else int(args.max_size_mb * 1024 * 1024)
+        max_age_seconds = None if args.max_age_days is None else args.max_age_days * 86400
+        keep_keys = None if args.source_dir is None else current_keys(args.source_dir)
+        removed, removed_bytes = extraction_cache.prune(max_bytes, max_age_seconds, keep_keys)
+        print(f"Removed {removed} entries ({removed_bytes / 1e6:.1f} MB)")
@@ -1,13 +1,19 @@
 import os
+import cProfile
 import glob
-from typing import List
+import itertools
+import pstats
+import resource
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+from typing import Dict, Iterator, List
 from dotenv import load_dotenv
 import argparse
 
 from langchain.document_loaders import (
-    CSVLoader,
-    EverNoteLoader,
-    PDFMinerLoader,
     TextLoader,
     UnstructuredEmailLoader,
     UnstructuredEPubLoader,
@@ -19,10 +25,18 @@ from langchain.document_loaders import (
 )
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Chroma
 from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.docstore.document import Document
-from constants import CHROMA_SETTINGS
+from loaders import PagedPDFMinerLoader, StreamingCSVLoader, StreamingEverNoteLoader, lazy_load
+from manifest import Manifest
+from lexical_index import BM25Index
+from vector_store import (backend_for, open_store, stored_dtype, chroma_has_collection, chroma_write, convert_store,
+                          MmapVectorStore, DTYPES, vector_store_rescore, quantization_report)
+from retrieval import store_lock
+from collection_admin import write_summary
+from embedding_cache import with_cache
+from extraction_cache import extraction_cache
+from metrics import metrics, stage_seconds, ingest_items
 
 
 load_dotenv()
@@ -30,71 +44,532 @@ load_dotenv()
 
 # Map file extensions to document loaders and their arguments
 LOADER_MAPPING = {
-    ".csv": (CSVLoader, {}),
+    ".csv": (StreamingCSVLoader, {}),
     # ".docx": (Docx2txtLoader, {}),
     ".docx": (UnstructuredWordDocumentLoader, {}),
-    ".enex": (EverNoteLoader, {}),
+    ".enex": (StreamingEverNoteLoader, {}),
     ".eml": (UnstructuredEmailLoader, {}),
     ".epub": (UnstructuredEPubLoader, {}),
     ".html": (UnstructuredHTMLLoader, {}),
     ".md": (UnstructuredMarkdownLoader, {}),
     ".odt": (UnstructuredODTLoader, {}),
-    ".pdf": (PDFMinerLoader, {}),
+    ".pdf": (PagedPDFMinerLoader, {}),
     ".pptx": (UnstructuredPowerPointLoader, {}),
     ".txt": (TextLoader, {"encoding": "utf8"}),
     # Add more mappings for other file extensions and loaders as needed
 }
 
+# Extensions whose records are cheap to parse but may be numerous; with --workers these are still
+# streamed in this process rather than sent back from a worker as one list
+STREAM_IN_PROCESS = {".csv"}
+# Extensions whose extracted text is kept in the extraction cache; plain text and CSV are
+# quicker to parse again than to decompress
+EXTRACTION_CACHED = {".docx", ".enex", ".eml", ".epub", ".html", ".md", ".odt", ".pdf", ".pptx"}
+
 
 load_dotenv()
 
+# Number of processes used to parse documents, overridden by --workers
+ingest_workers = int(os.environ.get('INGEST_WORKERS', 1))
+# Number of chunks embedded and added to the store at a time, overridden by --batch-size
+ingest_batch_size = int(os.environ.get('INGEST_BATCH_SIZE', 128))
+# Text splitting, overridden by --chunk-size and --chunk-overlap
+chunk_size_default = int(os.environ.get('CHUNK_SIZE', 500))
+chunk_overlap_default = int(os.environ.get('CHUNK_OVERLAP', 50))
+
 
-def load_single_document(file_path: str) -> Document:
+def load_single_document(file_path: str, content_hash: str = None) -> Iterator[Document]:
+    # Yields every record of the file (CSV row, PDF page, note...) as the loader produces it;
+    # content_hash, when already known, saves the extraction cache hashing the file again
     ext = "." + file_path.rsplit(".", 1)[-1]
     if ext in LOADER_MAPPING:
         loader_class, loader_args = LOADER_MAPPING[ext]
         loader = loader_class(file_path, **loader_args)
-        return loader.load()[0]
+        if ext in EXTRACTION_CACHED and extraction_cache.enabled:
+            yield from extraction_cache.load(file_path, loader_class, loader_args, lambda: lazy_load(loader),
+                                             content_hash)
+        else:
+            yield from lazy_load(loader)
+        return
 
     raise ValueError(f"Unsupported file extension '{ext}'")
 
 
-def load_documents(source_dir: str) -> List[Document]:
-    # Loads all documents from source documents directory
+def find_documents(source_dir: str) -> List[str]:
     all_files = []
     for ext in LOADER_MAPPING:
         all_files.extend(
             glob.glob(os.path.join(source_dir, f"**/*{ext}"), recursive=True)
         )
-    return [load_single_document(file_path) for file_path in all_files]
+    return all_files
+
+
+class LoadStats:
+    # Throughput of the loading stage, printed at the end of a run
+    def __init__(self):
+        self.found = 0
+        self.files = 0
+        self.documents = 0
+        self.bytes = 0
+        self.failures = []
+        self.started = time.monotonic()
+        self.finished = None
+
+    def summary(self):
+        elapsed = max((self.finished or time.monotonic()) - self.started, 1e-9)
+        return (f"Loaded {self.files} files ({self.bytes / 1e6:.1f} MB, {self.documents} records) in {elapsed:.1f}s: "
+                f"{self.files / elapsed:.2f} files/s, {self.bytes / 1e6 / elapsed:.2f} MB/s, "
+                f"{len(self.failures)} failed")
+
+
+def _load_one(file_path: str, content_hash: str = None):
+    # Runs in the worker process; failures are returned so one bad file doesn't abort the batch
+    try:
+        return file_path, list(load_single_document(file_path, content_hash)), None
+    except Exception as e:
+        return file_path, None, f"{type(e).__name__}: {e}"
+
+
+def _load_lazy(file_path: str, content_hash: str = None):
+    # Same shape as _load_one, but documents are produced as the caller iterates
+    return file_path, load_single_document(file_path, content_hash), None
+
+
+def load_documents(source_dir: str, workers: int = 1, stats: LoadStats = None, files: List[str] = None,
+                   hashes: Dict[str, str] = None) -> Iterator[Document]:
+    # Loads all documents from source documents directory (or just the given files), yielding them as they complete.
+    # hashes maps file paths to the content hashes already computed for them.
+    all_files = find_documents(source_dir) if files is None else files
+    stats = stats or LoadStats()
+    stats.found = len(all_files)
+    hashes = hashes or {}
+
+    if workers <= 1:
+        yield from _collect((_load_lazy(file_path, hashes.get(file_path)) for file_path in all_files), stats)
+    else:
+        pooled = [file_path for file_path in all_files if os.path.splitext(file_path)[1] not in STREAM_IN_PROCESS]
+        streamed = [file_path for file_path in all_files if os.path.splitext(file_path)[1] in STREAM_IN_PROCESS]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from _collect(_load_parallel(executor, pooled, workers * 4, hashes), stats)
+        yield from _collect((_load_lazy(file_path, hashes.get(file_path)) for file_path in streamed), stats)
+    stats.finished = time.monotonic()
+
+
+def _load_parallel(executor, all_files, max_in_flight, hashes):
+    # Keep a bounded number of files in flight so results don't pile up unconsumed
+    files = iter(all_files)
+    pending = set()
+    for file_path in itertools.islice(files, max_in_flight):
+        pending.add(executor.submit(_load_one, file_path, hashes.get(file_path)))
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+            for file_path in itertools.islice(files, 1):
+                pending.add(executor.submit(_load_one, file_path, hashes.get(file_path)))
+
+
+def _collect(results, stats: LoadStats):
+    # Documents of one file are yielded contiguously. A file that fails part way has its
+    # earlier records yielded already; run_ingest removes their chunks again.
+    for file_path, documents, error in results:
+        if error is None:
+            try:
+                for document in documents:
+                    stats.documents += 1
+                    yield document
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+        if error is not None:
+            print(f"Failed to load {file_path}: {error}")
+            stats.failures.append((file_path, error))
+            continue
+        stats.files += 1
+        stats.bytes += os.path.getsize(file_path)
+
+
+class IngestCancelled(Exception):
+    pass
+
+
+class IngestProgress:
+    # Counters updated while an ingestion runs, read by the job queue for status reports
+    def __init__(self):
+        self.files_found = 0
+        self.files_loaded = 0
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.chunks_persisted = 0
+        self.pipeline_stats = None
+        self.cancel_event = threading.Event()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise IngestCancelled()
+
+    def to_dict(self):
+        return {
+            "files_found": self.files_found,
+            "files_loaded": self.files_loaded,
+            "chunks_total": self.chunks_total,
+            "chunks_embedded": self.chunks_embedded,
+            "chunks_persisted": self.chunks_persisted,
+        }
+
+
+class PipelineStats:
+    # Time and item counts per ingest stage, plus the process's peak memory
+    STAGES = ("load", "split", "embed", "persist", "index")
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(self.STAGES, 0.0)
+        self.items = dict.fromkeys(self.STAGES, 0)
+
+    def add(self, stage, seconds, items=0):
+        self.seconds[stage] += seconds
+        self.items[stage] += items
+
+    def timed(self, stage, iterable):
+        # Attributes the time spent waiting on each item of a lazy stage to that stage
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start)
+                return
+            self.add(stage, time.perf_counter() - start, 1)
+            yield item
+
+    @staticmethod
+    def peak_rss_mb():
+        # ru_maxrss is reported in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def export(self):
+        # Adds this run to the process's /metrics histograms and counters
+        for stage in self.STAGES:
+            metrics.observe(stage_seconds, self.seconds[stage], operation="ingest", stage=stage)
+        metrics.inc(ingest_items, self.items["load"], kind="documents")
+        metrics.inc(ingest_items, self.items["persist"], kind="chunks")
+
+    def summary(self):
+        lines = []
+        for stage in self.STAGES:
+            seconds, items = self.seconds[stage], self.items[stage]
+            rate = items / seconds if seconds > 0 else 0.0
+            lines.append(f"  {stage:<8} {items:>8} items in {seconds:8.2f}s ({rate:.1f}/s)")
+        lines.append(f"  peak RSS {self.peak_rss_mb():.0f} MB")
+        return "\n".join(lines)
+
 
+class _FileTracker:
+    # Marks a file finished in the manifest once every chunk it produced is persisted.
+    # Documents of one file arrive contiguously, so a new source means the previous one is fully split.
 
-def main(collection, project_name):
-    # Load environment variables
-    source_directory = "source_documents/" + project_name
+    def __init__(self, manifest: Manifest):
+        self.manifest = manifest
+        self.current = None
+        self.pending = {}
+        self.split_done = set()
+
+    def chunks_split(self, source, count):
+        if source != self.current:
+            self.end_current()
+            self.current = source
+        self.pending[source] = self.pending.get(source, 0) + count
+
+    def end_current(self):
+        if self.current is not None:
+            self.split_done.add(self.current)
+            self._maybe_finish(self.current)
+            self.current = None
+
+    def chunks_persisted(self, sources):
+        for source in sources:
+            self.pending[source] -= 1
+        for source in set(sources):
+            self._maybe_finish(source)
+
+    def _maybe_finish(self, source):
+        if source in self.split_done and self.pending.get(source, 0) == 0:
+            self.split_done.discard(source)
+            self.pending.pop(source, None)
+            if source in self.manifest.files:
+                self.manifest.finish_file(source)
+
+
+def split_chunks(documents: Iterator[Document], text_splitter, stats: PipelineStats,
+                 progress: IngestProgress, tracker: _FileTracker) -> Iterator[Document]:
+    for document in documents:
+        if document.metadata["source"] != tracker.current:
+            progress.files_loaded += 1
+        start = time.perf_counter()
+        chunks = text_splitter.split_documents([document])
+        stats.add("split", time.perf_counter() - start, len(chunks))
+        progress.chunks_total += len(chunks)
+        tracker.chunks_split(document.metadata["source"], len(chunks))
+        yield from chunks
+    tracker.end_current()
+
+
+def renamed(documents: Iterator[Document], names) -> Iterator[Document]:
+    # Gives documents the source name their file is recorded under, instead of the path it was read from
+    for document in documents:
+        source = document.metadata.get("source")
+        document.metadata["source"] = names.get(source, source)
+        yield document
+
+
+def batched(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def add_batch(db, embeddings, batch: List[Document], stats: PipelineStats, progress: IngestProgress) -> List[str]:
+    contents = [doc.page_content for doc in batch]
+    start = time.perf_counter()
+    vectors = embeddings.embed_documents(contents)
+    stats.add("embed", time.perf_counter() - start, len(batch))
+    progress.chunks_embedded += len(batch)
+    progress.check_cancelled()
+    ids = [str(uuid.uuid1()) for _ in batch]
+    start = time.perf_counter()
+    with store_lock(db):
+        db._collection.add(
+            ids=ids,
+            embeddings=vectors,
+            metadatas=[doc.metadata for doc in batch],
+            documents=contents,
+        )
+    stats.add("persist", time.perf_counter() - start, len(batch))
+    progress.chunks_persisted += len(batch)
+    return ids
+
+
+def delete_chunks(db, chunk_ids: List[str]):
+    if chunk_ids:
+        with store_lock(db):
+            db._collection.delete(ids=chunk_ids)
+
+
+def report_quantization(db, k=10, queries=100):
+    # Memory saved by a quantized store and, when it kept its float32 vectors, its recall@k against them
+    if not isinstance(db, MmapVectorStore) or db._collection.dtype_name == "float32":
+        return
+    collection = db._collection
+    memory = collection.memory()
+    line = (f"Vectors stored as {memory['dtype']}: {memory['search_bytes'] / 1e6:.1f} MB searched instead of "
+            f"{memory['float32_bytes'] / 1e6:.1f} MB ({memory['saved_bytes'] / 1e6:.1f} MB saved)")
+    if collection.rescore and collection.count() > k:
+        report = quantization_report(collection.full_vectors, dtypes=(memory["dtype"],), k=k, queries=queries)
+        result = report["dtypes"][memory["dtype"]]
+        line += (f", recall@{k} {result['recall']:.3f}, {result['recall_rescored']:.3f} after re-scoring "
+                 f"{report['rescore_candidates']} candidates")
+    print(line)
+
+
+def run_ingest(collection, project_name, embeddings=None, progress=None, workers=None,
+               full_rebuild=False, delete_missing=True, batch_size=None, chunk_size=None, chunk_overlap=None,
+               files=None, quantize=None, rescore=vector_store_rescore):
+    # files limits the run to those paths instead of everything under the project's source directory;
+    # a mapping from source names to paths records the files under those names instead.
+    # quantize stores the collection's vectors as float32, float16 or int8 in an mmap store; an
+    # existing collection stored differently has its vectors converted.
+    # Chroma collections share one database with every process, so a run holds its write lock throughout.
+    chroma = backend_for(collection, os.environ.get('PERSIST_DIRECTORY') + "/" + collection) == "chroma"
+    with chroma_write() if chroma else nullcontext():
+        return _run_ingest(collection, project_name, embeddings, progress, workers, full_rebuild, delete_missing,
+                           batch_size, chunk_size, chunk_overlap, files, quantize, rescore)
+
+
+def _run_ingest(collection, project_name, embeddings, progress, workers, full_rebuild, delete_missing,
+                batch_size, chunk_size, chunk_overlap, files, quantize, rescore):
+    # Load environment variables
+    source_directory = "source_documents/" + (project_name or "")
     persist_directory = os.environ.get('PERSIST_DIRECTORY') + "/" + collection
+    progress = progress or IngestProgress()
 
     os.makedirs(persist_directory, exist_ok=True)
 
     embeddings_model_name = os.environ.get('EMBEDDINGS_MODEL_NAME')
     os.makedirs(source_directory, exist_ok=True)
-    # Load documents and split in chunks
-    print(f"Loading documents from {source_directory}")
-    chunk_size = 500
-    chunk_overlap = 50
-    documents = load_documents(source_directory)
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    texts = text_splitter.split_documents(documents)
-    print(f"Loaded {len(documents)} documents from {source_directory}")
-    print(f"Split into {len(texts)} chunks of text (max. {chunk_size} characters each)")
-
-    # Create embeddings
-    embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
-    
-    # Create and store locally vectorstore
-    db = Chroma.from_documents(texts, embeddings, collection_name=collection, persist_directory=persist_directory, client_settings=CHROMA_SETTINGS)
-    db.persist()
-    db = None
+
+    # Create embeddings, unless the caller already holds a loaded model
+    if embeddings is None:
+        embeddings = with_cache(HuggingFaceEmbeddings(model_name=embeddings_model_name), embeddings_model_name)
+
+    # A rebuilt collection keeps its backend even though its store is deleted first
+    backend = backend_for(collection, persist_directory)
+    previous_dtype = stored_dtype(collection, persist_directory)
+    requantize = quantize is not None and quantize != previous_dtype
+    manifest = Manifest(persist_directory)
+    # Chunks split differently can't be mixed in one collection, so new settings for an existing
+    # collection require an explicit full rebuild; otherwise it keeps the settings it was built with.
+    # Manifests from before settings were recorded used the fixed 500/50 split.
+    previous_settings = manifest.settings or {"chunk_size": 500, "chunk_overlap": 50}
+    if not manifest.files:
+        previous_settings = {"chunk_size": chunk_size_default, "chunk_overlap": chunk_overlap_default}
+    chunk_size = chunk_size or previous_settings["chunk_size"]
+    chunk_overlap = previous_settings["chunk_overlap"] if chunk_overlap is None else chunk_overlap
+    settings = {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+    if manifest.files and previous_settings != settings and not full_rebuild:
+        raise ValueError(f"Collection {collection} is split with {previous_settings}; changing it to {settings} "
+                         f"re-embeds every file, which needs --full-rebuild")
+    # Sources no longer on disk, such as uploads whose staged files were removed after ingestion, can't
+    # be loaded again, so a rebuild keeps their chunks. Files outside the project's source directory that
+    # are still on disk are loaded again with the project's files.
+    prefix = os.path.join(source_directory, "")
+    gone = [path for path in manifest.files if not path.startswith(prefix) and not os.path.exists(path)]
+    elsewhere = [path for path in manifest.files if not path.startswith(prefix) and os.path.exists(path)]
+    if requantize and backend != "mmap" and not chroma_has_collection(collection):
+        # Nothing is stored yet, so the quantized store is created straight away
+        backend, requantize = "mmap", False
+    db = open_store(collection, persist_directory, embeddings, backend, dtype=quantize, rescore=rescore)
+    if requantize and not (full_rebuild and not gone):
+        # Only mmap stores hold quantized vectors. Stored vectors are converted as they are, so
+        # nothing is embedded again; a collection without chunks is just created again.
+        if db._collection.count():
+            print(f"Converting the vectors of {collection} from {previous_dtype} to {quantize}")
+            if isinstance(db, MmapVectorStore):
+                db._collection.close()
+            convert_store(collection, persist_directory, quantize, rescore)
+        else:
+            db.delete_collection()
+        backend = "mmap"
+        db = open_store(collection, persist_directory, embeddings, backend, dtype=quantize, rescore=rescore)
+    elif requantize:
+        backend = "mmap" if quantize != "float32" else backend
+    index = BM25Index(persist_directory)
+    if full_rebuild and gone:
+        print(f"Rebuilding collection {collection}, keeping the chunks of {len(gone)} files no longer on disk "
+              f"(split with {previous_settings})")
+        if not index.exists:
+            index.build_from_store(db._collection)
+    elif full_rebuild:
+        print(f"Rebuilding collection {collection} from scratch")
+        db.delete_collection()
+        db = open_store(collection, persist_directory, embeddings, backend, dtype=quantize, rescore=rescore)
+        manifest.clear()
+        index.clear()
+    elif manifest.files and not index.exists:
+        # Collections ingested before BM25 indexes existed are indexed from their stored chunks once
+        print(f"Building the BM25 index of {collection} from {index.build_from_store(db._collection)} stored chunks")
+    manifest.settings = settings
+
+    def forget_chunks(chunk_ids):
+        delete_chunks(db, chunk_ids)
+        index.delete(chunk_ids)
+
+    try:
+        # Only new or changed files are loaded; removed files have their chunks deleted
+        if isinstance(files, dict):
+            manifest.locations.update(files)
+        all_files = find_documents(source_directory) if files is None else list(files)
+        if full_rebuild:
+            all_files += [path for path in elsewhere if path not in set(all_files)]
+            changed_files = list(all_files)
+        else:
+            changed_files = [file_path for file_path in all_files if not manifest.is_unchanged(file_path)]
+        print(f"Found {len(all_files)} files in {source_directory if files is None else 'the upload'}, "
+              f"{len(all_files) - len(changed_files)} unchanged")
+        if delete_missing and files is None:
+            for file_path in manifest.removed_files(source_directory, all_files):
+                print(f"Removing chunks of deleted file {file_path}")
+                forget_chunks(manifest.forget(file_path))
+        for file_path in changed_files:
+            forget_chunks(manifest.start_file(file_path))
+        progress.files_found = len(changed_files)
+
+        # Stream documents through loading, splitting, embedding and persisting so that
+        # only one batch of chunks (plus the files being parsed) is held in memory
+        print(f"Loading documents from {source_directory}")
+        workers = workers or ingest_workers
+        batch_size = batch_size or ingest_batch_size
+        load_stats = LoadStats()
+        stats = PipelineStats()
+        tracker = _FileTracker(manifest)
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        names = {manifest.location(file_path): file_path for file_path in changed_files}
+        # Files the extraction cache serves are looked up by the hash the manifest records, computed once
+        hashes = {}
+        if extraction_cache.enabled:
+            hashes = {location: manifest.content_hash(file_path) for location, file_path in names.items()
+                      if os.path.splitext(location)[1] in EXTRACTION_CACHED}
+        documents = stats.timed("load", load_documents(source_directory, workers=workers, stats=load_stats,
+                                                       files=list(names), hashes=hashes))
+        if manifest.locations:
+            documents = renamed(documents, names)
+        for batch in batched(split_chunks(documents, text_splitter, stats, progress, tracker), batch_size):
+            progress.check_cancelled()
+            ids = add_batch(db, embeddings, batch, stats, progress)
+            start = time.perf_counter()
+            index.add(ids, [doc.page_content for doc in batch])
+            stats.add("index", time.perf_counter() - start, len(batch))
+            for doc, chunk_id in zip(batch, ids):
+                manifest.add_chunk_ids(doc.metadata["source"], [chunk_id])
+            tracker.chunks_persisted([doc.metadata["source"] for doc in batch])
+        for file_path, _ in load_stats.failures:
+            forget_chunks(manifest.forget(names[file_path]))
+        for file_path in changed_files:
+            # Files that loaded without a single record or chunk never reach the tracker; they are
+            # recorded with no chunks so the next run counts them as unchanged
+            entry = manifest.files.get(file_path)
+            if entry is not None and entry["hash"] is None:
+                manifest.finish_file(file_path)
+        print(load_stats.summary())
+        print(f"Split into {progress.chunks_total} chunks of text (max. {chunk_size} characters each), "
+              f"embedded in batches of {batch_size}")
+        print(stats.summary())
+        removed, removed_bytes = extraction_cache.prune()
+        if removed:
+            print(f"Pruned {removed} extraction cache entries ({removed_bytes / 1e6:.1f} MB) to stay under the size limit")
+        stats.export()
+        progress.pipeline_stats = stats
+        report_quantization(db)
+    finally:
+        # Chunks already added before a cancellation are kept; their files stay marked as unfinished.
+        # Chroma collections are persisted by chroma_write.
+        if isinstance(db, MmapVectorStore):
+            db.persist()
+        index.save()
+        manifest.save()
+        db = None
+        write_summary(collection, persist_directory)
+    return progress
+
+
+def write_profile(path, progress, profiler, elapsed):
+    # Per-stage report followed by the functions with the most cumulative time
+    with open(path, "w") as f:
+        f.write(f"Ingest profile: {elapsed:.2f}s wall time\n")
+        f.write(f"{progress.files_loaded} files, {progress.chunks_persisted} chunks\n\n")
+        if progress.pipeline_stats is not None:
+            f.write("Stages:\n" + progress.pipeline_stats.summary() + "\n\n")
+        pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+    print(f"Profile written to {path}")
+
+
+def main(collection, project_name, workers=None, full_rebuild=False, batch_size=None, profile=None,
+         chunk_size=None, chunk_overlap=None, quantize=None, rescore=vector_store_rescore):
+    options = dict(workers=workers, full_rebuild=full_rebuild, batch_size=batch_size,
+                   chunk_size=chunk_size, chunk_overlap=chunk_overlap, quantize=quantize, rescore=rescore)
+    if profile is None:
+        run_ingest(collection, project_name, **options)
+        return
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        progress = run_ingest(collection, project_name, **options)
+    finally:
+        profiler.disable()
+    write_profile(profile, progress, profiler, time.perf_counter() - start)
 
 
 if __name__ == "__main__":
@@ -102,8 +577,21 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--collection", help="Saves the embedding in a collection name as specified")
     parser.add_argument("--project", help="Saves under this folder instead of the default source_documents")
+    parser.add_argument("--workers", type=int, default=ingest_workers, help="Number of processes used to parse documents (env INGEST_WORKERS)")
+    parser.add_argument("--batch-size", type=int, default=ingest_batch_size, help="Number of chunks embedded and persisted at a time (env INGEST_BATCH_SIZE)")
+    parser.add_argument("--chunk-size", type=int, help="Maximum characters per chunk (env CHUNK_SIZE for new collections)")
+    parser.add_argument("--chunk-overlap", type=int, help="Characters shared by consecutive chunks (env CHUNK_OVERLAP for new collections)")
+    parser.add_argument("--profile", metavar="PATH", help="Write a per-stage profile report to PATH")
+    parser.add_argument("--full-rebuild", action="store_true", help="Re-embed every file instead of only new or changed ones; needed to change --chunk-size or --chunk-overlap")
+    parser.add_argument("--quantize", choices=sorted(DTYPES), help="Store the collection's vectors as float16 or int8 in an mmap store (float32 for full precision); changing it converts the stored vectors")
+    parser.add_argument("--no-rescore", dest="rescore", action="store_false", default=vector_store_rescore, help="With --quantize, don't keep float32 vectors for re-scoring candidates (env VECTOR_STORE_RESCORE)")
 
     # Parse the command-line arguments
     args = parser.parse_args()
 
-    main(args.collection, args.project)
+    try:
+        main(args.collection, args.project, workers=args.workers, full_rebuild=args.full_rebuild, batch_size=args.batch_size,
+             profile=args.profile, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+             quantize=args.quantize, rescore=args.rescore)
+    except ValueError as e:
+        parser.exit(1, f"{e}\n")
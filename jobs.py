@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from ingest import run_ingest, IngestProgress, IngestCancelled
+from resources import registry
+from answer_cache import answer_cache
+
+# Number of ingestion jobs allowed to run at the same time
+ingest_job_workers = int(os.environ.get('INGEST_JOB_WORKERS', 1))
+# Finished jobs are forgotten after this many seconds
+ingest_job_retention_seconds = float(os.environ.get('INGEST_JOB_RETENTION_SECONDS', 3600))
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED)
+
+
+class IngestJob:
+    def __init__(self, collection, project_name, files, cleanup=None):
+        self.id = uuid.uuid4().hex
+        self.collection = collection
+        self.project_name = project_name
+        self.files = files
+        self.cleanup = cleanup
+        self.state = QUEUED
+        self.error = None
+        self.progress = IngestProgress()
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "collection_name": self.collection,
+            "project_name": self.project_name,
+            "files": list(self.files),
+            "state": self.state,
+            "error": self.error,
+            "progress": self.progress.to_dict(),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestJobQueue:
+    # Runs ingestion in-process on a small worker pool, reusing the registry's embedding model
+
+    def __init__(self, workers=ingest_job_workers, retention_seconds=ingest_job_retention_seconds):
+        self.retention_seconds = retention_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        # Jobs for the same collection run one at a time, since each rewrites the collection's manifest
+        self._collection_locks = {}
+
+    def submit(self, collection, project_name, files, cleanup=None):
+        job = IngestJob(collection, project_name, files, cleanup)
+        with self._lock:
+            self._forget_finished()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            self._forget_finished()
+            return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if job.state not in FINISHED_STATES:
+            # A queued job is dropped when a worker picks it up, a running one at the next batch
+            job.progress.cancel_event.set()
+        return job
+
+    def _run(self, job):
+        if job.progress.cancel_event.is_set():
+            job.state = CANCELLED
+            job.finished_at = time.time()
+            self._cleanup(job)
+            return
+        with self.collection_lock(job.collection):
+            self._run_locked(job)
+
+    def collection_lock(self, collection):
+        # Held while a job or an admin operation (delete by source, compaction) changes the collection
+        with self._lock:
+            return self._collection_locks.setdefault(collection, threading.Lock())
+
+    def _run_locked(self, job):
+        job.state = RUNNING
+        job.started_at = time.time()
+        try:
+            # Only the job's own uploaded files are ingested; they are removed afterwards, so their chunks
+            # must not be pruned on later runs
+            run_ingest(job.collection, job.project_name, embeddings=registry.embeddings(), progress=job.progress,
+                       delete_missing=False, files=job.files)
+            job.state = COMPLETED
+        except IngestCancelled:
+            job.state = CANCELLED
+        except Exception as e:
+            traceback.print_exc()
+            job.state = FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            # The pooled store for this collection no longer reflects what is on disk
+            registry.release(job.collection)
+            answer_cache.invalidate(job.collection)
+            self._cleanup(job)
+
+    def _cleanup(self, job):
+        if job.cleanup is None:
+            return
+        try:
+            job.cleanup()
+        except Exception as e:
+            print("exception during job cleanup", e)
+
+    def _forget_finished(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.state in FINISHED_STATES and now - job.finished_at > self.retention_seconds:
+                del self._jobs[job_id]
+
+
+job_queue = IngestJobQueue()
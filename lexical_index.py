@@ -0,0 +1,331 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+
+import numpy as np
+from dotenv import load_dotenv
+
+from retrieval import store_lock
+
+load_dotenv()
+
+persist_directory = os.environ.get('PERSIST_DIRECTORY')
+
+# BM25 term frequency saturation and document length normalisation
+bm25_k1 = float(os.environ.get('BM25_K1', 1.2))
+bm25_b = float(os.environ.get('BM25_B', 0.75))
+
+INDEX_DIR = "bm25"
+INDEX_FILE = "index.json"
+INDEX_FORMAT = 1
+# Chunks buffered in memory before they are written out as a segment
+SEGMENT_DOCS = 50000
+# Segments are merged into one when there are more than this many, or when this fraction of chunks is deleted
+MAX_SEGMENTS = 8
+MAX_DELETED_FRACTION = 0.2
+# Chunks read from the store at a time when indexing an existing collection
+BACKFILL_BATCH = 1000
+
+_WORD = re.compile(r"\w+")
+_COMPOUND = re.compile(r"\b\w+(?:[-.:/]\w+)+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have if in into is it its of on or so such that the their then "
+    "there these they this to was were will with".split())
+SEGMENT_FILES = ("terms", "offsets", "postings", "freqs", "lengths", "ids")
+
+
+def tokenize(text):
+    # Lower-cased words. Identifiers such as "ERR-1234", "os.path" or "v2.1" are indexed whole as well
+    # as by their parts, so an exact identifier outranks documents that merely contain its pieces.
+    text = text.lower()
+    return [word for word in _WORD.findall(text) if word not in STOPWORDS] + _COMPOUND.findall(text)
+
+
+def term_hash(term):
+    # Terms are stored as 64-bit hashes so the dictionary is a sorted array searchable in place
+    return int.from_bytes(hashlib.blake2b(term.encode("utf8"), digest_size=8).digest(), "little")
+
+
+def _load(path):
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # Empty arrays can't be memory-mapped
+        return np.load(path)
+
+
+class _Segment:
+    # One immutable, memory-mapped slice of the index: a sorted term-hash dictionary with offsets into
+    # the postings (chunk positions) and their term frequencies, plus each chunk's length and id
+    def __init__(self, directory, name, deleted):
+        self.name = name
+        for part in SEGMENT_FILES:
+            setattr(self, part, _load(os.path.join(directory, f"{name}.{part}.npy")))
+        self.live = None
+        if deleted:
+            self.live = np.ones(len(self.ids), dtype=bool)
+            self.live[deleted] = False
+
+    def keep(self):
+        return np.ones(len(self.ids), dtype=bool) if self.live is None else self.live
+
+    def ranges(self, hashes):
+        # Postings range of each term hash; empty where the segment lacks the term
+        if len(self.terms) == 0:
+            zeros = np.zeros(len(hashes), dtype=np.int64)
+            return zeros, zeros
+        positions = np.minimum(np.searchsorted(self.terms, hashes), len(self.terms) - 1)
+        found = self.terms[positions] == hashes
+        starts = np.where(found, self.offsets[positions], 0)
+        ends = np.where(found, self.offsets[positions + 1], 0)
+        return starts, ends
+
+
+class BM25Index:
+    # Per-collection BM25 inverted index stored next to the vector store in <collection>/bm25.
+    # Chunks added by an ingest run are written as a new segment; deleted chunks are masked until
+    # enough accumulate, then all segments are merged into one. index.json lists the segments and
+    # the deleted positions in each and is replaced atomically, so readers only see whole segments.
+
+    def __init__(self, collection_directory):
+        self.directory = os.path.join(collection_directory, INDEX_DIR)
+        self.path = os.path.join(self.directory, INDEX_FILE)
+        self._lock = threading.Lock()
+        self._pending = []  # (chunk id, term numbers) of chunks not yet written
+        self._vocabulary = {}  # term -> number, for the pending chunks
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        self.meta = {"format": INDEX_FORMAT, "segments": [], "deleted": {}}
+        self.mtime = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.meta = json.load(f)
+            self.mtime = os.stat(self.path).st_mtime
+        self.segments = [_Segment(self.directory, segment["name"], self.meta["deleted"].get(segment["name"]))
+                         for segment in self.meta["segments"]]
+        self._positions = None
+
+    @property
+    def exists(self):
+        return self.mtime is not None
+
+    def stale(self):
+        # True when another process or job saved the index since it was loaded
+        try:
+            return os.stat(self.path).st_mtime != self.mtime
+        except FileNotFoundError:
+            return self.mtime is not None
+
+    def total_docs(self):
+        return sum(segment["docs"] for segment in self.meta["segments"])
+
+    def deleted_docs(self):
+        return sum(len(positions) for positions in self.meta["deleted"].values())
+
+    def __len__(self):
+        return self.total_docs() - self.deleted_docs() + len(self._pending)
+
+    def add(self, ids, texts):
+        with self._lock:
+            vocabulary = self._vocabulary
+            for chunk_id, text in zip(ids, texts):
+                terms = [vocabulary.setdefault(term, len(vocabulary)) for term in tokenize(text)]
+                self._pending.append((chunk_id, np.array(terms, dtype=np.int32)))
+            self._dirty = True
+            if len(self._pending) >= SEGMENT_DOCS:
+                self._write_pending()
+
+    def delete(self, ids):
+        ids = set(ids)
+        if not ids:
+            return
+        with self._lock:
+            self._pending = [entry for entry in self._pending if entry[0] not in ids]
+            if self._positions is None:
+                self._positions = {
+                    segment.ids[position].decode(): (segment.name, int(position))
+                    for segment in self.segments for position in np.flatnonzero(segment.keep())
+                }
+            for chunk_id in ids:
+                located = self._positions.pop(chunk_id, None)
+                if located is not None:
+                    self.meta["deleted"].setdefault(located[0], []).append(located[1])
+            self._dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._pending = []
+            self._vocabulary = {}
+            self.meta["segments"] = []
+            self.meta["deleted"] = {}
+            self._positions = {}
+            self._dirty = True
+
+    def build_from_store(self, collection):
+        # Indexes every chunk already in a vector store collection (Chroma or mmap)
+        self.clear()
+        offset = 0
+        while True:
+            with store_lock(collection):
+                batch = collection.get(include=["documents"], limit=BACKFILL_BATCH, offset=offset)
+            if not batch["ids"]:
+                break
+            self.add(batch["ids"], batch["documents"])
+            offset += len(batch["ids"])
+        return offset
+
+    def save(self, compact=False):
+        # compact merges the segments and drops deleted chunks even below the usual thresholds
+        with self._lock:
+            if not self._dirty and self.exists and not compact:
+                return
+            if self._pending:
+                self._write_pending()
+            total = self.total_docs()
+            if compact or len(self.meta["segments"]) > MAX_SEGMENTS or (total and self.deleted_docs() > MAX_DELETED_FRACTION * total):
+                self._compact()
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.meta, f)
+            os.replace(tmp_path, self.path)
+            self._remove_unused()
+            self._dirty = False
+            self._load()
+
+    def _write_pending(self):
+        # (term, chunk) pairs are counted in one pass over every pending token
+        lengths = np.array([len(terms) for _, terms in self._pending], dtype=np.int64)
+        terms = np.concatenate([terms for _, terms in self._pending]).astype(np.int64)
+        docs = np.repeat(np.arange(len(self._pending), dtype=np.int64), lengths)
+        pairs, freqs = np.unique(terms * len(self._pending) + docs, return_counts=True)
+        term_hashes = np.array([term_hash(term) for term in self._vocabulary], dtype=np.uint64)
+        self._write_segment(
+            term_hashes[pairs // len(self._pending)], (pairs % len(self._pending)).astype(np.uint32),
+            np.minimum(freqs, np.iinfo(np.uint16).max).astype(np.uint16), lengths,
+            np.array([chunk_id.encode("utf8") for chunk_id, _ in self._pending]))
+        self._pending = []
+        self._vocabulary = {}
+
+    def _write_segment(self, hashes, docs, freqs, lengths, ids):
+        if len(ids) == 0:
+            return
+        order = np.lexsort((docs, hashes))
+        hashes, docs, freqs = hashes[order], docs[order], freqs[order]
+        terms, starts = np.unique(hashes, return_index=True)
+        arrays = {
+            "terms": terms.astype(np.uint64),
+            "offsets": np.append(starts, len(hashes)).astype(np.int64),
+            "postings": docs.astype(np.uint32),
+            "freqs": freqs.astype(np.uint16),
+            "lengths": lengths.astype(np.uint32),
+            "ids": ids,
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        name = uuid.uuid4().hex
+        for part, array in arrays.items():
+            np.save(os.path.join(self.directory, f"{name}.{part}.npy"), array)
+        self.meta["segments"].append({"name": name, "docs": len(ids), "tokens": int(lengths.sum())})
+
+    def _compact(self):
+        # Merges every segment into one without the deleted chunks
+        merged = {"hashes": [], "docs": [], "freqs": [], "lengths": [], "ids": []}
+        base = 0
+        for segment in (_Segment(self.directory, entry["name"], self.meta["deleted"].get(entry["name"]))
+                        for entry in self.meta["segments"]):
+            keep = segment.keep()
+            renumbered = np.cumsum(keep) - 1 + base
+            postings = np.asarray(segment.postings)
+            live = keep[postings]
+            merged["hashes"].append(np.repeat(np.asarray(segment.terms), np.diff(segment.offsets))[live])
+            merged["docs"].append(renumbered[postings[live]])
+            merged["freqs"].append(np.asarray(segment.freqs)[live])
+            merged["lengths"].append(np.asarray(segment.lengths)[keep])
+            merged["ids"].append(np.asarray(segment.ids)[keep])
+            base += int(keep.sum())
+        self.meta["segments"] = []
+        self.meta["deleted"] = {}
+        self._positions = None
+        if base:
+            self._write_segment(*(np.concatenate(merged[part]) for part in ("hashes", "docs", "freqs", "lengths", "ids")))
+
+    def _remove_unused(self):
+        used = {segment["name"] for segment in self.meta["segments"]}
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(".npy") and file_name.split(".", 1)[0] not in used:
+                # Readers that still map the file keep their view until they reload
+                os.remove(os.path.join(self.directory, file_name))
+
+    def search(self, query_text, k=20):
+        # Top-k (chunk id, BM25 score) for the query, best first
+        hashes = np.array(sorted({term_hash(term) for term in tokenize(query_text or "")}), dtype=np.uint64)
+        segments = self.segments
+        total_docs = sum(len(segment.ids) for segment in segments)
+        if len(hashes) == 0 or total_docs == 0:
+            return []
+        average_length = max(sum(int(entry["tokens"]) for entry in self.meta["segments"]) / total_docs, 1.0)
+        ranges = [segment.ranges(hashes) for segment in segments]
+        doc_freq = sum(ends - starts for starts, ends in ranges)
+        idf = np.log(1.0 + (total_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+        hits = []
+        for segment, (starts, ends) in zip(segments, ranges):
+            scores = np.zeros(len(segment.ids), dtype=np.float32)
+            for term_idf, start, end in zip(idf, starts, ends):
+                if end <= start:
+                    continue
+                postings = segment.postings[start:end]
+                freqs = segment.freqs[start:end].astype(np.float32)
+                norm = bm25_k1 * (1.0 - bm25_b + bm25_b * segment.lengths[postings] / average_length)
+                scores[postings] += term_idf * freqs * (bm25_k1 + 1.0) / (freqs + norm)
+            if segment.live is not None:
+                scores[~segment.live] = 0.0
+            matched = np.flatnonzero(scores)
+            if len(matched) > k:
+                matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+            hits.extend((float(scores[position]), segment.ids[position].decode()) for position in matched)
+        hits.sort(reverse=True)
+        return [(chunk_id, score) for score, chunk_id in hits[:k]]
+
+    def stats(self):
+        return {
+            "segments": len(self.meta["segments"]),
+            "chunks": len(self),
+            "deleted": self.deleted_docs(),
+            "bytes": sum(os.path.getsize(os.path.join(self.directory, file_name))
+                         for file_name in os.listdir(self.directory)) if os.path.isdir(self.directory) else 0,
+        }
+
+
+def open_index(collection_name, directory=None):
+    # The collection's index, or None when it was ingested before indexes were built
+    index = BM25Index(directory or os.path.join(persist_directory, collection_name))
+    return index if index.exists else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BM25 indexes used by hybrid retrieval")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="(Re)build the index of existing collections from their stores")
+    build_parser.add_argument("collections", help="Collection name, comma-separated list or wildcard")
+    stats_parser = subparsers.add_parser("stats", help="Print index size and segment counts")
+    stats_parser.add_argument("collections", help="Collection name, comma-separated list or wildcard")
+    args = parser.parse_args()
+
+    from retrieval import resolve_collections
+
+    for name in resolve_collections(args.collections, persist_directory):
+        directory = os.path.join(persist_directory, name)
+        index = BM25Index(directory)
+        if args.command == "build":
+            from vector_store import stored_collection
+            count = index.build_from_store(stored_collection(name, directory))
+            index.save()
+            print(f"{name}: indexed {count} chunks")
+        else:
+            print(f"{name}: {json.dumps(index.stats())}")
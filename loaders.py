@@ -0,0 +1,77 @@
+import csv
+from typing import Iterator, List
+
+from langchain.docstore.document import Document
+from langchain.document_loaders import CSVLoader, EverNoteLoader, PDFMinerLoader
+from langchain.document_loaders.evernote import _parse_note
+
+
+# Lazy variants of the loaders whose files hold many records. Each yields one Document per
+# row, page or note with that record's position in the metadata, so large files stream
+# through the splitter instead of being read into memory whole.
+
+
+class StreamingCSVLoader(CSVLoader):
+    # One document per row, read as the splitter asks for it
+
+    def lazy_load(self) -> Iterator[Document]:
+        with open(self.file_path, newline="", encoding=self.encoding) as csvfile:
+            csv_reader = csv.DictReader(csvfile, **self.csv_args)
+            for i, row in enumerate(csv_reader):
+                content = "\n".join(f"{k.strip()}: {(v or '').strip()}" for k, v in row.items() if k is not None)
+                source = self.file_path
+                if self.source_column is not None:
+                    if self.source_column not in row:
+                        raise ValueError(f"Source column '{self.source_column}' not found in CSV file.")
+                    source = row[self.source_column]
+                yield Document(page_content=content, metadata={"source": source, "row": i})
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
+
+
+class PagedPDFMinerLoader(PDFMinerLoader):
+    # One document per page (numbered from 1); pdfminer lays out a page at a time
+
+    def lazy_load(self) -> Iterator[Document]:
+        from pdfminer.high_level import extract_pages
+        from pdfminer.layout import LTTextContainer
+
+        for page_number, page_layout in enumerate(extract_pages(self.file_path), start=1):
+            text = "".join(element.get_text() for element in page_layout if isinstance(element, LTTextContainer))
+            if text.strip():
+                yield Document(page_content=text, metadata={"source": self.file_path, "page": page_number})
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
+
+
+class StreamingEverNoteLoader(EverNoteLoader):
+    # One document per note; each parsed note is cleared so the export's tree doesn't build up
+
+    def lazy_load(self) -> Iterator[Document]:
+        from lxml import etree
+
+        context = etree.iterparse(self.file_path, tag="note", encoding="utf-8", strip_cdata=False,
+                                  huge_tree=True, recover=True)
+        for i, (_, elem) in enumerate(context):
+            note = _parse_note(elem)
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+            metadata = {"source": self.file_path, "note": i}
+            if note.get("title"):
+                metadata["title"] = note["title"]
+            yield Document(page_content=note.get("content", ""), metadata=metadata)
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
+
+
+def lazy_load(loader) -> Iterator[Document]:
+    # Loaders without a lazy interface are loaded whole, but every document they return is kept
+    try:
+        documents = loader.lazy_load()
+    except NotImplementedError:
+        documents = loader.load()
+    yield from documents
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+
+MANIFEST_FILE = "manifest.json"
+
+
+def file_hash(file_path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class Manifest:
+    # Per-collection record of ingested source files and the chunk ids each one produced.
+    # Stored as PERSIST_DIRECTORY/<collection>/manifest.json:
+    #   {"files": {path: {"size": int, "mtime": float, "hash": str | None, "chunk_ids": [str]}},
+    #    "settings": {"chunk_size": int, "chunk_overlap": int}}
+    # An entry whose hash is None was not fully ingested and is treated as changed.
+    # settings records how the chunks were split; manifests written before it existed have none.
+    # Files are keyed by their source name, which is their path unless locations maps it to the
+    # path the file is read from during this run (uploads are named <project>/<filename>).
+    # hashes holds the content hashes computed during this run, so each file is read for hashing once.
+
+    def __init__(self, persist_directory):
+        self.path = os.path.join(persist_directory, MANIFEST_FILE)
+        self.files = {}
+        self.settings = None
+        self.locations = {}
+        self.hashes = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            self.files = data.get("files", {})
+            self.settings = data.get("settings")
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self.files, "settings": self.settings}, f)
+        os.replace(tmp_path, self.path)
+
+    def location(self, file_path):
+        return self.locations.get(file_path, file_path)
+
+    def content_hash(self, file_path):
+        if file_path not in self.hashes:
+            self.hashes[file_path] = file_hash(self.location(file_path))
+        return self.hashes[file_path]
+
+    def is_unchanged(self, file_path):
+        entry = self.files.get(file_path)
+        if entry is None or entry["hash"] is None:
+            return False
+        stat = os.stat(self.location(file_path))
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return True
+        if entry["size"] != stat.st_size:
+            return False
+        # Touched but possibly identical: compare content before re-embedding
+        if self.content_hash(file_path) == entry["hash"]:
+            entry["mtime"] = stat.st_mtime
+            return True
+        return False
+
+    def start_file(self, file_path):
+        # Returns the chunk ids of the previous version, which the caller deletes
+        old_ids = self.forget(file_path)
+        stat = os.stat(self.location(file_path))
+        self.files[file_path] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": None, "chunk_ids": []}
+        return old_ids
+
+    def add_chunk_ids(self, file_path, chunk_ids):
+        entry = self.files.get(file_path)
+        if entry is not None:
+            entry["chunk_ids"].extend(chunk_ids)
+
+    def finish_file(self, file_path):
+        self.files[file_path]["hash"] = self.content_hash(file_path)
+
+    def forget(self, file_path):
+        entry = self.files.pop(file_path, None)
+        return entry["chunk_ids"] if entry else []
+
+    def removed_files(self, source_directory, present_files):
+        # Tracked files under source_directory that are no longer on disk
+        prefix = os.path.join(source_directory, "")
+        present = set(present_files)
+        return [path for path in self.files if path.startswith(prefix) and path not in present]
+
+    def clear(self):
+        self.files = {}
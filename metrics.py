@@ -0,0 +1,156 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Upper bounds for count histograms such as chunks per batch or tokens per answer
+COUNT_BUCKETS = (1, 4, 16, 64, 256, 1024, 4096, 16384)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}  # label key -> [bucket counts..., sum, count]
+
+    def observe(self, value, labels):
+        series = self._series.setdefault(_label_key(labels), [0] * len(self.buckets) + [0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._series = {}
+
+    def inc(self, value, labels):
+        key = _label_key(labels)
+        self._series[key] = self._series.get(key, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._series.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    # Process-wide metrics rendered in the Prometheus text exposition format by /metrics
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._gauge_sources = []
+
+    def histogram(self, name, help_text, buckets=DURATION_BUCKETS):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, help_text, buckets)
+            return self._metrics[name]
+
+    def counter(self, name, help_text):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Counter(name, help_text)
+            return self._metrics[name]
+
+    def observe(self, histogram, value, **labels):
+        with self._lock:
+            histogram.observe(value, labels)
+
+    def inc(self, counter, value=1, **labels):
+        with self._lock:
+            counter.inc(value, labels)
+
+    def add_gauges(self, source):
+        # source() returns (name, help, value) tuples sampled at scrape time
+        self._gauge_sources.append(source)
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for metric in self._metrics.values():
+                lines.extend(metric.render())
+        for source in self._gauge_sources:
+            for name, help_text, value in source():
+                lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"])
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram("privategpt_stage_seconds", "Time spent per pipeline stage")
+request_seconds = metrics.histogram("privategpt_http_request_seconds", "HTTP request duration")
+ingest_items = metrics.counter("privategpt_ingest_items_total", "Files and chunks processed by ingestion")
+generated_tokens = metrics.histogram("privategpt_generated_tokens", "Tokens generated per answer", COUNT_BUCKETS)
+tokens_per_second = metrics.histogram("privategpt_generation_tokens_per_second", "Generation speed per answer",
+                                      (1, 2, 5, 10, 20, 50, 100, 200))
+context_tokens = metrics.histogram("privategpt_context_tokens", "Estimated tokens of retrieved text per prompt, after packing",
+                                   COUNT_BUCKETS)
+context_tokens_saved = metrics.counter("privategpt_context_tokens_saved_total",
+                                       "Estimated prompt tokens removed by context packing")
+
+
+class Timings:
+    # Per-request stage durations and counts; every stage is also exported as a histogram
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.values = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.values[f"{name}_seconds"] = self.values.get(f"{name}_seconds", 0.0) + seconds
+        metrics.observe(stage_seconds, seconds, operation=self.operation, stage=name)
+
+    def count(self, name, value):
+        self.values[name] = value
+
+    def tokens(self, count, seconds):
+        self.values["tokens"] = count
+        self.values["tokens_per_second"] = count / seconds if seconds > 0 else 0.0
+        metrics.observe(generated_tokens, count, operation=self.operation)
+        if seconds > 0:
+            metrics.observe(tokens_per_second, count / seconds, operation=self.operation)
+
+    def to_dict(self):
+        return dict(self.values)
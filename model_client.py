@@ -0,0 +1,205 @@
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+
+load_dotenv()
+
+# Unix socket of the model server (python model_server.py). When set, the embeddings model and the LLM
+# live in that one process and this process only sends it requests.
+model_server_socket = os.environ.get('MODEL_SERVER_SOCKET')
+# Connections each client process keeps to the model server, and so its concurrent requests
+model_server_connections = int(os.environ.get('MODEL_SERVER_CONNECTIONS', 4))
+# How long to keep retrying while the model server isn't accepting connections yet
+model_server_connect_timeout_seconds = float(os.environ.get('MODEL_SERVER_CONNECT_TIMEOUT_SECONDS', 60))
+
+# Texts sent per embed request; the server batches requests from all clients together again
+EMBED_REQUEST_TEXTS = 256
+
+# Every message is a frame: header and payload lengths as two big-endian uint32, a JSON header, then
+# an optional binary payload (embedding vectors travel as raw float32)
+_LENGTHS = struct.Struct(">II")
+
+
+def send_frame(sock, header, payload=b""):
+    data = json.dumps(header).encode("utf8")
+    sock.sendall(_LENGTHS.pack(len(data), len(payload)) + data + payload)
+
+
+def _recv_exact(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(min(size - len(buffer), 1 << 20))
+        if not chunk:
+            raise EOFError("Model server connection closed")
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+def recv_frame(sock):
+    header_size, payload_size = _LENGTHS.unpack(_recv_exact(sock, _LENGTHS.size))
+    header = json.loads(_recv_exact(sock, header_size))
+    return header, _recv_exact(sock, payload_size) if payload_size else b""
+
+
+class ModelServerError(RuntimeError):
+    pass
+
+
+class _Stale(Exception):
+    # The server closed a pooled connection while it was idle
+    pass
+
+
+class ModelClient:
+    # Pool of Unix-socket connections to the model server, each used by one request at a time
+
+    def __init__(self, path, connections=model_server_connections, connect_timeout=model_server_connect_timeout_seconds):
+        self.path = path
+        self.connections = connections
+        self.connect_timeout = connect_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(connections)
+        self.opened = 0
+
+    def _connect(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                self.opened += 1
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.5)
+
+    @contextmanager
+    def _connection(self):
+        self._slots.acquire()
+        sock = None
+        try:
+            with self._lock:
+                sock = self._idle.pop() if self._idle else None
+            reused = sock is not None
+            if sock is None:
+                sock = self._connect()
+            yield sock, reused
+        except BaseException:
+            # A connection interrupted mid-request may still have unread frames
+            if sock is not None:
+                sock.close()
+                sock = None
+            raise
+        finally:
+            if sock is not None:
+                with self._lock:
+                    self._idle.append(sock)
+            self._slots.release()
+
+    def call(self, header, payload=b"", on_frame=None):
+        # Sends one request and returns the final (header, payload). Intermediate frames, such as
+        # generated tokens, go to on_frame. A pooled connection the server has closed is replaced
+        # once, as long as nothing was received on it yet.
+        for attempt in range(2):
+            received = False
+            try:
+                with self._connection() as (sock, reused):
+                    try:
+                        send_frame(sock, header, payload)
+                        while True:
+                            reply, reply_payload = recv_frame(sock)
+                            received = True
+                            if "frame" in reply and on_frame is not None:
+                                on_frame(reply)
+                                continue
+                            break
+                    except (EOFError, ConnectionError):
+                        if reused and not received and attempt == 0:
+                            raise _Stale()
+                        raise
+            except _Stale:
+                continue
+            break
+        if "error" in reply:
+            if reply.get("status"):
+                from scheduler import SchedulerRejected
+                raise SchedulerRejected(reply["error"], reply.get("retry_after", 1), reply["status"])
+            raise ModelServerError(reply["error"])
+        return reply, reply_payload
+
+    def embed(self, texts: List[str], query=False) -> np.ndarray:
+        # query marks texts the server embeds without storing them in its embedding cache
+        parts = []
+        for start in range(0, len(texts), EMBED_REQUEST_TEXTS):
+            reply, payload = self.call({"op": "embed", "texts": texts[start:start + EMBED_REQUEST_TEXTS], "query": query})
+            parts.append(np.frombuffer(payload, dtype=np.float32).reshape(reply["count"], reply["dim"]))
+        return np.concatenate(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+
+    def generate(self, prompt, stop=None, on_token=None, queue=None, timeout=None):
+        def on_frame(frame):
+            if on_token is not None:
+                on_token(frame["token"])
+
+        reply, _ = self.call({"op": "generate", "prompt": prompt, "stop": stop, "queue": queue, "timeout": timeout},
+                             on_frame=on_frame)
+        return reply["result"]
+
+    def stats(self):
+        reply, _ = self.call({"op": "stats"})
+        reply["client"] = {"connections": self.connections, "idle": len(self._idle), "opened": self.opened}
+        return reply
+
+
+_clients = {}
+_clients_guard = threading.Lock()
+
+
+def model_client(path=None):
+    # One pooled client per socket path and process
+    path = path or model_server_socket
+    with _clients_guard:
+        client = _clients.get(path)
+        if client is None:
+            client = _clients[path] = ModelClient(path)
+        return client
+
+
+class RemoteEmbeddings(Embeddings):
+    def __init__(self, client: ModelClient):
+        self.client = client
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.client.embed(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.client.embed([text], query=True)[0].tolist()
+
+
+class RemoteLLM(LLM):
+    # Generation on the model server's LLM; tokens are streamed back to this process's callbacks.
+    # Requests from one process share a queue on the server, which serves processes round-robin.
+    client: Any
+    queue: str = ""
+
+    @property
+    def _llm_type(self) -> str:
+        return "remote"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None) -> str:
+        on_token = run_manager.on_llm_new_token if run_manager else None
+        return self.client.generate(prompt, stop=stop, on_token=on_token, queue=self.queue or f"pid-{os.getpid()}")
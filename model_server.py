@@ -0,0 +1,194 @@
+import argparse
+import os
+import queue
+import socketserver
+import threading
+import time
+import traceback
+
+from dotenv import load_dotenv
+import numpy as np
+from langchain.callbacks.base import BaseCallbackHandler
+
+from model_client import send_frame, recv_frame
+from embedding_cache import uncached
+from resources import ResourceRegistry
+from scheduler import LLMScheduler, SchedulerRejected, local_llm_instances
+from startup import warmup_llm
+
+load_dotenv()
+
+# Socket to listen on; workers connect to the same MODEL_SERVER_SOCKET
+model_server_socket = os.environ.get('MODEL_SERVER_SOCKET') or 'privategpt-models.sock'
+
+# Texts embedded together at most, across concurrent requests
+model_server_max_batch = int(os.environ.get('MODEL_SERVER_MAX_BATCH', 64))
+# How long the first request of a batch waits for others to join it
+model_server_batch_wait_ms = float(os.environ.get('MODEL_SERVER_BATCH_WAIT_MS', 5))
+
+# This process owns the models, so its registry loads them here instead of connecting to itself
+registry = ResourceRegistry(remote=False)
+scheduler = LLMScheduler(instances=local_llm_instances, registry=registry)
+
+
+class _EmbedRequest:
+    def __init__(self, texts, query=False):
+        self.texts = texts
+        self.query = query
+        self.vectors = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class EmbeddingBatcher:
+    # Collects embed requests arriving within a short window into one call of the embeddings model,
+    # which is much cheaper per text than many small calls
+
+    def __init__(self, max_batch=model_server_max_batch, wait_seconds=model_server_batch_wait_ms / 1000):
+        self.max_batch = max_batch
+        self.wait_seconds = wait_seconds
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.texts = 0
+        self.requests = 0
+        threading.Thread(target=self._run, name="embed-batcher", daemon=True).start()
+
+    def embed(self, texts, query=False):
+        request = _EmbedRequest(texts, query)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.vectors
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0].texts)
+            deadline = time.monotonic() + self.wait_seconds
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request.texts)
+            try:
+                # Chunks go through the embedding cache; queries bypass it so they don't evict chunks
+                embeddings = registry.embeddings()
+                vectors = {}
+                for query, model in ((False, embeddings), (True, uncached(embeddings))):
+                    texts = [text for request in batch if request.query == query for text in request.texts]
+                    vectors[query] = iter(model.embed_documents(texts) if texts else [])
+                for request in batch:
+                    request.vectors = [next(vectors[request.query]) for _ in request.texts]
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            self.batches += 1
+            self.requests += len(batch)
+            self.texts += size
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "texts": self.texts,
+            "mean_batch_texts": self.texts / self.batches if self.batches else 0.0,
+        }
+
+
+class _TokenForwarder(BaseCallbackHandler):
+    # Sends each generated token back to the client as it is produced
+    def __init__(self, sock):
+        self.sock = sock
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        send_frame(self.sock, {"frame": "token", "token": token})
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    # One client connection: requests are answered in order until the client disconnects
+
+    def handle(self):
+        while True:
+            try:
+                header, _ = recv_frame(self.request)
+            except (EOFError, ConnectionError):
+                return
+            try:
+                reply, payload = self.server.dispatch(self.request, header)
+            except SchedulerRejected as e:
+                reply, payload = {"error": str(e), "status": e.status, "retry_after": e.retry_after}, b""
+            except Exception as e:
+                traceback.print_exc()
+                reply, payload = {"error": f"{type(e).__name__}: {e}"}, b""
+            try:
+                send_frame(self.request, reply, payload)
+            except ConnectionError:
+                return
+
+
+class ModelServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, _Handler)
+        self.batcher = EmbeddingBatcher()
+
+    def dispatch(self, sock, header):
+        op = header.get("op")
+        if op == "embed":
+            vectors = np.asarray(self.batcher.embed(header["texts"], header.get("query", False)), dtype=np.float32)
+            count, dim = vectors.shape if vectors.size else (len(header["texts"]), 0)
+            return {"count": count, "dim": dim}, vectors.tobytes()
+        if op == "generate":
+            def generate(llm):
+                return llm(header["prompt"], stop=header.get("stop"), callbacks=[_TokenForwarder(sock)])
+
+            return {"result": scheduler.run(header.get("queue") or "", generate, timeout=header.get("timeout"))}, b""
+        if op == "stats":
+            return {"resources": registry.stats(), "scheduler": scheduler.stats(), "batcher": self.batcher.stats()}, b""
+        if op == "ping":
+            return {"ok": True}, b""
+        raise ValueError(f"Unknown operation {op!r}")
+
+
+def warm_up():
+    # Clients can connect while the models load; their first requests wait for them
+    try:
+        start = time.perf_counter()
+        registry.embeddings().embed_documents(["This is a test."])
+        print(f"Model server: embeddings loaded in {time.perf_counter() - start:.1f}s")
+        if warmup_llm:
+            start = time.perf_counter()
+            registry.llm()
+            print(f"Model server: LLM loaded in {time.perf_counter() - start:.1f}s")
+    except Exception:
+        traceback.print_exc()
+
+
+def main(path):
+    server = ModelServer(path)
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+    print(f"Model server listening on {path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the embeddings model and the LLM to local web workers")
+    parser.add_argument("--socket", default=model_server_socket, help="Unix socket path (env MODEL_SERVER_SOCKET)")
+    args = parser.parse_args()
+    main(args.socket)
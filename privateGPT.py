@@ -1,11 +1,16 @@
 from dotenv import load_dotenv
 from langchain import OpenAI
-from langchain.chains import RetrievalQA
+from langchain.chains.question_answering import load_qa_chain
 from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain.vectorstores import Chroma
 from langchain.llms import GPT4All, LlamaCpp
+import argparse
+import json
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 
@@ -16,35 +21,247 @@ model_type = os.environ.get('MODEL_TYPE')
 model_path = os.environ.get('MODEL_PATH')
 model_n_ctx = os.environ.get('MODEL_N_CTX')
 
-from constants import CHROMA_SETTINGS
+from vector_store import open_store, chroma_client
+from lexical_index import open_index
+from retrieval import citation, resolve_collections, search_collections
+from metrics import Timings
+from streaming import TokenCounter
+from context_packer import pack_context
 
-def main():
-    embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
-    db = Chroma(persist_directory=persist_directory, embedding_function=embeddings, client_settings=CHROMA_SETTINGS)
-    retriever = db.as_retriever()
-    # Prepare the LLM
-    callbacks = [StreamingStdOutCallbackHandler()]
+def open_stores(args, embeddings):
+    # Returns the collection names to search and functions opening each one's store and BM25 index.
+    # --collection accepts a comma-separated list or a wildcard, searched together.
+    if not args.collection:
+        # The process's shared client, which sees ingests persisted by other processes
+        db = Chroma(persist_directory=persist_directory, embedding_function=embeddings, client=chroma_client())
+        return ["langchain"], lambda name: db, lambda name: None
+    names = resolve_collections(args.collection, persist_directory)
+    stores = {
+        name: open_store(name, persist_directory + "/" + name, embeddings)
+        for name in names
+    }
+    indexes = {name: open_index(name) for name in names}
+    return names, stores.__getitem__, indexes.get
+
+
+def print_collection_timings(per_collection):
+    if len(per_collection) > 1:
+        print("\n> Collections:")
+        print(", ".join(f"{name}={stats['seconds']:.2f}s ({stats['hits']} hits)" for name, stats in per_collection.items()))
+
+
+def retrieve_only(names, open_db, open_index, embeddings, args):
+    # Retrieval-only mode: print the top-k chunks with their scores, no LLM is loaded
+    while True:
+        query = input("\nEnter a query: ")
+        if query == "exit":
+            break
+
+        hits, per_collection = search_collections(
+            names, open_db, embeddings.embed_query(query), k=args.k, query_text=query, open_index=open_index,
+            mode=args.mode, score_threshold=args.score_threshold,
+            mmr=args.mmr, fetch_k=args.fetch_k, lambda_mult=args.lambda_mult,
+            filter=json.loads(args.filter) if args.filter else None)
+        for document, score in hits:
+            print(f"\n> {citation(document.metadata)} (score {score:.3f}):")
+            print(document.page_content)
+        if args.timings:
+            print_collection_timings(per_collection)
+
+
+def read_questions(path):
+    # Questions from a JSONL file, or stdin for "-": one object per line with a "query" (or "question")
+    # and an optional "id", which defaults to the line number
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                query = record.get("query") or record["question"]
+            except (ValueError, KeyError, AttributeError):
+                sys.exit(f"{path}:{line_number}: expected a JSON object with a \"query\"")
+            yield record.get("id", line_number), query
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def answered_ids(path):
+    # Ids answered without an error by an earlier run writing to the same output. A last line cut
+    # short by the interruption is dropped, so appending starts on a fresh line.
+    done = set()
+    if path == "-" or not os.path.exists(path):
+        return done
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if "error" not in record:
+            done.add(json.dumps(record.get("id")))
+    return done
+
+
+def source_dict(document, score=None, content=False):
+    source = {"citation": citation(document.metadata), "metadata": document.metadata}
+    if score is not None:
+        source["score"] = score
+    if content:
+        source["page_content"] = document.page_content
+    return source
+
+
+def retrieve_batch(batch, names, open_db, open_index, embeddings, pool, search_kwargs):
+    # Embeds the questions of a batch in one call, then searches for all of them concurrently.
+    # Returns (hits, timings, error) per question.
+    queries = [query for _, query in batch]
+    start = time.perf_counter()
+    vectors = embeddings.embed_documents(queries)
+    embed_seconds = (time.perf_counter() - start) / len(batch)
+
+    def search_one(query, vector):
+        timings = Timings("privategpt")
+        # The batch's embedding time, shared equally between its questions
+        timings.record("embed_query", embed_seconds)
+        try:
+            with timings.stage("retrieve"):
+                hits, per_collection = search_collections(names, open_db, vector, query_text=query,
+                                                          open_index=open_index, **search_kwargs)
+        except Exception as e:
+            return None, timings, e
+        if len(per_collection) > 1:
+            timings.count("collections", per_collection)
+        return hits, timings, None
+
+    return list(pool.map(search_one, queries, vectors))
+
+
+def batch_answer(chain, query, hits, timings, args):
+    if chain is None:
+        return {"sources": [source_dict(doc, score, args.chunk_text) for doc, score in hits]}
+    with timings.stage("pack"):
+        context = pack_context([doc for doc, _ in hits])
+    context.report(timings)
+    counter = TokenCounter()
+    start = time.perf_counter()
+    answer = chain.run(input_documents=context.docs, question=query, callbacks=[counter])
+    elapsed = time.perf_counter() - start
+    timings.record("generate", elapsed)
+    timings.tokens(counter.tokens or len(answer.split()), elapsed)
+    return {"answer": answer, "sources": [source_dict(doc, content=args.chunk_text) for doc in context.docs]}
+
+
+def run_batch(names, open_db, open_index, embeddings, llm, args):
+    # Answers every question of the --batch JSONL input and appends one JSON line per question to
+    # --output. Questions are embedded and searched a batch at a time on a thread pool; the next batch
+    # is retrieved while the single LLM answers the current one. Questions already answered in
+    # --output are skipped, so an interrupted run continues where it stopped.
+    done = answered_ids(args.output)
+    questions = [(question_id, query) for question_id, query in read_questions(args.batch)
+                 if json.dumps(question_id) not in done]
+    if done:
+        print(f"Skipping {len(done)} questions already answered in {args.output}", file=sys.stderr)
+    search_kwargs = {"k": args.k, "mode": args.mode}
+    if llm is None:
+        search_kwargs.update(score_threshold=args.score_threshold, mmr=args.mmr, fetch_k=args.fetch_k,
+                             lambda_mult=args.lambda_mult, filter=json.loads(args.filter) if args.filter else None)
+    chain = load_qa_chain(llm, chain_type="stuff") if llm is not None else None
+    batches = (questions[i:i + args.batch_size] for i in range(0, len(questions), args.batch_size))
+
+    out = sys.stdout if args.output == "-" else open(args.output, "a")
+    start = time.perf_counter()
+    answered = 0
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="batch-search") as pool, \
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-retrieve") as prefetch:
+            def submit(batch):
+                if batch is None:
+                    return None
+                return prefetch.submit(retrieve_batch, batch, names, open_db, open_index, embeddings, pool, search_kwargs)
+
+            batch = next(batches, None)
+            future = submit(batch)
+            while future is not None:
+                results = future.result()
+                next_batch = next(batches, None)
+                future = submit(next_batch)
+                for (question_id, query), (hits, timings, error) in zip(batch, results):
+                    record = {"id": question_id, "query": query}
+                    if error is None:
+                        try:
+                            record.update(batch_answer(chain, query, hits, timings, args))
+                        except Exception as e:
+                            error = e
+                    if error is not None:
+                        record["error"] = f"{type(error).__name__}: {error}"
+                    record["timings"] = timings.to_dict()
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+                answered += len(batch)
+                elapsed = time.perf_counter() - start
+                print(f"{answered}/{len(questions)} questions in {elapsed:.1f}s "
+                      f"({answered / elapsed:.2f}/s)", file=sys.stderr)
+                batch = next_batch
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def load_llm(callbacks):
     match model_type:
         case "LlamaCpp":
-            llm = LlamaCpp(model_path=model_path, n_ctx=model_n_ctx, callbacks=callbacks, verbose=False)
+            return LlamaCpp(model_path=model_path, n_ctx=model_n_ctx, callbacks=callbacks, verbose=False)
         case "GPT4All":
-            llm = GPT4All(model=model_path, n_ctx=model_n_ctx, backend='gptj', callbacks=callbacks, verbose=False)
+            return GPT4All(model=model_path, n_ctx=model_n_ctx, backend='gptj', callbacks=callbacks, verbose=False)
         case "OpenAI":
-            llm = OpenAI(model_name="text-davinci-003")
+            return OpenAI(model_name="text-davinci-003")
 
         case _default:
             print(f"Model {model_type} not supported!")
-            exit;
-    qa = RetrievalQA.from_chain_type(llm=llm, chain_type="stuff", retriever=retriever, return_source_documents=True)
+            exit(1)
+
+
+def main(args):
+    embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name)
+    names, open_db, open_index = open_stores(args, embeddings)
+    if args.batch:
+        # Tokens aren't echoed to stdout, which may be the output
+        run_batch(names, open_db, open_index, embeddings, None if args.no_llm else load_llm([]), args)
+        return
+    if args.no_llm:
+        retrieve_only(names, open_db, open_index, embeddings, args)
+        return
+    # Prepare the LLM
+    llm = load_llm([StreamingStdOutCallbackHandler()])
+    chain = load_qa_chain(llm, chain_type="stuff")
     # Interactive questions and answers
     while True:
         query = input("\nEnter a query: ")
         if query == "exit":
             break
         
-        # Get the answer from the chain
-        res = qa(query)    
-        answer, docs = res['result'], res['source_documents']
+        # Get the answer from the chain, timing retrieval and generation separately
+        timings = Timings("privategpt")
+        with timings.stage("retrieve"):
+            hits, per_collection = search_collections(names, open_db, embeddings.embed_query(query), k=args.k,
+                                                      query_text=query, open_index=open_index, mode=args.mode)
+        with timings.stage("pack"):
+            context = pack_context([doc for doc, _ in hits])
+            docs = context.docs
+        context.report(timings)
+        counter = TokenCounter()
+        start = time.perf_counter()
+        answer = chain.run(input_documents=docs, question=query, callbacks=[counter])
+        elapsed = time.perf_counter() - start
+        timings.record("generate", elapsed)
+        timings.tokens(counter.tokens or len(answer.split()), elapsed)
 
         # Print the result
         print("\n\n> Question:")
@@ -54,8 +271,31 @@ def main():
         
         # Print the relevant sources used for the answer
         for document in docs:
-            print("\n> " + document.metadata["source"] + ":")
+            print("\n> " + citation(document.metadata) + ":")
             print(document.page_content)
 
+        if args.timings:
+            print("\n> Timings:")
+            print(", ".join(f"{name}={value:.2f}" for name, value in timings.to_dict().items()))
+            print(f"Context: {context.tokens} of {context.tokens_before} estimated tokens "
+                  f"({context.merged} merged, {context.duplicates} duplicates, {context.dropped} dropped)")
+            print_collection_timings(per_collection)
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--collection", help="Query this collection instead of the default one; a comma-separated list or a wildcard such as 'team-*' searches several")
+    parser.add_argument("--no-llm", action="store_true", help="Only print the retrieved chunks and their scores")
+    parser.add_argument("--k", type=int, default=4, help="Number of chunks to retrieve")
+    parser.add_argument("--mode", choices=["hybrid", "vector"], help="Fuse BM25 and vector rankings, or rank by vectors only (env RETRIEVAL_MODE)")
+    parser.add_argument("--score-threshold", type=float, help="Drop chunks scoring below this similarity (--no-llm)")
+    parser.add_argument("--mmr", action="store_true", help="Diversify results with maximal marginal relevance (--no-llm)")
+    parser.add_argument("--fetch-k", type=int, default=20, help="Candidates considered by MMR (--no-llm)")
+    parser.add_argument("--lambda-mult", type=float, default=0.5, help="MMR trade-off, 1 is pure relevance (--no-llm)")
+    parser.add_argument("--timings", action="store_true", help="Print retrieval and generation timings after each answer")
+    parser.add_argument("--filter", help="JSON metadata filter, e.g. '{\"source\": \"source_documents/a.txt\"}' (--no-llm)")
+    parser.add_argument("--batch", metavar="QUESTIONS", help="Answer the questions of a JSONL file, or '-' for stdin, instead of asking interactively")
+    parser.add_argument("--output", default="-", help="JSONL file the batch answers are appended to; questions already answered there are skipped (default stdout)")
+    parser.add_argument("--batch-size", type=int, default=32, help="Questions embedded together and retrieved ahead of generation (--batch)")
+    parser.add_argument("--workers", type=int, default=4, help="Threads searching the questions of a batch concurrently (--batch)")
+    parser.add_argument("--chunk-text", action="store_true", help="Include each source's chunk text in the batch output (--batch)")
+    main(parser.parse_args())
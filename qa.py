@@ -0,0 +1,102 @@
+import os
+import time
+
+from dotenv import load_dotenv
+from langchain.chains.question_answering import load_qa_chain
+
+from resources import registry
+from retrieval import document_to_dict, resolve_collections, search_collections
+from answer_cache import answer_cache
+from scheduler import scheduler
+from metrics import Timings
+from streaming import TokenCounter
+from context_packer import pack_context
+
+load_dotenv()
+
+persist_directory = os.environ.get('PERSIST_DIRECTORY')
+
+
+def collections_for(spec):
+    # Collection names for a request's collection_name: one name, a comma-separated list or a wildcard
+    return resolve_collections(spec, persist_directory)
+
+
+def cache_key(collection_names):
+    # Answers, and the scheduler's fair queueing, are keyed by the collections searched together
+    return ",".join(collection_names)
+
+
+def cached_answer(collection_names, query_text, timings=None):
+    # Exact repeats are answered without embedding the query; otherwise the query vector
+    # is returned so retrieval can reuse it
+    timings = timings or Timings("retrieve")
+    with timings.stage("cache_lookup"):
+        cached = answer_cache.get_exact(cache_key(collection_names), query_text)
+    if cached is not None:
+        return cached, None
+    with timings.stage("embed_query"):
+        vector = registry.embeddings().embed_query(query_text)
+    with timings.stage("cache_lookup"):
+        return answer_cache.get_similar(cache_key(collection_names), vector), vector
+
+
+def retrieve(collection_names, query_text, vector, timings=None, k=4, mode=None):
+    # Embeddings, the collections' stores and their BM25 indexes are loaded once and kept warm. Several
+    # collections are searched concurrently with the same query and merged into one top-k.
+    timings = timings or Timings("retrieve")
+    with timings.stage("vector_search"):
+        hits, per_collection = search_collections(collection_names, registry.db, vector, k=k, query_text=query_text,
+                                                  open_index=registry.lexical_index, mode=mode)
+    timings.count("chunks", len(hits))
+    if len(collection_names) > 1:
+        timings.count("collections", per_collection)
+    return [doc for doc, _ in hits]
+
+
+def pack(docs, timings=None):
+    # Removes repeated text from the retrieved chunks and fits them to the prompt's token budget
+    timings = timings or Timings("retrieve")
+    with timings.stage("pack"):
+        context = pack_context(docs)
+    context.report(timings)
+    return context
+
+
+def generate_answer(collection_names, query_text, docs, callbacks=None, timeout=None, timings=None):
+    # Generation is queued for one of the scheduler's model instances
+    timings = timings or Timings("retrieve")
+    queued = time.perf_counter()
+
+    def generate(llm):
+        timings.record("queue_wait", time.perf_counter() - queued)
+        chain = load_qa_chain(llm, chain_type="stuff")
+        with timings.stage("prompt"):
+            # The "stuff" prompt takes the chunks' text joined into one context
+            inputs = {"context": chain.document_separator.join(doc.page_content for doc in docs),
+                      "question": query_text}
+            timings.count("prompt_chars", len(chain.llm_chain.prompt.format(**inputs)))
+        counter = TokenCounter()
+        # Tokens only go to the caller's callbacks, never to the server's stdout
+        start = time.perf_counter()
+        answer = chain.llm_chain.predict(callbacks=list(callbacks or []) + [counter], **inputs)
+        elapsed = time.perf_counter() - start
+        timings.record("generate", elapsed)
+        # Models that don't stream report no tokens; count words instead
+        timings.tokens(counter.tokens or len(answer.split()), elapsed)
+        return answer
+
+    return scheduler.run(cache_key(collection_names), generate, timeout=timeout)
+
+
+def answer_query(collection_names, query_text, timeout=None, timings=None):
+    timings = timings or Timings("retrieve")
+    cached, vector = cached_answer(collection_names, query_text, timings)
+    if cached is not None:
+        return {"results": cached.answer, "docs": cached.sources, "cached": True}
+
+    context = pack(retrieve(collection_names, query_text, vector, timings), timings)
+    answer = generate_answer(collection_names, query_text, context.docs, timeout=timeout, timings=timings)
+    sources = [document_to_dict(doc) for doc in context.docs]
+    answer_cache.put(cache_key(collection_names), query_text, vector, answer, sources)
+    return {"results": answer, "docs": sources, "cached": False, "context": context.to_dict()}
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+from langchain.embeddings import HuggingFaceEmbeddings
+from langchain.llms import GPT4All, LlamaCpp
+
+from embedding_cache import with_cache
+from model_client import model_server_socket, model_client, RemoteEmbeddings, RemoteLLM
+from lexical_index import BM25Index
+from vector_store import open_store, chroma_client, MmapVectorStore
+
+load_dotenv()
+
+embeddings_model_name = os.environ.get("EMBEDDINGS_MODEL_NAME")
+persist_directory = os.environ.get('PERSIST_DIRECTORY')
+
+model_type = os.environ.get('MODEL_TYPE')
+model_n_ctx = os.environ.get('MODEL_N_CTX')
+
+# Maximum number of open Chroma stores kept in the pool
+chroma_pool_size = int(os.environ.get('CHROMA_POOL_SIZE', 8))
+# Stores not used for this many seconds are closed on the next pool access
+chroma_pool_idle_seconds = float(os.environ.get('CHROMA_POOL_IDLE_SECONDS', 600))
+
+
+class ModelNotSupported(Exception):
+    pass
+
+
+class ResourceRegistry:
+    # Process-wide holder for the embedding model, the LLM and open Chroma stores.
+    # Everything is loaded on first use and reused by later requests. A remote registry's models are
+    # clients of the model server process instead, which is shared by every worker; by default it is
+    # remote when MODEL_SERVER_SOCKET is set. The model server itself uses a local one.
+
+    def __init__(self, pool_size=chroma_pool_size, idle_seconds=chroma_pool_idle_seconds,
+                 remote=bool(model_server_socket)):
+        self.pool_size = pool_size
+        self.idle_seconds = idle_seconds
+        self.remote = remote
+        self._embeddings = None
+        self._llm = None
+        self._stores = OrderedDict()  # collection -> (db, last_used)
+        self._indexes = {}  # collection -> BM25Index, dropped with the collection's store
+        self._lock = threading.Lock()
+        self._embeddings_lock = threading.Lock()
+        self._llm_lock = threading.Lock()
+
+    def embeddings(self):
+        if self._embeddings is None:
+            with self._embeddings_lock:
+                if self._embeddings is None and self.remote:
+                    # The server keeps the embedding cache
+                    self._embeddings = RemoteEmbeddings(model_client())
+                elif self._embeddings is None:
+                    self._embeddings = with_cache(HuggingFaceEmbeddings(model_name=embeddings_model_name), embeddings_model_name)
+        return self._embeddings
+
+    def llm(self):
+        if self._llm is None:
+            with self._llm_lock:
+                if self._llm is None:
+                    self._llm = self.load_llm()
+        return self._llm
+
+    def load_llm(self):
+        # Loads a new LLM instance; registry.llm() returns the shared one
+        if self.remote:
+            return RemoteLLM(client=model_client())
+        # MODEL_PATH is read at load time since model_download() may update it after import
+        model_path = os.environ.get('MODEL_PATH')
+        # No stdout handler here: the instance is shared, and each request passes the callbacks its
+        # tokens go to
+        if model_type == "LlamaCpp":
+            return LlamaCpp(model_path=model_path, n_ctx=model_n_ctx, verbose=False)
+        elif model_type == "GPT4All":
+            return GPT4All(model=model_path, n_ctx=model_n_ctx, backend='gptj', verbose=False)
+        raise ModelNotSupported(f"Model {model_type} not supported!")
+
+    def db(self, collection_name):
+        with self._lock:
+            now = time.monotonic()
+            self._evict_idle(now)
+            entry = self._stores.pop(collection_name, None)
+            if entry is None:
+                db = open_store(collection_name, persist_directory + "/" + collection_name, self.embeddings())
+            else:
+                db = entry[0]
+                if not isinstance(db, MmapVectorStore):
+                    # Loads the Chroma database again if another process persisted changes since
+                    chroma_client()
+            self._stores[collection_name] = (db, now)
+            while len(self._stores) > self.pool_size:
+                name, _ = self._stores.popitem(last=False)
+                self._indexes.pop(name, None)
+            return db
+
+    def lexical_index(self, collection_name):
+        # The collection's BM25 index, reloaded when an ingest saved a new version; None for
+        # collections ingested before indexes were built
+        with self._lock:
+            index = self._indexes.get(collection_name)
+            if index is None or index.stale():
+                index = self._indexes[collection_name] = BM25Index(persist_directory + "/" + collection_name)
+        return index if index.exists else None
+
+    def release(self, collection_name):
+        # Drop a pooled store, e.g. after the collection was re-ingested on disk
+        with self._lock:
+            self._stores.pop(collection_name, None)
+            self._indexes.pop(collection_name, None)
+
+    def _evict_idle(self, now):
+        if self.idle_seconds <= 0:
+            return
+        for name, (_, last_used) in list(self._stores.items()):
+            if now - last_used > self.idle_seconds:
+                del self._stores[name]
+                self._indexes.pop(name, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "embeddings_loaded": self._embeddings is not None,
+                "llm_loaded": self._llm is not None,
+                "open_collections": list(self._stores.keys()),
+                "pool_size": self.pool_size,
+                "embedding_cache": self._embeddings.cache.stats() if hasattr(self._embeddings, "cache") else None,
+                "model_server": model_server_socket if self.remote else None,
+            }
+
+
+registry = ResourceRegistry()
@@ -0,0 +1,234 @@
+import fnmatch
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+from langchain.vectorstores.utils import maximal_marginal_relevance
+
+load_dotenv()
+
+# Threads searching the collections of a federated query concurrently
+federated_search_workers = int(os.environ.get('FEDERATED_SEARCH_WORKERS', 8))
+# "hybrid" fuses vector and BM25 rankings; "vector" uses embedding similarity alone
+retrieval_mode = os.environ.get('RETRIEVAL_MODE', 'hybrid')
+# Reciprocal rank fusion constant: larger values give lower-ranked results relatively more weight
+rrf_k = int(os.environ.get('RRF_K', 60))
+# Candidates taken from each ranking before fusion
+hybrid_candidates = int(os.environ.get('HYBRID_CANDIDATES', 20))
+
+RETRIEVAL_MODES = ("hybrid", "vector")
+
+
+def document_to_dict(document: Document, score=None, rrf_score=None):
+    # Document objects are not JSON serialisable; responses carry their content and metadata, and the
+    # citation clients show for them
+    result = {"page_content": document.page_content, "metadata": document.metadata,
+              "citation": citation(document.metadata)}
+    if score is not None:
+        result["score"] = score
+    if rrf_score is not None:
+        result["rrf_score"] = rrf_score
+    return result
+
+
+def citation(metadata):
+    # Source path plus the record position kept by the streaming loaders, e.g. "data.csv (row 12)"
+    source = metadata.get("source", "")
+    for key in ("page", "row", "note"):
+        if key in metadata:
+            return f"{source} ({key} {metadata[key]})"
+    return source
+
+
+# The duckdb+parquet client behind Chroma stores is not safe for concurrent use from several threads.
+# Chroma stores share one client per process, so they share its lock; other stores get their own.
+# Re-entrant, since reloading the Chroma client (vector_store.chroma_client) takes it too.
+_store_locks = weakref.WeakKeyDictionary()
+_store_locks_guard = threading.Lock()
+
+
+def store_lock(db):
+    key = getattr(db, "_client", db)
+    with _store_locks_guard:
+        lock = _store_locks.get(key)
+        if lock is None:
+            lock = _store_locks[key] = threading.RLock()
+        return lock
+
+
+def distance_to_score(distance):
+    # Chroma returns squared L2 distances; for unit-length embeddings 1 - d/2 is the cosine similarity
+    return 1.0 - distance / 2.0
+
+
+def _query(db, vector, n_results, filter=None, embeddings=False):
+    # Queries the store's collection directly so scores, MMR and filters work from one lookup
+    include = ["documents", "metadatas", "distances"] + (["embeddings"] if embeddings else [])
+    with store_lock(db):
+        count = db._collection.count()
+        if count == 0:
+            return None
+        return db._collection.query(query_embeddings=[vector], n_results=min(n_results, count),
+                                    where=filter or None, include=include)
+
+
+def search_by_vector(db, vector, k=4, score_threshold=None, mmr=False, fetch_k=20, lambda_mult=0.5,
+                     filter: Optional[dict] = None) -> List[Tuple[Document, float]]:
+    results = _query(db, vector, max(fetch_k, k) if mmr else k, filter, embeddings=mmr)
+    if results is None:
+        return []
+    hits = [
+        (Document(page_content=text, metadata=metadata or {}), distance_to_score(distance))
+        for text, metadata, distance in zip(results["documents"][0], results["metadatas"][0], results["distances"][0])
+    ]
+    if mmr:
+        selected = maximal_marginal_relevance(np.array(vector, dtype=np.float32), results["embeddings"][0],
+                                              k=min(k, len(hits)), lambda_mult=lambda_mult)
+        hits = [hits[i] for i in selected]
+    if score_threshold is not None:
+        hits = [(doc, score) for doc, score in hits if score >= score_threshold]
+    return hits
+
+
+def hybrid_search_by_vector(db, index, query_text, vector, k=4, score_threshold=None, filter: Optional[dict] = None,
+                            candidates=None, similarities=False) -> List[Tuple[Document, float]]:
+    # Reciprocal rank fusion of the vector ranking and the BM25 ranking of the collection's lexical index,
+    # so exact identifiers and names found by BM25 make it into a small k. A collection without an index
+    # is ranked by vectors alone. Scores are fused RRF scores, comparable between collections but not
+    # with similarities. score_threshold applies to the similarity of every candidate, BM25 ones included,
+    # before they are ranked. With similarities, hits are (document, similarity, rrf_score) triples.
+    candidates = max(candidates or hybrid_candidates, k)
+    fused = {}  # chunk id -> [document, rrf score, similarity]
+    results = _query(db, vector, candidates, filter)
+    if results is not None:
+        vector_hits = zip(results["ids"][0], results["documents"][0], results["metadatas"][0], results["distances"][0])
+        rank = 0
+        for chunk_id, text, metadata, distance in vector_hits:
+            similarity = distance_to_score(distance)
+            if score_threshold is not None and similarity < score_threshold:
+                continue
+            fused[chunk_id] = [Document(page_content=text, metadata=metadata or {}), 1.0 / (rrf_k + rank + 1),
+                               similarity]
+            rank += 1
+    lexical_hits = index.search(query_text, candidates) if index is not None and query_text else []
+    missing = [chunk_id for chunk_id, _ in lexical_hits if chunk_id not in fused]
+    fetched = {}
+    if missing:
+        with store_lock(db):
+            records = db._collection.get(ids=missing, where=filter or None,
+                                         include=["documents", "metadatas", "embeddings"])
+        query = np.asarray(vector, dtype=np.float32)
+        for chunk_id, text, metadata, embedding in zip(records["ids"], records["documents"], records["metadatas"],
+                                                       records["embeddings"]):
+            # Scored like the store scores vector candidates, from the squared L2 distance
+            difference = np.asarray(embedding, dtype=np.float32) - query
+            fetched[chunk_id] = (Document(page_content=text, metadata=metadata or {}),
+                                 distance_to_score(float(difference @ difference)))
+    rank = 0
+    for chunk_id, _ in lexical_hits:
+        if chunk_id in fused:
+            fused[chunk_id][1] += 1.0 / (rrf_k + rank + 1)
+        elif chunk_id in fetched:
+            doc, similarity = fetched[chunk_id]
+            if score_threshold is not None and similarity < score_threshold:
+                continue
+            fused[chunk_id] = [doc, 1.0 / (rrf_k + rank + 1), similarity]
+        else:
+            # Excluded by the filter, or deleted from the store since the index was saved
+            continue
+        rank += 1
+    hits = sorted(fused.values(), key=lambda hit: hit[1], reverse=True)[:k]
+    if similarities:
+        return [(doc, similarity, score) for doc, score, similarity in hits]
+    return [(doc, score) for doc, score, _ in hits]
+
+
+def search(db, embeddings, query, **kwargs) -> List[Tuple[Document, float]]:
+    return search_by_vector(db, embeddings.embed_query(query), **kwargs)
+
+
+def collection_names(persist_directory):
+    # Every collection has its own directory under PERSIST_DIRECTORY, created when it is first ingested.
+    # Chroma keeps the HNSW indexes of all its collections in PERSIST_DIRECTORY/index.
+    try:
+        entries = sorted(os.listdir(persist_directory))
+    except (FileNotFoundError, TypeError):
+        return []
+    return [name for name in entries if name != "index" and os.path.isdir(os.path.join(persist_directory, name))]
+
+
+def resolve_collections(spec, persist_directory) -> List[str]:
+    # spec is a collection name, a comma-separated list or a list of names, any of which may be a
+    # shell-style wildcard such as "team-*"; wildcards match the collections on disk
+    patterns = spec if isinstance(spec, (list, tuple)) else (spec or "").split(",")
+    names = []
+    for pattern in (pattern.strip() for pattern in patterns):
+        if not pattern:
+            continue
+        if any(char in pattern for char in "*?["):
+            names.extend(fnmatch.filter(collection_names(persist_directory), pattern))
+        else:
+            names.append(pattern)
+    names = list(dict.fromkeys(names))
+    if not names:
+        raise ValueError(f"No collection matches {spec!r}")
+    return names
+
+
+_search_pool = None
+_search_pool_guard = threading.Lock()
+
+
+def _executor():
+    global _search_pool
+    with _search_pool_guard:
+        if _search_pool is None:
+            _search_pool = ThreadPoolExecutor(max_workers=federated_search_workers, thread_name_prefix="search")
+        return _search_pool
+
+
+def search_collections(names, open_db, vector, k=4, query_text=None, open_index=None, mode=None,
+                       similarities=False, **kwargs):
+    # Searches every named collection with one query vector, concurrently, and merges the hits
+    # into a global top-k by score. Each document's metadata gains the collection it came from.
+    # With query_text, hybrid mode (the default, see RETRIEVAL_MODE) fuses each collection's vector
+    # ranking with its BM25 index from open_index(name); MMR searches always rank by vectors alone.
+    # With similarities, hits are (document, similarity, rrf_score) triples, rrf_score being None
+    # when ranked by vectors alone.
+    # Returns the hits and {name: {"seconds": float, "hits": int}} for every collection searched.
+    mode = mode or retrieval_mode
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode {mode!r}")
+    hybrid = mode == "hybrid" and query_text is not None and not kwargs.get("mmr")
+
+    def search_one(name):
+        start = time.perf_counter()
+        if hybrid:
+            hits = hybrid_search_by_vector(open_db(name), open_index(name) if open_index else None, query_text,
+                                           vector, k=k, score_threshold=kwargs.get("score_threshold"),
+                                           filter=kwargs.get("filter"), similarities=similarities)
+        else:
+            hits = search_by_vector(open_db(name), vector, k=k, **kwargs)
+            if similarities:
+                hits = [(doc, score, None) for doc, score in hits]
+        return hits, time.perf_counter() - start
+
+    if len(names) == 1:
+        results = [search_one(names[0])]
+    else:
+        results = list(_executor().map(search_one, names))
+    merged = []
+    per_collection = {}
+    for name, (hits, seconds) in zip(names, results):
+        per_collection[name] = {"seconds": seconds, "hits": len(hits)}
+        for hit in hits:
+            hit[0].metadata["collection"] = name
+            merged.append(hit)
+    merged.sort(key=lambda hit: hit[-1] if hit[-1] is not None else hit[1], reverse=True)
+    return merged[:k], per_collection
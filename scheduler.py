@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from dotenv import load_dotenv
+
+from resources import registry
+from model_client import model_server_socket, model_server_connections
+
+load_dotenv()
+
+# Number of LLM instances loaded, each serving one generation at a time. Clients of a model server
+# instead run as many generations at once as they have connections; the server queues them for its instances.
+local_llm_instances = int(os.environ.get('LLM_INSTANCES', 1))
+llm_instances = model_server_connections if model_server_socket else local_llm_instances
+# Generation requests waiting beyond this are rejected with 429
+llm_queue_size = int(os.environ.get('LLM_QUEUE_SIZE', 16))
+# Default time a request may wait in the queue before it is answered with 503
+llm_queue_timeout_seconds = float(os.environ.get('LLM_QUEUE_TIMEOUT_SECONDS', 120))
+
+# Number of recent wait and generation times kept for percentiles
+_WINDOW = 1000
+
+
+class SchedulerRejected(Exception):
+    # Raised when a request can't be served now; retry_after is a hint in seconds
+    def __init__(self, message, retry_after, status):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status = status
+
+
+class QueueFull(SchedulerRejected):
+    def __init__(self, retry_after):
+        super().__init__("Generation queue is full", retry_after, 429)
+
+
+class DeadlineExceeded(SchedulerRejected):
+    def __init__(self, retry_after):
+        super().__init__("Request waited too long for a free model", retry_after, 503)
+
+
+class _Request:
+    def __init__(self, collection, fn):
+        self.collection = collection
+        self.fn = fn
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LLMScheduler:
+    # Owns a fixed number of LLM instances and feeds them generation requests from
+    # per-collection queues served round-robin, so one busy collection can't starve the rest.
+    # The instances come from registry, which holds the models.
+
+    def __init__(self, instances=llm_instances, max_queue=llm_queue_size, timeout_seconds=llm_queue_timeout_seconds,
+                 registry=registry):
+        self.instances = instances
+        self.registry = registry
+        self.max_queue = max_queue
+        self.timeout_seconds = timeout_seconds
+        self._queues = OrderedDict()  # collection -> deque of _Request, in round-robin order
+        self._depth = 0
+        self._condition = threading.Condition()
+        self._workers = []
+        self.wait_times = deque(maxlen=_WINDOW)
+        self.generation_times = deque(maxlen=_WINDOW)
+        self.completed = 0
+        self.rejected = 0
+        self.expired = 0
+        self.busy = 0
+
+    def _start(self):
+        # Worker threads, and with them the model instances, are created on first use
+        if self._workers:
+            return
+        for index in range(self.instances):
+            worker = threading.Thread(target=self._work, args=(index,), name=f"llm-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def run(self, collection, fn, timeout=None):
+        # Calls fn(llm) on a free instance and returns its result, waiting at most timeout in the queue
+        timeout = self.timeout_seconds if timeout is None else min(timeout, self.timeout_seconds)
+        request = _Request(collection or "", fn)
+        with self._condition:
+            self._start()
+            if self._depth >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(self.retry_after())
+            self._queues.setdefault(request.collection, deque()).append(request)
+            self._depth += 1
+            self._condition.notify()
+
+        # The deadline covers the wait in the queue only; once started, generation runs to completion
+        if not request.done.wait(timeout=timeout):
+            with self._condition:
+                if self._remove(request):
+                    self.expired += 1
+                    raise DeadlineExceeded(self.retry_after())
+            request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def check_capacity(self):
+        # Lets streaming endpoints reject before the response has started
+        with self._condition:
+            if self._depth >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(self.retry_after())
+
+    def _remove(self, request):
+        queue = self._queues.get(request.collection)
+        if queue is None or request not in queue:
+            return False
+        queue.remove(request)
+        self._depth -= 1
+        if not queue:
+            del self._queues[request.collection]
+        return True
+
+    def _next_request(self):
+        # Take the head of the first collection's queue, then move that collection to the back
+        collection, queue = next(iter(self._queues.items()))
+        request = queue.popleft()
+        self._depth -= 1
+        del self._queues[collection]
+        if queue:
+            self._queues[collection] = queue
+        return request
+
+    def _work(self, index):
+        llm = None
+        while True:
+            with self._condition:
+                while not self._queues:
+                    self._condition.wait()
+                request = self._next_request()
+                self.busy += 1
+            started = time.monotonic()
+            self.wait_times.append(started - request.enqueued_at)
+            try:
+                if llm is None:
+                    # The first instance is the registry's shared model, others are loaded separately
+                    llm = self.registry.llm() if index == 0 else self.registry.load_llm()
+                request.result = request.fn(llm)
+            except Exception as e:
+                request.error = e
+            finally:
+                self.generation_times.append(time.monotonic() - started)
+                with self._condition:
+                    self.busy -= 1
+                    self.completed += 1
+                request.done.set()
+
+    def retry_after(self):
+        # Rough time until a queued request would start: queue depth times mean generation time
+        mean = sum(self.generation_times) / len(self.generation_times) if self.generation_times else 10.0
+        return max(1, int(mean * (self._depth + 1) / max(self.instances, 1)))
+
+    def stats(self):
+        with self._condition:
+            per_collection = {name: len(queue) for name, queue in self._queues.items()}
+            return {
+                "instances": self.instances,
+                "busy": self.busy,
+                "queue_depth": self._depth,
+                "queue_limit": self.max_queue,
+                "queued_per_collection": per_collection,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "expired": self.expired,
+                "wait_seconds": _summary(self.wait_times),
+                "generation_seconds": _summary(self.generation_times),
+            }
+
+
+def _summary(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max": values[-1],
+    }
+
+
+scheduler = LLMScheduler()
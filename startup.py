@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from metrics import Timings
+
+load_dotenv()
+
+# background: the server answers at once while models load on a thread; eager: load before serving;
+# manual: nothing is loaded until warmup.start() or run() is called (tests, benchmarks)
+startup_mode = os.environ.get('STARTUP_MODE', 'background')
+# Also load the LLM during warm-up instead of on the first generation request
+warmup_llm = os.environ.get('WARMUP_LLM', '1').lower() in ('1', 'true', 'yes')
+
+# Heavy modules imported by the warm-up, in dependency order so each stage times only its own import
+WARMUP_IMPORTS = ("langchain", "chromadb", "resources", "vector_store", "ingest", "jobs", "retrieval",
+                  "answer_cache", "scheduler", "streaming", "qa")
+
+
+class Warmup:
+    # Runs the named startup steps in order, recording how long each took and whether it finished.
+    # A failed step is reported and the remaining steps still run, so endpoints that don't need
+    # it become ready; readiness of the whole service means every step finished.
+
+    def __init__(self):
+        self.steps = []
+        self.stages = OrderedDict()
+        self.step_states = OrderedDict()
+        self.errors = {}
+        self.state = "pending"
+        self.created_at = time.monotonic()
+        self.finished_at = None
+        self._ready = threading.Event()
+        self._thread = None
+        self._timings = Timings("startup")
+
+    def add(self, name, fn):
+        self.steps.append((name, fn))
+        self.step_states[name] = "pending"
+
+    def record(self, name, seconds):
+        # Steps timed outside the warm-up, such as importing the web app itself
+        self.stages[name] = seconds
+        self._timings.record(name, seconds)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+            self._thread.start()
+
+    def run(self):
+        self.state = "warming"
+        try:
+            for name, fn in self.steps:
+                self.step_states[name] = "running"
+                start = time.perf_counter()
+                try:
+                    fn()
+                except Exception as e:
+                    traceback.print_exc()
+                    self.step_states[name] = "failed"
+                    self.errors[name] = f"{type(e).__name__}: {e}"
+                    continue
+                self.record(name, time.perf_counter() - start)
+                self.step_states[name] = "ready"
+                print(f"Startup: {name} took {self.stages[name]:.2f}s")
+            self.state = "failed" if self.errors else "ready"
+            if not self.errors:
+                self._ready.set()
+        finally:
+            self.finished_at = time.monotonic()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def ready_for(self, steps):
+        # Whether the given steps have finished; steps that were never added, such as load_llm
+        # with WARMUP_LLM=0, don't hold anything up
+        return all(self.step_states.get(name, "ready") == "ready" for name in steps)
+
+    def failed(self, steps):
+        return {name: self.errors[name] for name in steps if name in self.errors}
+
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def status(self):
+        end = self.finished_at or time.monotonic()
+        return {
+            "state": self.state,
+            "ready": self.ready,
+            "uptime_seconds": time.monotonic() - self.created_at,
+            "warmup_seconds": end - self.created_at if self.state != "pending" else 0.0,
+            "stages": dict(self.stages),
+            "steps": dict(self.step_states),
+            "errors": dict(self.errors),
+        }
+
+
+warmup = Warmup()
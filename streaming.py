@@ -0,0 +1,66 @@
+import json
+import queue
+import threading
+import time
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+# Sentinel pushed to the token queue when generation ends
+_DONE = object()
+
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    # Forwards generated tokens to a queue read by the HTTP response instead of stdout
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.queue.put(token)
+
+
+class TokenCounter(BaseCallbackHandler):
+    def __init__(self):
+        self.tokens = 0
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.tokens += 1
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_generation(generate, timings):
+    # Runs generate(callbacks) on a background thread and yields its tokens as they arrive.
+    # timings is filled with first-token and generation times once the stream is exhausted.
+    handler = QueueCallbackHandler()
+    errors = []
+
+    def run():
+        try:
+            generate([handler])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            handler.queue.put(_DONE)
+
+    start = time.perf_counter()
+    tokens = 0
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while True:
+        token = handler.queue.get()
+        if token is _DONE:
+            break
+        if tokens == 0:
+            timings["first_token_seconds"] = time.perf_counter() - start
+        tokens += 1
+        yield token
+    thread.join()
+    elapsed = time.perf_counter() - start
+    timings["generation_seconds"] = elapsed
+    timings["tokens"] = tokens
+    timings["tokens_per_second"] = tokens / elapsed if elapsed > 0 else 0.0
+    if errors:
+        raise errors[0]
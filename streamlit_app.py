@@ -2,103 +2,242 @@ from dotenv import load_dotenv
 import os
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 from typing import List
 import json
 import socket
 from urllib3.connection import HTTPConnection
 
+load_dotenv()
+
 API_BASE_URL = os.environ.get("API_BASE_URL")
 
-load_dotenv()
+# Seconds between status requests while embed jobs are running
+job_poll_seconds = float(os.environ.get('STREAMLIT_JOB_POLL_SECONDS', 1.5))
+# The collection list is fetched again after this long, or right away after an embed job finishes
+collections_ttl_seconds = float(os.environ.get('STREAMLIT_COLLECTIONS_TTL_SECONDS', 60))
+
+# Seconds to wait for the backend to accept a connection; answers may then stream for much longer
+CONNECT_TIMEOUT = 10
+# Finished jobs still shown under the upload form
+FINISHED_JOBS_SHOWN = 5
+FINISHED_STATES = ("completed", "failed", "cancelled")
+
+# Keep-alive probes so a long generation isn't cut off by idle connection timeouts
+KEEPALIVE_SOCKET_OPTIONS = [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    # (socket.SOL_TCP, socket.TCP_KEEPIDLE, 45),
+    (socket.SOL_TCP, socket.TCP_KEEPINTVL, 10),
+    (socket.SOL_TCP, socket.TCP_KEEPCNT, 6),
+]
 
-embeddings_model_name = os.environ.get("EMBEDDINGS_MODEL_NAME")
-persist_directory = os.environ.get('PERSIST_DIRECTORY')
 
-from constants import CHROMA_SETTINGS
-import chromadb
+class KeepAliveAdapter(HTTPAdapter):
+    # Sets the keep-alive options on this adapter's connections only, instead of on urllib3's global defaults
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + KEEPALIVE_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
 
+
+@st.cache_resource
+def http_session():
+    # One pooled session for the whole Streamlit server, reused by every rerun and browser tab
+    session = requests.Session()
+    adapter = KeepAliveAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+@st.cache_data(ttl=collections_ttl_seconds, show_spinner=False)
 def list_of_collections():
-    client = chromadb.Client(CHROMA_SETTINGS)
-    return (client.list_collections())
-    
+    # Collection summaries from the backend, which reads them without opening any store
+    response = http_session().get(f"{API_BASE_URL}/collections", timeout=CONNECT_TIMEOUT)
+    response.raise_for_status()
+    return response.json()["collections"]
+
+
+def refresh_collections():
+    list_of_collections.clear()
+
+
 def main():
     st.title("PrivateGPT App: Document Embedding and Retrieval")
-    
+    # job id -> last known status of embed jobs started from this browser session
+    st.session_state.setdefault("jobs", {})
+
     # Document upload section
     st.header("Document Upload")
     files = st.file_uploader("Upload document", accept_multiple_files=True)
 
     project_name = st.selectbox(label="project",options=["ai_story","general"])
-    # collection_name = st.text_input("Collection Name") not working for some reason
-    collection_name = "ai_story"
+    collection_name = st.text_input("Collection Name", value="ai_story")
 
-    if st.button("Embed"):
+    if st.button("Embed", disabled=not files or not collection_name):
         embed_documents(files, project_name,collection_name)
-    
+    show_jobs()
+
     # Query section
     st.header("Document Retrieval")
+    collection_column, refresh_column = st.columns([5, 1])
+    if refresh_column.button("Refresh"):
+        refresh_collections()
     collection_names = get_collection_names()
-    selected_collection = st.selectbox("Select a document", collection_names)
+    selected_collection = collection_column.selectbox("Select a document", collection_names)
     if selected_collection:
         query = st.text_input("Query")
-        if st.button("Retrieve"):
+        if st.button("Retrieve") and query:
             retrieve_documents(query, selected_collection)
+        else:
+            show_answer(st.session_state.get("answer"))
 
 def embed_documents(files:List[st.runtime.uploaded_file_manager.UploadedFile], project_name:str,collection_name:str):
     endpoint = f"{API_BASE_URL}/embed2"
-    files_data = [("files", file) for file in files]
+    files_data = [("files", (file.name, file, file.type)) for file in files]
     data = {"collection_name": collection_name,
             "project_name": project_name
             }
 
-    response = requests.post(endpoint, files=files_data, data=data)
-    if response.status_code == 200:
-        st.success("Documents embedded successfully!")
+    try:
+        response = http_session().post(endpoint, files=files_data, data=data, timeout=(CONNECT_TIMEOUT, None))
+    except requests.RequestException as e:
+        st.error(f"Document embedding failed: {e}")
+        return
+    if response.status_code in (200, 202):
+        result = response.json()
+        skipped = result.get("skipped_files", [])
+        if skipped:
+            st.info("Skipped " + ", ".join(f"{file['filename']} ({file['reason']})" for file in skipped))
+        if result.get("job_id"):
+            st.session_state["jobs"][result["job_id"]] = {"job_id": result["job_id"], "state": "queued",
+                                                          "collection_name": collection_name, "progress": {}}
     else:
         st.error("Document embedding failed.")
         st.write(response.text)
 
-    print("Completed")
 
+def poll_job(job):
+    try:
+        response = http_session().get(f"{API_BASE_URL}/jobs/{job['job_id']}", timeout=CONNECT_TIMEOUT)
+    except requests.RequestException:
+        return job
+    if response.status_code == 404:
+        # Finished jobs are forgotten by the backend after a while
+        return dict(job, state="failed", error="job no longer known to the backend")
+    return response.json() if response.ok else job
+
+
+@st.fragment(run_every=job_poll_seconds)
+def show_jobs():
+    # Reruns on its own every job_poll_seconds, without blocking or rerunning the rest of the page
+    jobs = st.session_state["jobs"]
+    completed = False
+    for job_id, job in list(jobs.items()):
+        if job["state"] not in FINISHED_STATES:
+            job = jobs[job_id] = poll_job(job)
+            completed = completed or job["state"] == "completed"
+        progress = job.get("progress") or {}
+        label = f"{job['collection_name']}: {job['state']}"
+        if job["state"] == "failed":
+            st.error(f"{label} ({job.get('error')})")
+        elif job["state"] in FINISHED_STATES:
+            st.success(f"{label}, {progress.get('chunks_persisted', 0)} chunks from "
+                       f"{progress.get('files_loaded', 0)} files")
+        else:
+            total = progress.get("chunks_total") or 0
+            st.progress(progress.get("chunks_persisted", 0) / total if total else 0.0,
+                        text=f"{label}, {progress.get('files_loaded', 0)}/{progress.get('files_found', 0)} files "
+                             f"loaded, {progress.get('chunks_persisted', 0)}/{total} chunks embedded")
+    finished = [job_id for job_id, job in jobs.items() if job["state"] in FINISHED_STATES]
+    for job_id in finished[:-FINISHED_JOBS_SHOWN]:
+        del jobs[job_id]
+    if completed:
+        # New chunks change the collection's counts, and a new collection must appear in the list
+        refresh_collections()
+        st.rerun()
 
-def get_collection_names():
 
-    collections = list_of_collections()
-    print(collections)
-    return ["ai_story","general"]
-    # return [collection.name for collection in collections]
+def get_collection_names():
+    try:
+        collections = list_of_collections()
+    except requests.RequestException as e:
+        st.error(f"Could not list collections: {e}")
+        return []
+    return [collection["name"] for collection in collections]
 
 
 
 def retrieve_documents(query: str, collection_name: str):
-    endpoint = f"{API_BASE_URL}/retrieve"
+    endpoint = f"{API_BASE_URL}/retrieve/stream"
     data = {"query": query, "collection_name": collection_name}
 
-    print(data)
-
-    # Modify socket options for the HTTPConnection class
-    HTTPConnection.default_socket_options = (
-        HTTPConnection.default_socket_options + [
-            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
-            # (socket.SOL_TCP, socket.TCP_KEEPIDLE, 45),
-            (socket.SOL_TCP, socket.TCP_KEEPINTVL, 10),
-            (socket.SOL_TCP, socket.TCP_KEEPCNT, 6)
-        ]
-    )
-    
-    response = requests.post(endpoint, params=data)
-    if response.status_code == 200:
-        result = response.json()
-        st.subheader("Results")
-        st.text(result["results"])
-        
-        st.subheader("Documents")
-        for doc in result["docs"]:
-            st.text(doc)
-    else:
-        st.error("Failed to retrieve documents.")
-        st.write(response.text)
+    # Kept in the session so the answer stays on screen across reruns
+    answer = st.session_state["answer"] = {"query": query, "docs": [], "text": "", "error": None, "timings": None}
+    try:
+        with http_session().post(endpoint, data=data, stream=True, timeout=(CONNECT_TIMEOUT, None)) as response:
+            if response.status_code != 200:
+                st.session_state["answer"] = None
+                st.error("Failed to retrieve documents.")
+                st.write(response.text)
+                return
+
+            st.subheader("Results")
+            answer_placeholder = st.empty()
+            documents_container = st.container()
+            for event, payload in read_events(response):
+                if event == "sources":
+                    answer["docs"] = payload["docs"]
+                    with documents_container:
+                        show_documents(answer["docs"])
+                elif event == "token":
+                    answer["text"] += payload["token"]
+                    answer_placeholder.text(answer["text"])
+                elif event == "error":
+                    answer["error"] = payload["message"]
+                    st.error(answer["error"])
+                elif event == "done":
+                    answer["timings"] = payload["timings"]
+                    show_timings(answer["timings"])
+    except requests.RequestException as e:
+        answer["error"] = str(e)
+        st.error(f"Failed to retrieve documents: {e}")
+
+
+def show_answer(answer):
+    if not answer:
+        return
+    st.subheader("Results")
+    st.text(answer["text"])
+    show_documents(answer["docs"])
+    if answer["error"]:
+        st.error(answer["error"])
+    if answer["timings"]:
+        show_timings(answer["timings"])
+
+
+def show_documents(docs):
+    st.subheader("Documents")
+    for doc in docs:
+        st.text(f"{doc['citation']}:\n{doc['page_content']}")
+
+
+def show_timings(timings):
+    st.caption(f"First token after {timings.get('first_token_seconds', 0):.1f}s, "
+               f"{timings['tokens']} tokens in {timings['total_seconds']:.1f}s")
+
+
+def read_events(response):
+    # Parses a server-sent event stream into (event, data) pairs
+    event, data = None, []
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+        elif not line and event is not None:
+            yield event, json.loads("\n".join(data))
+            event, data = None, []
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
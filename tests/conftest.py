@@ -0,0 +1,69 @@
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Project modules read their settings at import, so the environment is set before any of them is
+# imported. Every test shares one PERSIST_DIRECTORY (the Chroma client is process-wide) and uses
+# collections of its own.
+_workdir = tempfile.mkdtemp(prefix="privategpt-tests-")
+os.environ.update(
+    PERSIST_DIRECTORY=os.path.join(_workdir, "db"),
+    EMBEDDINGS_MODEL_NAME="test-fake",
+    EMBEDDING_CACHE_DIR=os.path.join(_workdir, "embedding_cache"),
+    EMBEDDING_CACHE_MAX_ENTRIES="0",
+    EXTRACTION_CACHE_DIR=os.path.join(_workdir, "extraction_cache"),
+    EXTRACTION_CACHE_MAX_MB="0",
+    STARTUP_MODE="manual",
+)
+
+
+@pytest.fixture
+def embeddings():
+    from benchmarks.fakes import FakeEmbeddings
+    return FakeEmbeddings(dim=32)
+
+
+@pytest.fixture(params=["chroma", "mmap"])
+def backend(request, monkeypatch):
+    # Backend of the collections the test creates
+    import vector_store
+    monkeypatch.setattr(vector_store, "vector_store_backend", request.param)
+    return request.param
+
+
+@pytest.fixture
+def collection():
+    return f"test-{uuid.uuid4().hex[:12]}"
+
+
+class Project:
+    # Source files of an ingest project, under source_documents/<name> of the test's working directory
+
+    def __init__(self, name):
+        self.name = name
+        self.directory = os.path.join("source_documents", name)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def write(self, file_name, text):
+        with open(self.path(file_name), "w") as f:
+            f.write(text)
+        return self.path(file_name)
+
+    def remove(self, file_name):
+        os.remove(self.path(file_name))
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    # Manifests record source paths relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return Project("project")
@@ -0,0 +1,153 @@
+import os
+
+import pytest
+
+from extraction_cache import extraction_cache
+from ingest import run_ingest
+from manifest import Manifest, file_hash
+from vector_store import stored_collection, stored_dtype
+
+
+def collection_directory(collection):
+    return os.path.join(os.environ["PERSIST_DIRECTORY"], collection)
+
+
+def stored_chunks(collection):
+    # chunk id -> (text, source) of every chunk in the collection's store
+    records = stored_collection(collection, collection_directory(collection)).get(include=["documents", "metadatas"])
+    return {chunk_id: (text, metadata["source"])
+            for chunk_id, text, metadata in zip(records["ids"], records["documents"], records["metadatas"])}
+
+
+def manifest_chunk_ids(collection):
+    manifest = Manifest(collection_directory(collection))
+    return [chunk_id for entry in manifest.files.values() for chunk_id in entry["chunk_ids"]]
+
+
+def assert_manifest_matches_store(collection):
+    # Every stored chunk belongs to exactly one manifest entry, and every recorded chunk is stored
+    recorded = manifest_chunk_ids(collection)
+    assert len(recorded) == len(set(recorded))
+    assert set(recorded) == set(stored_chunks(collection))
+
+
+def ingest(collection, project, embeddings, **options):
+    return run_ingest(collection, project.name, embeddings=embeddings, **options)
+
+
+def test_unchanged_files_are_skipped(backend, collection, project, embeddings):
+    for index in range(3):
+        project.write(f"file{index}.txt", f"document {index} about apples")
+    assert ingest(collection, project, embeddings).files_found == 3
+    chunks = stored_chunks(collection)
+
+    # Touched but identical files are compared by content and skipped too
+    os.utime(project.path("file0.txt"), (0, 0))
+    progress = ingest(collection, project, embeddings)
+
+    assert progress.files_found == 0
+    assert progress.chunks_persisted == 0
+    assert stored_chunks(collection) == chunks
+    assert_manifest_matches_store(collection)
+
+
+def test_changed_file_is_embedded_again(backend, collection, project, embeddings):
+    project.write("kept.txt", "a file that stays the same")
+    changed = project.write("changed.txt", "the first version")
+    ingest(collection, project, embeddings)
+
+    project.write("changed.txt", "the second, longer version of the file")
+    progress = ingest(collection, project, embeddings)
+
+    assert progress.files_found == 1
+    texts = {source: [] for source in (changed, project.path("kept.txt"))}
+    for text, source in stored_chunks(collection).values():
+        texts[source].append(text)
+    assert texts[changed] == ["the second, longer version of the file"]
+    assert texts[project.path("kept.txt")] == ["a file that stays the same"]
+    assert_manifest_matches_store(collection)
+
+
+def test_removed_file_chunks_are_deleted(backend, collection, project, embeddings):
+    project.write("kept.txt", "a file that stays")
+    removed = project.write("removed.txt", "a file that is deleted")
+    ingest(collection, project, embeddings)
+
+    project.remove("removed.txt")
+    ingest(collection, project, embeddings)
+
+    assert removed not in {source for _, source in stored_chunks(collection).values()}
+    assert removed not in Manifest(collection_directory(collection)).files
+    assert_manifest_matches_store(collection)
+
+
+def test_empty_file_is_recorded_without_chunks(backend, collection, project, embeddings):
+    project.write("text.txt", "some text")
+    empty = project.write("empty.csv", "header\n")
+    ingest(collection, project, embeddings)
+
+    entry = Manifest(collection_directory(collection)).files[empty]
+    assert entry["hash"] is not None and entry["chunk_ids"] == []
+    assert ingest(collection, project, embeddings).files_found == 0
+
+
+def test_changed_chunk_settings_need_a_full_rebuild(backend, collection, project, embeddings):
+    project.write("file.txt", "some text " * 100)
+    ingest(collection, project, embeddings, chunk_size=200, chunk_overlap=0)
+
+    with pytest.raises(ValueError, match="--full-rebuild"):
+        ingest(collection, project, embeddings, chunk_size=100, chunk_overlap=0)
+
+    ingest(collection, project, embeddings, chunk_size=100, chunk_overlap=0, full_rebuild=True)
+    assert Manifest(collection_directory(collection)).settings == {"chunk_size": 100, "chunk_overlap": 0}
+    assert_manifest_matches_store(collection)
+
+
+def test_quantize_converts_stored_vectors(backend, collection, project, embeddings, monkeypatch):
+    for index in range(3):
+        project.write(f"file{index}.txt", f"document {index} about pears")
+    ingest(collection, project, embeddings)
+    chunks = stored_chunks(collection)
+
+    def no_embedding(texts):
+        raise AssertionError("converted vectors must not be embedded again")
+
+    monkeypatch.setattr(embeddings, "embed_documents", no_embedding)
+    ingest(collection, project, embeddings, quantize="int8")
+
+    assert stored_dtype(collection, collection_directory(collection)) == "int8"
+    assert stored_chunks(collection) == chunks
+    assert_manifest_matches_store(collection)
+
+
+def test_cached_extraction_hashes_each_file_once(backend, collection, project, embeddings, tmp_path, monkeypatch):
+    monkeypatch.setattr(extraction_cache, "directory", str(tmp_path / "extraction_cache"))
+    monkeypatch.setattr(extraction_cache, "max_bytes", 1 << 20)
+    # Text files aren't cached normally, but need no optional parser
+    monkeypatch.setattr("ingest.EXTRACTION_CACHED", {".txt"})
+    hashed = []
+
+    def counting_hash(file_path):
+        hashed.append(file_path)
+        return file_hash(file_path)
+
+    monkeypatch.setattr("manifest.file_hash", counting_hash)
+    monkeypatch.setattr("extraction_cache.file_hash", counting_hash)
+    notes = project.write("notes.txt", "some text worth caching")
+    ingest(collection, project, embeddings)
+
+    assert hashed == [notes]
+    assert extraction_cache.stats()["entries"] == 1
+
+
+def test_uploads_are_recorded_under_their_source_name(backend, collection, project, embeddings, tmp_path):
+    staged = tmp_path / "uploads" / "request" / "notes.txt"
+    staged.parent.mkdir(parents=True)
+    staged.write_text("the first upload")
+    ingest(collection, project, embeddings, delete_missing=False, files={"project/notes.txt": str(staged)})
+
+    staged.write_text("the changed upload, sent again")
+    ingest(collection, project, embeddings, delete_missing=False, files={"project/notes.txt": str(staged)})
+
+    assert list(stored_chunks(collection).values()) == [("the changed upload, sent again", "project/notes.txt")]
+    assert_manifest_matches_store(collection)
@@ -0,0 +1,214 @@
+import threading
+import time
+
+import pytest
+
+import jobs
+from jobs import IngestJobQueue, QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED
+
+
+class StubIngest:
+    # Stands in for run_ingest: reports some progress, then holds each run until its collection is let go
+
+    def __init__(self):
+        self.calls = []
+        self.started = set()
+        self.gates = {}
+        self.running = {}
+        self.max_running = {}
+        self.error = None
+        self._lock = threading.Lock()
+
+    def gate(self, collection):
+        with self._lock:
+            return self.gates.setdefault(collection, threading.Event())
+
+    def __call__(self, collection, project_name, embeddings=None, progress=None, delete_missing=True, files=None):
+        with self._lock:
+            self.calls.append({"collection": collection, "project_name": project_name, "embeddings": embeddings,
+                               "delete_missing": delete_missing, "files": files})
+            self.running[collection] = self.running.get(collection, 0) + 1
+            self.max_running[collection] = max(self.max_running.get(collection, 0), self.running[collection])
+            self.started.add(collection)
+        try:
+            progress.files_found = len(files)
+            progress.chunks_total = 10
+            progress.chunks_persisted = 4
+            gate = self.gate(collection)
+            while not gate.wait(0.01):
+                progress.check_cancelled()
+            progress.check_cancelled()
+            if self.error is not None:
+                raise self.error
+            progress.chunks_persisted = 10
+            return progress
+        finally:
+            with self._lock:
+                self.running[collection] -= 1
+
+    def wait_started(self, collection):
+        wait_for(lambda: collection in self.started)
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = StubIngest()
+    monkeypatch.setattr(jobs, "run_ingest", stub)
+    monkeypatch.setattr(jobs.registry, "embeddings", lambda: "embeddings")
+    return stub
+
+
+@pytest.fixture
+def released(monkeypatch):
+    # Collections whose pooled store was released and whose cached answers were invalidated
+    released = {"stores": [], "answers": []}
+    monkeypatch.setattr(jobs.registry, "release", released["stores"].append)
+    monkeypatch.setattr(jobs.answer_cache, "invalidate", released["answers"].append)
+    return released
+
+
+@pytest.fixture
+def queue(stub, released):
+    queue = IngestJobQueue(workers=2, retention_seconds=60)
+    yield queue
+    for gate in list(stub.gates.values()):
+        gate.set()
+    for job in queue.list():
+        queue.cancel(job.id)
+    queue._executor.shutdown(wait=True)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def wait_finished(job):
+    # finished_at is set after the job's final state
+    wait_for(lambda: job.finished_at is not None)
+
+
+class Cleanup:
+    # Staged upload cleanup; a job calls it last, after releasing its collection
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+
+
+def test_submitted_job_reports_progress_until_completed(queue, stub, released):
+    cleanup = Cleanup()
+    files = {"project/notes.txt": "uploads/project/request/notes.txt"}
+    job = queue.submit("docs", "project", files, cleanup=cleanup)
+    assert queue.get(job.id) is job
+    stub.wait_started("docs")
+
+    status = job.to_dict()
+    assert status["state"] == RUNNING
+    assert status["files"] == ["project/notes.txt"]
+    assert status["progress"]["files_found"] == 1
+    assert status["progress"]["chunks_persisted"] == 4
+
+    stub.gate("docs").set()
+    wait_for(lambda: cleanup.calls)
+    assert job.state == COMPLETED
+    assert job.to_dict()["progress"]["chunks_persisted"] == 10
+    # Uploads are ingested with the registry's model, and other files' chunks are kept
+    assert stub.calls == [{"collection": "docs", "project_name": "project", "embeddings": "embeddings",
+                           "delete_missing": False, "files": files}]
+    assert cleanup.calls == 1
+    assert released == {"stores": ["docs"], "answers": ["docs"]}
+
+
+def test_cancelled_queued_job_never_runs(stub, released):
+    queue = IngestJobQueue(workers=1, retention_seconds=60)
+    cleanup = Cleanup()
+    running = queue.submit("docs", "project", {})
+    stub.wait_started("docs")
+    queued = queue.submit("other", "project", {}, cleanup=cleanup)
+    assert queued.state == QUEUED
+
+    assert queue.cancel(queued.id) is queued
+    stub.gate("docs").set()
+    wait_finished(running)
+    wait_finished(queued)
+    queue._executor.shutdown(wait=True)
+
+    assert queued.state == CANCELLED
+    assert [call["collection"] for call in stub.calls] == ["docs"]
+    assert cleanup.calls == 1
+    assert released["stores"] == ["docs"]
+
+
+def test_cancelled_running_job_stops_and_releases_the_collection(queue, stub, released):
+    cleanup = Cleanup()
+    job = queue.submit("docs", "project", {}, cleanup=cleanup)
+    stub.wait_started("docs")
+
+    queue.cancel(job.id)
+    wait_for(lambda: cleanup.calls)
+
+    assert job.state == CANCELLED
+    assert cleanup.calls == 1
+    assert released == {"stores": ["docs"], "answers": ["docs"]}
+
+
+def test_failed_job_records_the_error_and_releases_the_collection(queue, stub, released):
+    stub.error = RuntimeError("disk full")
+    stub.gate("docs").set()
+    cleanup = Cleanup()
+    job = queue.submit("docs", "project", {}, cleanup=cleanup)
+    wait_for(lambda: cleanup.calls)
+
+    assert job.state == FAILED
+    assert job.error == "disk full"
+    assert cleanup.calls == 1
+    assert released == {"stores": ["docs"], "answers": ["docs"]}
+
+
+def test_jobs_for_one_collection_run_one_at_a_time(queue, stub):
+    first = queue.submit("docs", "project", {})
+    second = queue.submit("docs", "project", {})
+    other = queue.submit("other", "project", {})
+    stub.wait_started("docs")
+    # The second worker can't take the collection, so the other collection's job waits behind it
+    time.sleep(0.1)
+    assert second.state == QUEUED
+
+    stub.gate("docs").set()
+    wait_finished(first)
+    wait_finished(second)
+    stub.gate("other").set()
+    wait_finished(other)
+
+    assert [job.state for job in (first, second, other)] == [COMPLETED] * 3
+    assert stub.max_running["docs"] == 1
+
+
+def test_collection_lock_holds_jobs_back(queue, stub):
+    stub.gate("docs").set()
+    with queue.collection_lock("docs"):
+        job = queue.submit("docs", "project", {})
+        time.sleep(0.1)
+        assert job.state == QUEUED
+    wait_finished(job)
+    assert job.state == COMPLETED
+
+
+def test_finished_jobs_are_forgotten_after_the_retention_period(queue, stub):
+    stub.gate("docs").set()
+    old = queue.submit("docs", "project", {})
+    recent = queue.submit("docs", "project", {})
+    wait_finished(old)
+    wait_finished(recent)
+    old.finished_at = time.time() - 120
+    running = queue.submit("other", "project", {})
+    stub.wait_started("other")
+    running.created_at = time.time() - 120
+
+    assert {job.id for job in queue.list()} == {recent.id, running.id}
+    assert queue.get(old.id) is None
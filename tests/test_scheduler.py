@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+from resources import registry
+from scheduler import LLMScheduler, QueueFull, DeadlineExceeded
+
+
+@pytest.fixture(autouse=True)
+def fake_llm(monkeypatch):
+    monkeypatch.setattr(registry, "llm", lambda: "llm-0")
+    monkeypatch.setattr(registry, "load_llm", lambda: "llm-n")
+
+
+class Blocker:
+    # A generation that holds its model instance until released
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, llm):
+        self.started.set()
+        assert self.release.wait(10)
+        return llm
+
+
+def run_in_thread(scheduler, collection, fn, **kwargs):
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = scheduler.run(collection, fn, **kwargs)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, outcome
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_runs_on_a_free_instance():
+    scheduler = LLMScheduler(instances=1, max_queue=2, timeout_seconds=5)
+    assert scheduler.run("docs", lambda llm: f"answer from {llm}") == "answer from llm-0"
+    assert scheduler.stats()["completed"] == 1
+
+
+def test_full_queue_is_rejected_with_429():
+    scheduler = LLMScheduler(instances=1, max_queue=1, timeout_seconds=5)
+    busy = Blocker()
+    running, _ = run_in_thread(scheduler, "docs", busy)
+    assert busy.started.wait(5)
+    queued, queued_outcome = run_in_thread(scheduler, "docs", lambda llm: "queued")
+    wait_for(lambda: scheduler.stats()["queue_depth"] == 1)
+
+    with pytest.raises(QueueFull) as rejected:
+        scheduler.run("other", lambda llm: "rejected")
+    assert rejected.value.status == 429
+    assert rejected.value.retry_after >= 1
+    with pytest.raises(QueueFull):
+        scheduler.check_capacity()
+    assert scheduler.stats()["rejected"] == 2
+
+    busy.release.set()
+    running.join(5)
+    queued.join(5)
+    assert queued_outcome == {"result": "queued"}
+    assert scheduler.stats()["queue_depth"] == 0
+
+
+def test_request_waiting_past_its_deadline_gets_503():
+    scheduler = LLMScheduler(instances=1, max_queue=4, timeout_seconds=5)
+    busy = Blocker()
+    running, _ = run_in_thread(scheduler, "docs", busy)
+    assert busy.started.wait(5)
+
+    with pytest.raises(DeadlineExceeded) as expired:
+        scheduler.run("docs", lambda llm: "too late", timeout=0.05)
+    assert expired.value.status == 503
+    stats = scheduler.stats()
+    assert stats["expired"] == 1
+    # The expired request left the queue, so it never runs
+    assert stats["queue_depth"] == 0
+
+    busy.release.set()
+    running.join(5)
+    assert scheduler.run("docs", lambda llm: "next") == "next"
+    assert scheduler.stats()["completed"] == 2
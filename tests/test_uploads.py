@@ -0,0 +1,51 @@
+import io
+import os
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from uploads import StagedUpload
+
+
+def upload(filename, text):
+    return FileStorage(stream=io.BytesIO(text.encode()), filename=filename)
+
+
+@pytest.fixture
+def staged(collection, project):
+    staged = StagedUpload(collection, project.name)
+    yield staged
+    staged.cleanup()
+
+
+def test_files_get_source_names_under_the_project(staged):
+    assert staged.save(upload("notes.txt", "some notes")) == "project/notes.txt"
+    assert staged.saved_files == ["project/notes.txt"]
+    with open(staged.files["project/notes.txt"]) as f:
+        assert f.read() == "some notes"
+
+
+def test_second_file_of_the_same_name_is_skipped(staged):
+    staged.save(upload("notes.txt", "the first file"))
+    assert staged.save(upload("notes.txt", "another file of the same name")) is None
+
+    assert staged.saved_files == ["project/notes.txt"]
+    assert staged.skipped == [{"filename": "notes.txt", "hash": None, "reason": "duplicate filename"}]
+    with open(staged.files["project/notes.txt"]) as f:
+        assert f.read() == "the first file"
+
+
+def test_identical_content_is_skipped(staged):
+    staged.save(upload("notes.txt", "the same text"))
+    assert staged.save(upload("copy.txt", "the same text")) is None
+    assert staged.skipped[0]["reason"] == "duplicate upload"
+    assert os.listdir(staged.directory) == ["notes.txt"]
+
+
+def test_failing_open_raises_its_own_error(staged, monkeypatch):
+    def refuse(*args, **kwargs):
+        raise PermissionError("no writing here")
+
+    monkeypatch.setattr("uploads.open", refuse, raising=False)
+    with pytest.raises(PermissionError, match="no writing here"):
+        staged.save(upload("notes.txt", "some notes"))
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from vector_store import MmapCollection
+
+
+def unit_vectors(count, dim=16, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture(params=["float32", "float16", "int8"])
+def store(request, tmp_path):
+    collection = MmapCollection(str(tmp_path / "mmap_store"), dtype=request.param, hnsw=False)
+    yield collection
+    collection.close()
+
+
+def add_chunks(store, count):
+    ids = [f"chunk-{index}" for index in range(count)]
+    vectors = unit_vectors(count)
+    store.add(ids=ids, embeddings=vectors, documents=[f"text {index}" for index in range(count)],
+              metadatas=[{"source": f"file{index % 3}.txt"} for index in range(count)])
+    return ids, vectors
+
+
+def nearest_ids(store, vector, k):
+    return store.query(query_embeddings=[vector], n_results=k, include=["documents"])["ids"][0]
+
+
+def test_deleted_chunks_stop_matching(store):
+    ids, vectors = add_chunks(store, 30)
+    store.delete(ids=ids[:5])
+    store.delete(where={"source": "file2.txt"})
+
+    deleted = set(ids[:5]) | {chunk_id for index, chunk_id in enumerate(ids) if index % 3 == 2}
+    assert store.count() == 30 - len(deleted)
+    for index in range(30):
+        assert not deleted & set(nearest_ids(store, vectors[index], 30))
+    assert store.get(ids=sorted(deleted), include=[])["ids"] == []
+    # Rows stay in the files until the collection is compacted
+    assert store.memory()["rows"] == 30
+
+
+def test_compact_keeps_live_chunks(store):
+    ids, vectors = add_chunks(store, 40)
+    deleted = ids[::2]
+    store.delete(ids=deleted)
+    before = {index: nearest_ids(store, vectors[index], 3) for index in range(1, 40, 2)}
+
+    result = store.compact()
+
+    assert result["rows_before"] == 40 and result["rows"] == 20
+    assert store.memory()["rows"] == 20
+    assert store.count() == 20
+    for index, nearest in before.items():
+        assert nearest_ids(store, vectors[index], 3) == nearest
+    records = store.get(ids=ids[1::2], include=["documents", "metadatas"])
+    assert sorted(records["documents"]) == sorted(f"text {index}" for index in range(1, 40, 2))
+
+    # New chunks are appended after the compacted rows
+    store.add(ids=["new"], embeddings=unit_vectors(1, seed=1), documents=["new text"])
+    assert nearest_ids(store, unit_vectors(1, seed=1)[0], 1) == ["new"]
+    assert store.count() == 21
+
+
+def test_compact_without_deletions_changes_nothing(store):
+    add_chunks(store, 10)
+    result = store.compact()
+    assert result["rows_before"] == result["rows"] == 10
+    assert result["bytes"] == result["bytes_before"]
+
+
+def test_reopened_store_finds_chunks_with_hnsw(tmp_path):
+    store = MmapCollection(str(tmp_path / "mmap_store"), hnsw=True)
+    ids, vectors = add_chunks(store, 50)
+    store.persist()
+    store.close()
+
+    reopened = MmapCollection(str(tmp_path / "mmap_store"), hnsw=True)
+    try:
+        assert reopened.count() == 50
+        for index in range(0, 50, 7):
+            assert nearest_ids(reopened, vectors[index], 1) == [ids[index]]
+        # Chunks added after the graph was saved are found too
+        reopened.add(ids=["new"], embeddings=unit_vectors(1, seed=1), documents=["new text"])
+        assert nearest_ids(reopened, unit_vectors(1, seed=1)[0], 1) == ["new"]
+    finally:
+        reopened.close()
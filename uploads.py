@@ -0,0 +1,130 @@
+import contextlib
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+from dotenv import load_dotenv
+from werkzeug.utils import secure_filename
+
+from manifest import Manifest
+
+load_dotenv()
+
+persist_directory = os.environ.get('PERSIST_DIRECTORY')
+# Uploads are staged under <UPLOAD_DIRECTORY>/<project>/<request id> until their job has ingested them
+upload_directory = os.environ.get('UPLOAD_DIRECTORY', 'uploads')
+# Size limits in MB; 0 disables a limit
+upload_max_file_mb = float(os.environ.get('UPLOAD_MAX_FILE_MB', 256))
+upload_max_request_mb = float(os.environ.get('UPLOAD_MAX_REQUEST_MB', 1024))
+# Uploads are copied to disk this many bytes at a time
+UPLOAD_CHUNK_BYTES = 1 << 20
+
+
+def max_bytes(mb):
+    return int(mb * 1024 * 1024) if mb > 0 else None
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+# Content hashes of uploads queued or being embedded, per collection, so an identical file sent by a
+# concurrent request is skipped too; released when the job that owns them finishes
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def _claim(collection, content_hash):
+    with _pending_lock:
+        hashes = _pending.setdefault(collection, set())
+        if content_hash in hashes:
+            return False
+        hashes.add(content_hash)
+        return True
+
+
+def _release(collection, content_hashes):
+    with _pending_lock:
+        hashes = _pending.get(collection, set())
+        hashes.difference_update(content_hashes)
+        if not hashes:
+            _pending.pop(collection, None)
+
+
+def known_hashes(collection):
+    # Content hashes of the files fully ingested into the collection
+    manifest = Manifest(os.path.join(persist_directory, collection))
+    return {entry["hash"] for entry in manifest.files.values() if entry["hash"]}
+
+
+class StagedUpload:
+    # The files of one /embed2 request, streamed into a staging directory of their own so concurrent
+    # requests for a project never see or delete each other's files. Files whose content is already
+    # in the collection, or queued for it by another request, are skipped instead of written.
+    # Each file is ingested under the source name <project>/<filename>, so citations don't show the
+    # staging directory and a changed file uploaded again replaces the chunks of its previous version.
+
+    def __init__(self, collection, project_name):
+        self.collection = collection
+        self.request_id = uuid.uuid4().hex
+        self.project = secure_filename(project_name or "") or "default"
+        self.directory = os.path.join(upload_directory, self.project, self.request_id)
+        # source name -> staged path
+        self.files = {}
+        self.saved_files = []
+        self.skipped = []
+        self.bytes = 0
+        self._hashes = set()
+        self._known = None
+
+    def save(self, file, max_file_bytes=None, max_request_bytes=None):
+        if self._known is None:
+            self._known = known_hashes(self.collection)
+        os.makedirs(self.directory, exist_ok=True)
+        filename = secure_filename(file.filename or "") or "upload"
+        source = f"{self.project}/{filename}"
+        if source in self.files:
+            # A second file of the same name would replace the first one's chunks under the same source name
+            self.skipped.append({"filename": file.filename, "hash": None, "reason": "duplicate filename"})
+            return None
+        file_path = os.path.join(self.directory, filename)
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            with open(file_path, "wb") as f:
+                for block in iter(lambda: file.stream.read(UPLOAD_CHUNK_BYTES), b""):
+                    size += len(block)
+                    if max_file_bytes is not None and size > max_file_bytes:
+                        raise UploadTooLarge(f"{file.filename} is larger than {max_file_bytes / 1048576:g} MB")
+                    if max_request_bytes is not None and self.bytes + size > max_request_bytes:
+                        raise UploadTooLarge(f"The upload is larger than {max_request_bytes / 1048576:g} MB")
+                    sha.update(block)
+                    f.write(block)
+        except BaseException:
+            # The file is missing if opening it failed
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(file_path)
+            raise
+        self.bytes += size
+        content_hash = sha.hexdigest()
+        reason = None
+        if content_hash in self._known:
+            reason = "already in collection"
+        elif content_hash in self._hashes or not _claim(self.collection, content_hash):
+            reason = "duplicate upload"
+        if reason is not None:
+            os.remove(file_path)
+            self.skipped.append({"filename": file.filename, "hash": content_hash, "reason": reason})
+            return None
+        self._hashes.add(content_hash)
+        self.files[source] = file_path
+        self.saved_files.append(source)
+        return source
+
+    def cleanup(self):
+        # Removes the staged files and lets their content be uploaded again
+        _release(self.collection, self._hashes)
+        self._hashes = set()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,954 @@
+import argparse
+import atexit
+import fcntl
+import fnmatch
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, Iterable, List, Optional, Tuple
+
+import chromadb
+import numpy as np
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores import Chroma
+from langchain.vectorstores.base import VectorStore
+
+from constants import CHROMA_SETTINGS
+
+load_dotenv()
+
+persist_directory = os.environ.get('PERSIST_DIRECTORY')
+
+# Backend for collections without a store on disk yet: "chroma" or "mmap"
+vector_store_backend = os.environ.get('VECTOR_STORE', 'chroma')
+# Per-collection backends, e.g. "team-*=mmap,legacy=chroma"; patterns are shell-style wildcards
+vector_store_overrides = os.environ.get('VECTOR_STORE_OVERRIDES', '')
+# Element type of new mmap stores: float32, float16 (half the searched bytes) or int8 (a quarter,
+# scalar-quantized with one scale per vector)
+vector_store_dtype = os.environ.get('VECTOR_STORE_DTYPE', 'float32')
+# Quantized stores also keep the float32 vectors on disk and re-score their best candidates with them
+vector_store_rescore = os.environ.get('VECTOR_STORE_RESCORE', '1').lower() in ('1', 'true', 'yes')
+# Candidates re-scored per requested result
+vector_store_rescore_factor = int(os.environ.get('VECTOR_STORE_RESCORE_FACTOR', 4))
+# Maintain an HNSW graph next to new mmap stores for approximate search
+vector_store_hnsw = os.environ.get('VECTOR_STORE_HNSW', '0').lower() in ('1', 'true', 'yes')
+
+STORE_DIR = "mmap_store"
+INDEX_FILE = "meta.sqlite"
+VECTORS_FILE = "vectors.bin"
+NORMS_FILE = "norms.f32"
+SCALES_FILE = "scales.f32"
+FULL_VECTORS_FILE = "vectors.f32"
+HNSW_FILE = "hnsw.bin"
+
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+# Rows scored at a time by exact search, bounding the float32 copy of a quantized block
+SEARCH_BLOCK_ROWS = 65536
+# Quantized rows are converted to float32 before scoring; blocks this small stay in the CPU cache
+QUANTIZED_BLOCK_ROWS = 4096
+MIN_CAPACITY = 1024
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+_OPERATORS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+
+def quantize(vectors, dtype):
+    # Returns the stored form of float32 vectors and, for int8, each vector's scale
+    # (its largest absolute component maps to 127)
+    if DTYPES[dtype] is not np.int8:
+        return vectors.astype(DTYPES[dtype]), None
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.rint(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def dequantize(vectors, scales=None):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors * np.asarray(scales)[:, None] if scales is not None else vectors
+
+
+def _keep_best(best, rows, keys, exact, m):
+    # Merges a block's candidates into the running best m per query, ranked by keys
+    if best is not None:
+        rows, keys, exact = (np.concatenate([old, new], axis=1) for old, new in zip(best, (rows, keys, exact)))
+    if keys.shape[1] > m:
+        top = np.argpartition(keys, m - 1, axis=1)[:, :m]
+        rows, keys, exact = (np.take_along_axis(values, top, axis=1) for values in (rows, keys, exact))
+    return rows, keys, exact
+
+
+def _recall(found, truth):
+    return float(np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(found.tolist(), truth.tolist())]))
+
+
+def quantization_report(blocks, dtypes=("float16", "int8"), k=10, queries=100,
+                        factor=vector_store_rescore_factor, seed=0):
+    # Recall@k of each quantized dtype against exact float32 search, without and with re-scoring
+    # factor * k candidates. blocks() yields a collection's float32 vectors a block at a time; the
+    # queries are stored vectors, each left out of its own results.
+    sizes = [len(block) for block in blocks()]
+    total = sum(sizes)
+    if total <= k:
+        raise ValueError(f"Need more than {k} vectors, found {total}")
+    picked = np.sort(np.random.default_rng(seed).choice(total, size=min(queries, total), replace=False))
+    parts, offset = [], 0
+    for block in blocks():
+        inside = picked[(picked >= offset) & (picked < offset + len(block))]
+        parts.append(block[inside - offset])
+        offset += len(block)
+    query_vectors = np.concatenate(parts).astype(np.float32)
+    query_norms = np.einsum("ij,ij->i", query_vectors, query_vectors)[:, None]
+    m = k * factor
+    truth, approximate, offset = None, {dtype: None for dtype in dtypes}, 0
+    for block in blocks():
+        block = np.asarray(block, dtype=np.float32)
+        rows = np.broadcast_to(np.arange(offset, offset + len(block)), (len(query_vectors), len(block)))
+        norms = np.einsum("ij,ij->i", block, block)[None, :]
+        exact = norms - 2.0 * (query_vectors @ block.T) + query_norms
+        exact[rows == picked[:, None]] = np.inf
+        truth = _keep_best(truth, rows, exact, exact, k)
+        for dtype in dtypes:
+            stored, scales = quantize(block, dtype)
+            keys = norms - 2.0 * (query_vectors @ dequantize(stored, scales).T) + query_norms
+            keys[rows == picked[:, None]] = np.inf
+            approximate[dtype] = _keep_best(approximate[dtype], rows, keys, exact, m)
+        offset += len(block)
+    dim = query_vectors.shape[1]
+    report = {"rows": total, "dim": dim, "k": k, "queries": len(picked), "rescore_candidates": m, "dtypes": {}}
+    for dtype, (rows, keys, exact) in approximate.items():
+        top_approximate = np.take_along_axis(rows, np.argsort(keys, axis=1)[:, :k], axis=1)
+        top_rescored = np.take_along_axis(rows, np.argsort(exact, axis=1)[:, :k], axis=1)
+        row_bytes = dim * np.dtype(DTYPES[dtype]).itemsize + 4 + (4 if DTYPES[dtype] is np.int8 else 0)
+        report["dtypes"][dtype] = {
+            "search_bytes": total * row_bytes,
+            "saved_fraction": 1 - row_bytes / ((dim + 1) * 4),
+            "recall": _recall(top_approximate, truth[0]),
+            "recall_rescored": _recall(top_rescored, truth[0]),
+        }
+    return report
+
+
+def format_quantization_report(name, report):
+    lines = [f"{name}: {report['rows']} vectors of {report['dim']} dimensions, "
+             f"recall@{report['k']} over {report['queries']} queries against float32"]
+    for dtype, result in report["dtypes"].items():
+        lines.append(f"  {dtype:8} {result['search_bytes'] / 1e6:9.1f} MB searched ({result['saved_fraction']:.0%} saved), "
+                     f"recall {result['recall']:.3f}, {result['recall_rescored']:.3f} re-scoring "
+                     f"{report['rescore_candidates']} candidates")
+    return "\n".join(lines)
+
+
+def _where_sql(where):
+    # Translates a Chroma metadata filter into a SQL condition on the JSON metadata column
+    clauses, params = [], []
+    for key, value in where.items():
+        if key in ("$and", "$or"):
+            parts = [_where_sql(part) for part in value]
+            joiner = " AND " if key == "$and" else " OR "
+            clauses.append("(" + joiner.join(sql for sql, _ in parts) + ")")
+            for _, part_params in parts:
+                params.extend(part_params)
+            continue
+        column = f"json_extract(metadata, '$.\"{key}\"')"
+        if not isinstance(value, dict):
+            value = {"$eq": value}
+        for operator, operand in value.items():
+            if operator in ("$in", "$nin"):
+                placeholders = ",".join("?" * len(operand))
+                clauses.append(f"{column} {'IN' if operator == '$in' else 'NOT IN'} ({placeholders})")
+                params.extend(operand)
+            elif operator in _OPERATORS:
+                clauses.append(f"{column} {_OPERATORS[operator]} ?")
+                params.append(operand)
+            else:
+                raise ValueError(f"Unsupported filter operator {operator}")
+    return " AND ".join(clauses) or "1", params
+
+
+class MmapCollection:
+    # Vectors of one collection in a memory-mapped matrix, with documents and metadata in sqlite.
+    # Row i of vectors.bin holds the chunk stored with row i in the chunks table, and norms.f32
+    # its squared length, set to +inf once the chunk is deleted. Rows are only appended, so
+    # opening is constant time and processes mapping the same files share their pages.
+    # The committed row count lives in sqlite and is written after the vectors, so readers in
+    # other processes never see a row before its vector. An optional HNSW graph over the rows
+    # answers unfiltered queries; rows added after it was last saved are searched exactly.
+    # float16 and int8 stores search their smaller vectors, then re-score the best candidates with
+    # the float32 copy in vectors.f32, of which only those rows are read. int8 rows are scaled by
+    # scales.f32. Norms are always exact.
+    # Compaction rewrites the live rows into files of a new generation (vectors.<n>.bin, ...) and
+    # renumbers them in the same transaction. Searches read inside one sqlite snapshot, so they
+    # always pair row numbers with the files of the same generation.
+    # The methods mirror the chromadb Collection calls made by ingest.py and retrieval.py.
+
+    def __init__(self, directory, dtype=vector_store_dtype, hnsw=vector_store_hnsw, rescore=vector_store_rescore):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(directory, INDEX_FILE), check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS chunks (row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, "
+                         "document TEXT, metadata TEXT)")
+        with self._db:
+            # Settings are fixed when the store is created
+            self._db.execute("INSERT OR IGNORE INTO meta VALUES ('dtype', ?)", (dtype,))
+            self._db.execute("INSERT OR IGNORE INTO meta VALUES ('hnsw', ?)", ("1" if hnsw else "0",))
+            self._db.execute("INSERT OR IGNORE INTO meta VALUES ('rescore', ?)",
+                             ("1" if rescore and dtype != "float32" else "0",))
+        self.dtype_name = self._meta("dtype")
+        self.dtype = DTYPES[self.dtype_name]
+        self.hnsw = self._meta("hnsw") == "1"
+        self.rescore = self._meta("rescore") == "1"
+        self._vectors = None
+        self._norms = None
+        self._scales = None
+        self._full = None
+        self._generation = int(self._meta("generation", 0))
+        self._index = None
+        self._index_mtime = None
+        self._index_dirty = False
+
+    def _meta(self, name, default=None):
+        row = self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, name, value):
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, str(value)))
+
+    @property
+    def dim(self):
+        dim = self._meta("dim")
+        return int(dim) if dim is not None else None
+
+    def _rows(self):
+        return int(self._meta("rows", 0))
+
+    def _files(self, dim):
+        # (attribute, file, element type, columns) of every per-row file of the store
+        files = [("_vectors", VECTORS_FILE, self.dtype, dim), ("_norms", NORMS_FILE, np.float32, None)]
+        if self.dtype is np.int8:
+            files.append(("_scales", SCALES_FILE, np.float32, None))
+        if self.rescore:
+            files.append(("_full", FULL_VECTORS_FILE, np.float32, dim))
+        return files
+
+    def _path(self, name, generation=None):
+        # Files of generation 0, the one every store starts with, keep their plain names
+        generation = self._generation if generation is None else generation
+        if generation == 0:
+            return os.path.join(self.directory, name)
+        stem, extension = os.path.splitext(name)
+        return os.path.join(self.directory, f"{stem}.{generation}{extension}")
+
+    def _sync_generation(self):
+        # Drops the maps and the graph when the store was compacted since they were opened
+        generation = int(self._meta("generation", 0))
+        if generation != self._generation:
+            self._generation = generation
+            self._vectors = self._norms = self._scales = self._full = None
+            self._index, self._index_mtime, self._index_dirty = None, None, False
+
+    def _map(self, rows):
+        # (Re)maps the files when they hold fewer rows than needed, e.g. after another process grew them
+        self._sync_generation()
+        if self._vectors is not None and self._vectors.shape[0] >= rows:
+            return
+        dim = self.dim
+        capacity = os.path.getsize(self._path(NORMS_FILE)) // 4
+        # Assigned together, so a file removed by a compaction meanwhile leaves no partial mapping behind
+        maps = {attribute: np.memmap(self._path(name), dtype=dtype, mode="r+",
+                                     shape=(capacity, columns) if columns else (capacity,))
+                for attribute, name, dtype, columns in self._files(dim)}
+        for attribute, mapped in maps.items():
+            setattr(self, attribute, mapped)
+
+    def _grow(self, rows, dim):
+        self._sync_generation()
+        norms_path = self._path(NORMS_FILE)
+        capacity = os.path.getsize(norms_path) // 4 if os.path.exists(norms_path) else 0
+        if rows > capacity:
+            capacity = max(rows, capacity * 2, MIN_CAPACITY)
+            # Extending with truncate leaves existing pages, and other processes' mappings of them, untouched
+            for _, name, dtype, columns in self._files(dim):
+                with open(self._path(name), "ab") as f:
+                    f.truncate(capacity * (columns or 1) * np.dtype(dtype).itemsize)
+            self._vectors = None
+        self._map(rows)
+
+    def _snapshot(self, read):
+        # Runs read in one sqlite read transaction. A compaction committed between choosing the
+        # generation and mapping its files removes them; read is then retried on the new generation.
+        for attempt in range(2):
+            self._db.execute("BEGIN")
+            try:
+                return read()
+            except FileNotFoundError:
+                if attempt:
+                    raise
+            finally:
+                self._db.execute("COMMIT")
+
+    def _flush(self):
+        for attribute, _, _, _ in self._files(self.dim):
+            getattr(self, attribute).flush()
+
+    def _float_vectors(self, rows):
+        # float32 vectors of rows (a slice or an index array): the stored copy, or the dequantized rows
+        if self.rescore:
+            return np.asarray(self._full[rows])
+        return dequantize(self._vectors[rows], self._scales[rows] if self._scales is not None else None)
+
+    def add(self, ids: List[str], embeddings, metadatas: Optional[List[dict]] = None,
+            documents: Optional[List[str]] = None):
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        metadatas = metadatas or [None] * len(ids)
+        documents = documents or [None] * len(ids)
+        with self._lock, self._db:
+            # BEGIN IMMEDIATE serialises writers across processes while readers carry on
+            self._db.execute("BEGIN IMMEDIATE")
+            self._delete_rows(ids)
+            if self.dim is None:
+                self._set_meta("dim", vectors.shape[1])
+            start = self._rows()
+            end = start + len(ids)
+            self._grow(end, vectors.shape[1])
+            stored, scales = quantize(vectors, self.dtype_name)
+            self._vectors[start:end] = stored
+            self._norms[start:end] = np.einsum("ij,ij->i", vectors, vectors)
+            if scales is not None:
+                self._scales[start:end] = scales
+            if self.rescore:
+                self._full[start:end] = vectors
+            self._flush()
+            self._db.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", [
+                (start + i, chunk_id, document, json.dumps(metadata or {}))
+                for i, (chunk_id, document, metadata) in enumerate(zip(ids, documents, metadatas))
+            ])
+            self._set_meta("rows", end)
+            if self.hnsw:
+                self._index_add(start, end)
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[dict] = None):
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            if where is not None:
+                sql, params = _where_sql(where)
+                ids = [row[0] for row in self._db.execute(f"SELECT id FROM chunks WHERE {sql}", params)]
+            self._delete_rows(ids or [])
+
+    def _delete_rows(self, ids):
+        rows = []
+        for chunk_id in ids:
+            row = self._db.execute("SELECT row FROM chunks WHERE id = ?", (chunk_id,)).fetchone()
+            if row is not None:
+                rows.append(row[0])
+        if not rows:
+            return
+        self._db.executemany("DELETE FROM chunks WHERE row = ?", [(row,) for row in rows])
+        self._map(self._rows())
+        self._norms[rows] = np.inf
+        self._norms.flush()
+        if self._index is not None:
+            for row in rows:
+                if row < self._index.get_current_count():
+                    self._index.mark_deleted(row)
+            self._index_dirty = True
+
+    def count(self):
+        return self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def _load_index(self, rows):
+        # Returns the HNSW graph, reloading it when another process saved a newer one
+        import hnswlib
+
+        path = self._path(HNSW_FILE)
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        if self._index is not None and (self._index_dirty or mtime == self._index_mtime):
+            return self._index
+        index = hnswlib.Index(space="l2", dim=self.dim)
+        if mtime is not None:
+            index.load_index(path, max_elements=max(rows, 1), allow_replace_deleted=False)
+        else:
+            index.init_index(max_elements=max(rows, MIN_CAPACITY), M=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION)
+        index.set_ef(HNSW_EF_SEARCH)
+        self._index, self._index_mtime = index, mtime
+        return index
+
+    def _index_add(self, start, end):
+        index = self._load_index(end)
+        # Rows the saved graph doesn't cover yet, including ones added by other processes
+        first = index.get_current_count()
+        if index.get_max_elements() < end:
+            index.resize_index(max(end, index.get_max_elements() * 2))
+        index.add_items(self._float_vectors(slice(first, end)), np.arange(first, end))
+        deleted = np.nonzero(np.isinf(self._norms[first:end]))[0]
+        for row in deleted:
+            index.mark_deleted(first + int(row))
+        self._index_dirty = True
+
+    def _score(self, query, query_norm, rows, index, k):
+        # Squared L2 distances |x|^2 - 2 x.q + |q|^2 of one block (a slice or an index array of rows),
+        # cut down to its best k
+        dots = np.asarray(self._vectors[index], dtype=np.float32) @ query
+        if self._scales is not None:
+            dots *= self._scales[index]
+        distances = self._norms[index] - 2.0 * dots + query_norm
+        if len(rows) > k:
+            top = np.argpartition(distances, k)[:k]
+            rows, distances = rows[top], distances[top]
+        return rows, distances
+
+    def _exact(self, query, k, start=0, stop=None, rows=None):
+        # Scores rows[start:stop] of the map, or just the given rows, a block at a time
+        query_norm = float(np.dot(query, query))
+        block_rows = SEARCH_BLOCK_ROWS if self.dtype is np.float32 else QUANTIZED_BLOCK_ROWS
+        results = []
+        if rows is None:
+            for block_start in range(start, stop, block_rows):
+                block_stop = min(block_start + block_rows, stop)
+                results.append(self._score(query, query_norm, np.arange(block_start, block_stop),
+                                           slice(block_start, block_stop), k))
+        else:
+            for block_start in range(0, len(rows), block_rows):
+                block = rows[block_start:block_start + block_rows]
+                results.append(self._score(query, query_norm, block, block, k))
+        if not results:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        return np.concatenate([r for r, _ in results]), np.concatenate([d for _, d in results])
+
+    def _search(self, query, k, where):
+        rows_total = self._rows()
+        if rows_total == 0:
+            return [], []
+        self._map(rows_total)
+        final_k = k
+        if self.rescore:
+            k *= vector_store_rescore_factor
+        if where:
+            sql, params = _where_sql(where)
+            allowed = np.array([row[0] for row in self._db.execute(f"SELECT row FROM chunks WHERE {sql}", params)],
+                               dtype=np.int64)
+            rows, distances = self._exact(query, k, rows=allowed)
+        elif self.hnsw and (self._index is not None or os.path.exists(self._path(HNSW_FILE))):
+            index = self._load_index(rows_total)
+            covered = min(index.get_current_count(), rows_total)
+            try:
+                # Over-fetch, since rows deleted by another process may still be in a loaded graph
+                labels, graph_distances = index.knn_query(query, k=min(2 * k, covered))
+                rows, distances = labels[0].astype(np.int64), graph_distances[0]
+                deleted = np.isinf(self._norms[rows])
+                distances = np.where(deleted, np.inf, distances)
+            except RuntimeError:
+                # Fewer live elements than k in the graph: search the covered rows exactly instead
+                rows, distances = self._exact(query, k, 0, covered)
+            if covered < rows_total:
+                tail_rows, tail_distances = self._exact(query, k, covered, rows_total)
+                rows = np.concatenate([rows, tail_rows])
+                distances = np.concatenate([distances, tail_distances])
+        else:
+            rows, distances = self._exact(query, k, 0, rows_total)
+        keep = np.isfinite(distances)
+        rows, distances = rows[keep], distances[keep]
+        if self.rescore and len(rows):
+            # Exact distances of the approximate candidates; the graph can return a row twice
+            rows = np.unique(rows)
+            distances = self._norms[rows] - 2.0 * (self._full[rows] @ query) + float(np.dot(query, query))
+        order = np.argsort(distances)[:final_k]
+        return rows[order].tolist(), np.maximum(distances[order], 0.0).tolist()
+
+    def query(self, query_embeddings, n_results: int = 10, where: Optional[dict] = None,
+              include: Iterable[str] = ("metadatas", "documents", "distances")):
+        with self._lock:
+            results = self._snapshot(lambda: self._query(query_embeddings, n_results, where, include))
+        return {key: value for key, value in results.items() if key == "ids" or key in include}
+
+    def _query(self, query_embeddings, n_results, where, include):
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": [], "embeddings": []}
+        for query in np.asarray(query_embeddings, dtype=np.float32):
+            rows, distances = self._search(query, n_results, where)
+            records = self._records(rows)
+            hits = [(records[row], distance, row) for row, distance in zip(rows, distances) if row in records]
+            results["ids"].append([record[0] for record, _, _ in hits])
+            results["documents"].append([record[1] for record, _, _ in hits])
+            results["metadatas"].append([record[2] for record, _, _ in hits])
+            results["distances"].append([distance for _, distance, _ in hits])
+            if "embeddings" in include:
+                results["embeddings"].append(self._float_vectors(np.array([row for _, _, row in hits],
+                                                                          dtype=np.int64)).tolist())
+        return results
+
+    def _records(self, rows):
+        # row -> (id, document, metadata); rows deleted meanwhile are missing
+        records = {}
+        for start in range(0, len(rows), 500):
+            part = rows[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            for row, chunk_id, document, metadata in self._db.execute(
+                    f"SELECT row, id, document, metadata FROM chunks WHERE row IN ({placeholders})", part):
+                records[row] = (chunk_id, document, json.loads(metadata))
+        return records
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[dict] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None, include: Iterable[str] = ("metadatas", "documents")):
+        sql, params = _where_sql(where or {})
+        if ids is not None:
+            sql += f" AND id IN ({','.join('?' * len(ids))})"
+            params = params + list(ids)
+        query = f"SELECT row, id, document, metadata FROM chunks WHERE {sql} ORDER BY row"
+        if limit is not None or offset is not None:
+            query += f" LIMIT {int(limit) if limit is not None else -1} OFFSET {int(offset or 0)}"
+        def read():
+            records = self._db.execute(query, params).fetchall()
+            result = {"ids": [record[1] for record in records]}
+            if "documents" in include:
+                result["documents"] = [record[2] for record in records]
+            if "metadatas" in include:
+                result["metadatas"] = [json.loads(record[3]) for record in records]
+            if "embeddings" in include:
+                self._map(self._rows())
+                result["embeddings"] = self._float_vectors(np.array([record[0] for record in records],
+                                                                    dtype=np.int64)).tolist()
+            return result
+
+        with self._lock:
+            return self._snapshot(read)
+
+    def persist(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._flush()
+            if self._index is not None and self._index_dirty:
+                path = self._path(HNSW_FILE)
+                self._index.save_index(path + ".tmp")
+                os.replace(path + ".tmp", path)
+                self._index_mtime = os.path.getmtime(path)
+                self._index_dirty = False
+
+    def build_index(self):
+        # Builds the HNSW graph over every stored row, e.g. after migrating a collection
+        with self._lock:
+            self.hnsw = True
+            with self._db:
+                self._set_meta("hnsw", "1")
+            rows = self._rows()
+            if rows:
+                self._map(rows)
+                self._index_add(0, rows)
+            self.persist()
+
+    def disk_bytes(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+
+    def compact(self):
+        # Copies the live rows into files of the next generation, renumbers the chunks, rebuilds the
+        # HNSW graph and removes the previous generation's files. Searches running meanwhile keep
+        # the old files they mapped; the next ones map the new files.
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN IMMEDIATE")
+                self._sync_generation()
+                rows_total, dim = self._rows(), self.dim
+                live = np.array([row for (row,) in self._db.execute("SELECT row FROM chunks ORDER BY row")],
+                                dtype=np.int64)
+                result = {"rows_before": rows_total, "rows": len(live), "bytes_before": self.disk_bytes()}
+                if dim is None or len(live) == rows_total:
+                    result["bytes"] = result["bytes_before"]
+                    return result
+                self._map(rows_total)
+                previous = self._generation
+                old = {attribute: getattr(self, attribute) for attribute, _, _, _ in self._files(dim)}
+                self._set_meta("generation", previous + 1)
+                self._grow(max(len(live), 1), dim)
+                for start in range(0, len(live), SEARCH_BLOCK_ROWS):
+                    block = live[start:start + SEARCH_BLOCK_ROWS]
+                    for attribute, mapped in old.items():
+                        getattr(self, attribute)[start:start + len(block)] = mapped[block]
+                self._flush()
+                # Rows only move down and are renumbered in ascending order, so no two chunks ever share one
+                self._db.executemany("UPDATE chunks SET row = ? WHERE row = ?",
+                                     [(new, int(row)) for new, row in enumerate(live) if new != row])
+                self._set_meta("rows", len(live))
+                if self.hnsw and len(live):
+                    self._index_add(0, len(live))
+                    self.persist()
+            old = None
+            for _, name, _, _ in self._files(dim) + [(None, HNSW_FILE, None, None)]:
+                path = self._path(name, previous)
+                if os.path.exists(path):
+                    os.remove(path)
+            self._db.execute("VACUUM")
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            result["bytes"] = self.disk_bytes()
+            return result
+
+    def memory(self):
+        # Bytes scanned by exact search (vectors, norms and scales of every row) against float32 vectors
+        rows, dim = self._rows(), self.dim or 0
+        searched = sum(rows * (columns or 1) * np.dtype(dtype).itemsize
+                       for attribute, _, dtype, columns in self._files(dim) if attribute != "_full")
+        float32 = rows * (dim + 1) * 4
+        return {"dtype": self.dtype_name, "rescore": self.rescore, "rows": rows, "search_bytes": searched,
+                "float32_bytes": float32, "saved_bytes": float32 - searched}
+
+    def full_vectors(self):
+        # Live rows' float32 vectors, a block at a time, for measuring recall against full precision
+        if self.dtype is not np.float32 and not self.rescore:
+            raise ValueError(f"{self.directory} keeps only {self.dtype_name} vectors")
+        rows_total = self._rows()
+        if rows_total:
+            self._map(rows_total)
+        for start in range(0, rows_total, SEARCH_BLOCK_ROWS):
+            stop = min(start + SEARCH_BLOCK_ROWS, rows_total)
+            live = np.isfinite(self._norms[start:stop])
+            yield self._float_vectors(slice(start, stop))[live]
+
+    def close(self):
+        self._db.close()
+        self._vectors = self._norms = self._scales = self._full = self._index = None
+
+
+class MmapVectorStore(VectorStore):
+    # LangChain vector store over an MmapCollection kept in <collection persist directory>/mmap_store.
+    # Like Chroma, similarity_search_with_score returns squared L2 distances.
+
+    def __init__(self, collection_name: str, persist_directory: str, embedding_function: Optional[Embeddings] = None,
+                 dtype: str = vector_store_dtype, hnsw: bool = vector_store_hnsw, rescore: bool = vector_store_rescore):
+        self.collection_name = collection_name
+        self.persist_directory = persist_directory
+        self._embedding_function = embedding_function
+        self._collection = MmapCollection(os.path.join(persist_directory, STORE_DIR), dtype=dtype, hnsw=hnsw,
+                                          rescore=rescore)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid1()) for _ in texts]
+        embeddings = self._embedding_function.embed_documents(texts)
+        self._collection.add(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=texts)
+        return ids
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4,
+                                               filter: Optional[dict] = None) -> List[Tuple[Document, float]]:
+        results = self._collection.query(query_embeddings=[embedding], n_results=k, where=filter)
+        return [
+            (Document(page_content=text, metadata=metadata), distance)
+            for text, metadata, distance in zip(results["documents"][0], results["metadatas"][0], results["distances"][0])
+        ]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None,
+                                     **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding_function.embed_query(query), k, filter)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, filter: Optional[dict] = None,
+                                    **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   ids: Optional[List[str]] = None, collection_name: str = "langchain",
+                   persist_directory: Optional[str] = None, **kwargs: Any) -> "MmapVectorStore":
+        store = cls(collection_name, persist_directory, embedding)
+        store.add_texts(texts, metadatas, ids)
+        return store
+
+    def persist(self):
+        self._collection.persist()
+
+    def delete_collection(self):
+        self._collection.close()
+        shutil.rmtree(self._collection.directory, ignore_errors=True)
+
+
+def backend_for(collection_name, directory):
+    # An override names the backend outright; otherwise a collection keeps the backend it was
+    # created (or migrated) with, and new collections use VECTOR_STORE
+    for entry in vector_store_overrides.split(","):
+        pattern, _, backend = entry.partition("=")
+        if backend and fnmatch.fnmatch(collection_name, pattern.strip()):
+            return backend.strip()
+    if os.path.exists(os.path.join(directory, STORE_DIR, INDEX_FILE)):
+        return "mmap"
+    return vector_store_backend
+
+
+# The duckdb+parquet database behind every Chroma collection
+CHROMA_FILES = ("chroma-embeddings.parquet", "chroma-collections.parquet")
+# Held by the process writing to Chroma collections, for a whole ingest or admin operation
+CHROMA_WRITE_LOCK = "chroma.write.lock"
+# Held while the parquet files are written (exclusively) or loaded (shared)
+CHROMA_PERSIST_LOCK = "chroma.persist.lock"
+
+_chroma_client = None
+_chroma_client_guard = threading.RLock()
+_chroma_loaded = None  # parquet files the client's copy matches, as (mtime, size) pairs
+_chroma_writers = 0
+_chroma_write_file = None
+_chroma_write_guard = threading.Lock()
+
+
+@contextmanager
+def _chroma_file_lock(name, mode):
+    os.makedirs(CHROMA_SETTINGS.persist_directory, exist_ok=True)
+    with open(os.path.join(CHROMA_SETTINGS.persist_directory, name), "a") as f:
+        fcntl.flock(f, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _chroma_signature():
+    signature = []
+    for name in CHROMA_FILES:
+        try:
+            stat = os.stat(os.path.join(CHROMA_SETTINGS.persist_directory, name))
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def chroma_client():
+    # One client per process: every duckdb+parquet client loads and persists the whole database,
+    # so separate clients in one process would overwrite each other's changes on persist.
+    # The client holds a copy of the parquet files, loaded again when another process persisted
+    # since, unless this process is writing (and so holds the write lock). chromadb's own persist
+    # at exit is dropped, since it would write a stale copy back; chroma_write persists instead.
+    global _chroma_client, _chroma_loaded
+    with _chroma_client_guard:
+        if _chroma_client is None:
+            with _chroma_file_lock(CHROMA_PERSIST_LOCK, fcntl.LOCK_SH):
+                _chroma_loaded = _chroma_signature()
+                _chroma_client = chromadb.Client(CHROMA_SETTINGS)
+            atexit.unregister(_chroma_client._db.persist)
+        elif not _chroma_writers and _chroma_signature() != _chroma_loaded:
+            _reload_chroma()
+        return _chroma_client
+
+
+def _reload_chroma():
+    global _chroma_loaded
+    from retrieval import store_lock
+
+    db = _chroma_client._db
+    # Queries of this process's stores wait while the tables are replaced
+    with store_lock(_chroma_client), _chroma_file_lock(CHROMA_PERSIST_LOCK, fcntl.LOCK_SH):
+        _chroma_loaded = _chroma_signature()
+        db._conn.execute("DELETE FROM embeddings")
+        db._conn.execute("DELETE FROM collections")
+        # HNSW indexes are saved on every change and loaded again on first use
+        # (reset_indexes() would delete their files)
+        db.index_cache = {}
+        db.load()
+
+
+def persist_chroma():
+    global _chroma_loaded
+    client = chroma_client()
+    with _chroma_client_guard, _chroma_file_lock(CHROMA_PERSIST_LOCK, fcntl.LOCK_EX):
+        client.persist()
+        _chroma_loaded = _chroma_signature()
+
+
+@contextmanager
+def chroma_write():
+    # Wraps changes to Chroma collections. Processes take turns, so none persists a copy missing
+    # another's changes: the first writer of a process waits for the write lock of PERSIST_DIRECTORY
+    # and loads the latest copy, and every writer persists when done. Threads of one process share
+    # the lock, since they share the client.
+    global _chroma_writers, _chroma_write_file
+    with _chroma_write_guard:
+        if not _chroma_writers:
+            os.makedirs(CHROMA_SETTINGS.persist_directory, exist_ok=True)
+            f = open(os.path.join(CHROMA_SETTINGS.persist_directory, CHROMA_WRITE_LOCK), "a")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            _chroma_write_file = f
+            chroma_client()
+        _chroma_writers += 1
+    try:
+        yield chroma_client()
+    finally:
+        try:
+            persist_chroma()
+        finally:
+            with _chroma_write_guard:
+                _chroma_writers -= 1
+                if not _chroma_writers:
+                    fcntl.flock(_chroma_write_file, fcntl.LOCK_UN)
+                    _chroma_write_file.close()
+                    _chroma_write_file = None
+
+
+def chroma_has_collection(collection_name):
+    # list_collections() would load chromadb's default embedding function for every collection
+    try:
+        chroma_client().get_collection(collection_name, embedding_function=_no_embeddings)
+    except ValueError:
+        return False
+    return True
+
+
+def stored_dtype(collection_name, directory):
+    # Element type of a collection's stored vectors; Chroma always stores float32
+    if backend_for(collection_name, directory) != "mmap":
+        return "float32"
+    path = os.path.join(directory, STORE_DIR, INDEX_FILE)
+    if not os.path.exists(path):
+        return vector_store_dtype
+    with sqlite3.connect(path) as db:
+        row = db.execute("SELECT value FROM meta WHERE name = 'dtype'").fetchone()
+    return row[0] if row else vector_store_dtype
+
+
+def open_store(collection_name, directory, embeddings, backend=None, dtype=None, rescore=vector_store_rescore):
+    # Opens the vector store of a collection whose files live in directory (PERSIST_DIRECTORY/<collection>).
+    # dtype and rescore only apply to an mmap store created by this call.
+    backend = backend or backend_for(collection_name, directory)
+    if backend == "mmap":
+        return MmapVectorStore(collection_name, directory, embeddings, dtype=dtype or vector_store_dtype,
+                               rescore=rescore)
+    if backend == "chroma":
+        return Chroma(collection_name=collection_name, persist_directory=directory, embedding_function=embeddings,
+                      client=chroma_client())
+    raise ValueError(f"Unknown vector store backend '{backend}'")
+
+
+def _no_embeddings(texts):
+    raise RuntimeError("Stored chunks are read as they are and never embedded")
+
+
+def stored_collection(collection_name, directory):
+    # The collection object behind a store, for reading its chunks without loading an embeddings model
+    if backend_for(collection_name, directory) == "mmap":
+        return MmapCollection(os.path.join(directory, STORE_DIR))
+    return chroma_client().get_collection(collection_name, embedding_function=_no_embeddings)
+
+
+def _copy_collection(source, store_directory, dtype, hnsw, rescore, batch_size):
+    # Copies every chunk of source, a Chroma or mmap collection, with its stored vectors into a new
+    # mmap store; a partly written store is removed again if the copy fails
+    target = MmapCollection(store_directory, dtype=dtype, hnsw=False, rescore=rescore)
+    total = source.count()
+    try:
+        for offset in range(0, total, batch_size):
+            batch = source.get(limit=batch_size, offset=offset,
+                               include=["embeddings", "documents", "metadatas"])
+            target.add(ids=batch["ids"], embeddings=batch["embeddings"], metadatas=batch["metadatas"],
+                       documents=batch["documents"])
+            print(f"Copied {min(offset + batch_size, total)}/{total} chunks")
+        if hnsw:
+            print("Building HNSW index")
+            target.build_index()
+        target.persist()
+    except BaseException:
+        target.close()
+        shutil.rmtree(store_directory, ignore_errors=True)
+        raise
+    return target
+
+
+def migrate(collection_name, dtype=vector_store_dtype, hnsw=vector_store_hnsw, rescore=vector_store_rescore,
+            batch_size=1000):
+    # Copies a Chroma collection into an mmap store in the same directory, keeping chunk ids so the
+    # collection's manifest stays valid. The Chroma data is left in place until deleted by hand.
+    directory = os.path.join(persist_directory, collection_name)
+    # Stored embeddings are copied as they are, so no embedding function is needed (or loaded)
+    source = chroma_client().get_collection(collection_name, embedding_function=_no_embeddings)
+    store_directory = os.path.join(directory, STORE_DIR)
+    if os.path.exists(store_directory):
+        raise ValueError(f"{store_directory} already exists")
+    target = _copy_collection(source, store_directory, dtype, hnsw, rescore, batch_size)
+    print(f"Migrated {collection_name}: {target.count()} chunks in {store_directory}")
+
+
+def convert_store(collection_name, directory, dtype, rescore=vector_store_rescore, batch_size=1000):
+    # Rewrites a collection's vectors as dtype in a new mmap store, which replaces the current one once
+    # complete. The stored vectors are copied, so nothing is embedded again and chunk ids, the manifest
+    # and the BM25 index stay valid. A quantized store without float32 copies is dequantized, so going
+    # back to higher precision doesn't restore the original vectors. Chroma data is left in place, as
+    # by migrate.
+    source = stored_collection(collection_name, directory)
+    store_directory = os.path.join(directory, STORE_DIR)
+    new_directory = store_directory + ".new"
+    shutil.rmtree(new_directory, ignore_errors=True)
+    if isinstance(source, MmapCollection):
+        hnsw = source.hnsw
+        if source.dtype_name != "float32" and not source.rescore and dtype != source.dtype_name:
+            print(f"{collection_name} keeps only {source.dtype_name} vectors; they are dequantized, "
+                  f"re-ingest with --full-rebuild for exact vectors")
+    else:
+        hnsw = vector_store_hnsw
+    try:
+        target = _copy_collection(source, new_directory, dtype, hnsw, rescore, batch_size)
+    finally:
+        if isinstance(source, MmapCollection):
+            source.close()
+    target.close()
+    old_directory = store_directory + ".old"
+    if os.path.exists(store_directory):
+        os.replace(store_directory, old_directory)
+    os.replace(new_directory, store_directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def collection_vectors(collection_name, directory):
+    # Returns a function yielding the collection's float32 vectors a block at a time
+    collection = stored_collection(collection_name, directory)
+    if isinstance(collection, MmapCollection):
+        return collection.full_vectors
+    total = collection.count()
+
+    def blocks():
+        for offset in range(0, total, SEARCH_BLOCK_ROWS):
+            batch = collection.get(limit=SEARCH_BLOCK_ROWS, offset=offset, include=["embeddings"])
+            yield np.asarray(batch["embeddings"], dtype=np.float32)
+
+    return blocks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage memory-mapped vector stores")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="Copy Chroma collections into mmap stores")
+    migrate_parser.add_argument("collections", nargs="+", help="Collection names or wildcards such as 'team-*'")
+    migrate_parser.add_argument("--dtype", choices=sorted(DTYPES), default=vector_store_dtype)
+    migrate_parser.add_argument("--hnsw", action="store_true", default=vector_store_hnsw, help="Also build an HNSW graph")
+    migrate_parser.add_argument("--no-rescore", dest="rescore", action="store_false", default=vector_store_rescore,
+                                help="Keep only the quantized vectors of a float16/int8 store")
+    index_parser = subparsers.add_parser("build-index", help="Build the HNSW graph of mmap stores")
+    index_parser.add_argument("collections", nargs="+")
+    report_parser = subparsers.add_parser("quantization-report",
+                                          help="Memory saved and recall@k of float16 and int8 storage against float32")
+    report_parser.add_argument("collections", nargs="+")
+    report_parser.add_argument("--k", type=int, default=10)
+    report_parser.add_argument("--queries", type=int, default=100, help="Stored vectors used as queries")
+    args = parser.parse_args()
+
+    from retrieval import resolve_collections
+
+    for name in resolve_collections(args.collections, persist_directory):
+        if args.command == "migrate":
+            migrate(name, dtype=args.dtype, hnsw=args.hnsw, rescore=args.rescore)
+        elif args.command == "quantization-report":
+            blocks = collection_vectors(name, os.path.join(persist_directory, name))
+            try:
+                print(format_quantization_report(name, quantization_report(blocks, k=args.k, queries=args.queries)))
+            except ValueError as e:
+                print(f"Skipping {name}: {e}")
+        else:
+            MmapCollection(os.path.join(persist_directory, name, STORE_DIR)).build_index()
+            print(f"Built HNSW index for {name}")